@@ -0,0 +1,145 @@
+from whatdisay.callbacks import CallbackReceiver, CallbackTimeout, DeepgramJobs
+from whatdisay.deepgram_stub import DeepgramStub, StubSettings
+from whatdisay.upload import WavSource, SegmentPayload, ByteBudget, uploadSegments
+import whatdisay.callbacks as callbacks
+import numpy as np
+import aiohttp
+import asyncio
+import io
+import time
+import wave
+import pytest
+
+
+def tone_wav(seconds=3.0, freq=220, frame_rate=16000) -> bytes:
+    # a tone with quiet lead-in and tail, so the stub hears one utterance
+    t = np.arange(int(seconds * frame_rate)) / frame_rate
+    x = 8000 * np.sin(2 * np.pi * freq * t) * ((t > 0.5) & (t < seconds - 0.5))
+    x = (x + np.random.default_rng(freq).normal(0, 10, len(t))).astype(np.int16)
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(frame_rate)
+        w.writeframes(x.tobytes())
+    return buf.getvalue()
+
+
+OPTIONS = {'punctuate': True, 'diarize': True, 'utterances': True, 'model': 'meeting'}
+
+
+def run_jobs(stub, n, **kwargs):
+    async def main(receiver):
+        jobs = DeepgramJobs(receiver, api_url=stub.url, api_key='stub', poll_url=stub.url + '/listen/{request_id}', **kwargs)
+        async with aiohttp.ClientSession() as session:
+            results = await asyncio.gather(*[
+                jobs.transcribe(tone_wav(2.0 + i, 180 + 60 * i), OPTIONS, session=session) for i in range(n)
+            ])
+        return jobs, results
+
+    with CallbackReceiver() as receiver:
+        return asyncio.run(main(receiver))
+
+
+def test_results_arrive_by_callback():
+    with DeepgramStub(StubSettings(latency='fixed:300', seed=1)) as stub:
+        jobs, results = run_jobs(stub, 8, poll_after_s=30, timeout_s=60)
+
+    assert jobs.stats == {'submitted': 8, 'callbacks': 8, 'polled': 0, 'timed_out': 0}
+    for i, r in enumerate(results):
+        assert r['metadata']['duration'] == pytest.approx(2.0 + i, abs=0.01)
+        assert r['results']['utterances']
+    # every upload was answered right away instead of after the processing latency
+    assert max(r['latency'] for r in stub.stats.snapshot()['requests']) < 0.3
+
+
+def test_streamed_segment_payloads(tmp_path):
+    wav_file = tmp_path / 'meeting.wav'
+    wav_file.write_bytes(tone_wav(6.0))
+
+    async def main(receiver, stub):
+        jobs = DeepgramJobs(receiver, api_url=stub.url, api_key='stub', poll_after_s=30, timeout_s=60)
+        with WavSource(str(wav_file)) as source:
+            payloads = [SegmentPayload(source, s, s + 2.0, spacer_ms=2000, chunk_bytes=4096) for s in (0.0, 2.0, 4.0)]
+            async with aiohttp.ClientSession() as session:
+                return await asyncio.gather(*[jobs.transcribe(p.chunks(), {'model': 'whisper'}, session=session) for p in payloads])
+
+    with DeepgramStub(StubSettings(latency='fixed:100', seed=4)) as stub, CallbackReceiver() as receiver:
+        results = asyncio.run(main(receiver, stub))
+
+    assert [r['metadata']['duration'] for r in results] == pytest.approx([4.0, 4.0, 4.0], abs=0.01)
+
+
+def test_lost_callbacks_are_polled_for():
+    with DeepgramStub(StubSettings(latency='fixed:200', callback_drop_rate=1.0, seed=2)) as stub:
+        jobs, results = run_jobs(stub, 4, poll_after_s=0.5, poll_interval_s=0.2, timeout_s=10)
+
+    assert jobs.stats['polled'] == 4 and jobs.stats['callbacks'] == 0
+    assert all(r['results']['channels'][0]['alternatives'][0]['transcript'] for r in results)
+
+
+def test_times_out_without_a_result():
+    with DeepgramStub(StubSettings(latency='fixed:5000', callback_drop_rate=1.0, seed=3)) as stub:
+        with pytest.raises(CallbackTimeout):
+            run_jobs(stub, 1, poll_after_s=0.2, poll_interval_s=0.2, timeout_s=1.0)
+
+
+def test_times_out_without_polling():
+    async def main(receiver, stub):
+        jobs = DeepgramJobs(receiver, api_url=stub.url, api_key='stub', poll_after_s=0.1, timeout_s=1.0)
+        async with aiohttp.ClientSession() as session:
+            await jobs.transcribe(tone_wav(2.0), OPTIONS, session=session)
+
+    with DeepgramStub(StubSettings(latency='fixed:100', callback_drop_rate=1.0, seed=5)) as stub, CallbackReceiver() as receiver:
+        with pytest.raises(CallbackTimeout):
+            asyncio.run(main(receiver, stub))
+
+
+def test_unknown_request_is_an_error():
+    async def main(receiver, stub):
+        jobs = DeepgramJobs(receiver, api_url=stub.url, api_key='stub', poll_url=stub.url + '/listen/{request_id}', poll_after_s=0.1, timeout_s=30)
+        async with aiohttp.ClientSession() as session:
+            await jobs.collect(session, 'not-a-request')
+
+    with DeepgramStub(StubSettings(seed=6)) as stub, CallbackReceiver() as receiver:
+        with pytest.raises(aiohttp.ClientResponseError) as e:
+            asyncio.run(main(receiver, stub))
+    assert e.value.status == 404
+
+
+def test_refuses_unreachable_receiver(monkeypatch):
+    with CallbackReceiver() as receiver:
+        monkeypatch.setattr(callbacks, 'sharedReceiver', lambda: receiver)
+        monkeypatch.setattr(callbacks.Config, 'get_optional_param', lambda self, k, d=None: {'DEEPGRAM_API_URL': 'https://api.deepgram.com/v1'}.get(k, d))
+        monkeypatch.setattr(callbacks.Config, 'get_param', lambda self, k: 'key')
+        with pytest.raises(ValueError, match='CALLBACK_PUBLIC_URL'):
+            callbacks.deepgramJobs()
+
+        receiver.public_url = 'https://hooks.example.com'
+        assert callbacks.deepgramJobs().receiver is receiver
+
+
+def test_upload_slots_are_freed_once_submitted(tmp_path):
+    wav_file = tmp_path / 'meeting.wav'
+    wav_file.write_bytes(tone_wav(12.0))
+    segments = [[s, s + 1.5, 'Speaker_0'] for s in range(0, 12, 2)]
+
+    async def main(receiver, stub):
+        jobs = DeepgramJobs(receiver, api_url=stub.url, api_key='stub', poll_after_s=30, timeout_s=60)
+        budget = ByteBudget(10 ** 9)
+
+        async def send(i, segment, payload):
+            return await jobs.transcribe(payload.chunks(), {'model': 'whisper'}, session=session, on_submitted=payload.uploaded)
+
+        started = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            with WavSource(str(wav_file)) as source:
+                results, _ = await uploadSegments(source, segments, send, budget, max_concurrency=1)
+        return budget, results, time.monotonic() - started
+
+    with DeepgramStub(StubSettings(latency='fixed:1000', seed=7)) as stub, CallbackReceiver() as receiver:
+        budget, results, elapsed = asyncio.run(main(receiver, stub))
+
+    assert all(results) and budget.in_flight == 0
+    # one slot, but it's only held while uploading: the 1s of processing of each segment overlaps the others'
+    assert elapsed < 3.0
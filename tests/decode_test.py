@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+decode = pytest.importorskip('whatdisay.decode')
+
+
+class StubModel:
+    # stands in for a whisper model: transcribe returns canned windows, at the temperature each one ended up at
+
+    def __init__(self, is_multilingual=True, windows=((0.0, -0.3),)):
+        self.is_multilingual = is_multilingual
+        self.windows = windows
+        self.calls = []
+
+    def detect_language(self, mel):
+        if not self.is_multilingual:
+            raise ValueError("This model doesn't have language tokens so it can't perform lang id")
+        return None, {'en': 0.1, 'de': 0.9}
+
+    def transcribe(self, audio, **kwargs):
+        self.calls.append(kwargs)
+        segments = [
+            {'seek': 3000 * i, 'start': 30.0 * i, 'end': 30.0 * i + 5, 'text': f' window {i}', 'temperature': t,
+             'avg_logprob': logprob, 'compression_ratio': 1.2, 'no_speech_prob': 0.01}
+            for i, (t, logprob) in enumerate(self.windows)
+        ]
+        return {'text': ''.join(s['text'] for s in segments), 'segments': segments, 'language': kwargs['language']}
+
+
+def session(model, **kwargs):
+    s = decode.DecodeSession('stub', **kwargs)
+    s._model = model
+    return s
+
+
+def test_english_only_models_skip_detection():
+    model = StubModel(is_multilingual=False)
+    s = session(model)
+    s.transcribe(np.zeros(16000, dtype=np.float32), 'A')
+    assert s.language == 'en' and s.detect_passes == 0
+    assert model.calls[0]['language'] == 'en'
+
+
+def test_fallbacks_are_per_window():
+    # the second window needed both fallbacks and still failed; the others decoded once
+    model = StubModel(windows=((0.0, -0.3), (0.4, -1.5), (0.0, -0.2)))
+    s = session(model, max_fallbacks=2, language='en')
+    s.transcribe(np.zeros(16000, dtype=np.float32), 'A')
+
+    assert len(model.calls) == 1 and model.calls[0]['temperature'] == (0.0, 0.2, 0.4)
+    assert s.stats()['decode_passes'] == 5
+    assert s.stats()['fallbacks'] == 2 and s.stats()['fallbacks_exhausted'] == 1
+
+
+def test_evicting_drops_session_references(monkeypatch):
+    monkeypatch.setattr(decode.whisper, 'load_model', lambda name: StubModel())
+    s = session(None, language='en')
+    s._model = None
+    s.transcribe(np.zeros(16000, dtype=np.float32), 'A')
+    assert 'stub' in decode._MODELS
+
+    assert decode.evictWhisperModels() == ['stub']
+    assert s._model is None and 'stub' not in decode._MODELS
+    # the session loads it again when it's needed
+    s.transcribe(np.zeros(16000, dtype=np.float32), 'A')
+
+    # a model someone else holds on to would only be loaded twice, so it stays
+    held = s.model
+    assert decode.evictWhisperModels() == []
+    assert decode._MODELS['stub'] is held
+    del held
+    assert decode.evictWhisperModels() == ['stub']
+
+
+def test_model_copies_load_and_lock_separately(monkeypatch):
+    monkeypatch.setattr(decode.whisper, 'load_model', lambda name: StubModel())
+    first, second = decode.DecodeSession('stub', language='en'), decode.DecodeSession('stub', language='en', copy=1)
+    assert first.model is not second.model
+    assert decode.decodeLock(first.model_key) is not decode.decodeLock(second.model_key)
+    del first, second
+    decode.evictWhisperModels()
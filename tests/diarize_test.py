@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+diarize = pytest.importorskip('whatdisay.diarize')
+
+
+class FakePipeline:
+
+    def __init__(self, threshold=0.5, embedding='pyannote/wespeaker-voxceleb-resnet34-LM'):
+        self.embedding = embedding
+        self.segmentation_step = 0.1
+        self.threshold = threshold
+
+    def parameters(self, instantiated=False):
+        # hyperparameters come back as numpy scalars
+        return {
+            'segmentation': {'min_duration_off': np.float64(0.0), 'threshold': np.float32(self.threshold)},
+            'clustering': {'method': 'centroid', 'threshold': np.float64(0.7)},
+        }
+
+
+def test_speaker_args():
+    assert diarize._speakerArgs() == {}
+    assert diarize._speakerArgs(num_speakers='3') == {'num_speakers': 3}
+    # 0 means not set, like an empty option
+    assert diarize._speakerArgs(num_speakers=0, min_speakers=2, max_speakers=4.0) == {'min_speakers': 2, 'max_speakers': 4}
+
+
+def test_pipeline_key():
+    key = diarize._pipelineKey(FakePipeline(), 500)
+    assert key == diarize._pipelineKey(FakePipeline(), 500)
+    # anything the cached embeddings depend on changes the key
+    assert key != diarize._pipelineKey(FakePipeline(), 0)
+    assert key != diarize._pipelineKey(FakePipeline(threshold=0.6), 500)
+    assert key != diarize._pipelineKey(FakePipeline(embedding='speechbrain/spkrec-ecapa-voxceleb'), 500)
+
+    # clustering settings don't, re-clustering is what the cache is for
+    other = FakePipeline()
+    other.parameters = lambda instantiated=False: {**FakePipeline().parameters(), 'clustering': {'threshold': 0.5}}
+    assert key == diarize._pipelineKey(other, 500)
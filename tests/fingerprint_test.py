@@ -0,0 +1,78 @@
+from whatdisay.fingerprint import FingerprintIndex, SegmentDedupe, spectralFingerprint, bitErrorRate
+from whatdisay.upload import WavSource
+import numpy as np
+import wave
+
+
+RATE = 16000
+
+
+def jingle(seconds, seed):
+    # tones hopping between random pitches, loud enough to fingerprint
+    rng = np.random.default_rng(seed)
+    notes = rng.uniform(300, 1800, int(seconds * 8))
+    f = np.repeat(notes, RATE // 8)[:int(seconds * RATE)]
+    return 0.3 * np.sin(2 * np.pi * np.cumsum(f) / RATE) + rng.normal(0, 0.003, len(f))
+
+
+def write_wav(path, x):
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(RATE)
+        w.writeframes((x * 32767).astype(np.int16).tobytes())
+    return str(path)
+
+
+def test_fingerprint_survives_a_shifted_cut():
+    x = jingle(6.0, 1)
+    a, loud = spectralFingerprint(x[:5 * RATE], RATE)
+    # cut 0.3s later and quieter
+    b, _ = spectralFingerprint(0.5 * x[int(0.3 * RATE):int(5.3 * RATE)], RATE)
+    assert loud.all() and len(a) == len(b)
+    assert bitErrorRate(b, a, int(0.3 * 64), 0.9) < 0.15
+    other, _ = spectralFingerprint(jingle(5.0, 2), RATE)
+    assert bitErrorRate(other, a, 0, 0.9) > 0.35
+
+
+def test_index_lookup(tmp_path):
+    x = jingle(6.0, 1)
+    with FingerprintIndex(str(tmp_path / 'fingerprints.db')) as index:
+        values, loud = spectralFingerprint(x[:5 * RATE], RATE)
+        clip = index.add('whisper:base', values, loud, 5.0, 'Thanks for calling.')
+
+        values, loud = spectralFingerprint(x[int(0.2 * RATE):int(5.2 * RATE)], RATE)
+        hit = index.lookup('whisper:base', values, loud, 5.0)
+        assert hit[:2] == (clip, 'Thanks for calling.') and hit[2] < 0.15
+        # only reused for the engine that transcribed it, and for clips about as long
+        assert index.lookup('deepgram:whisper', values, loud, 5.0) is None
+        assert index.lookup('whisper:base', values, loud, 8.0) is None
+
+        values, loud = spectralFingerprint(jingle(5.0, 2), RATE)
+        assert index.lookup('whisper:base', values, loud, 5.0) is None
+
+
+def test_segment_dedupe(tmp_path):
+    intro = jingle(3.0, 1)
+    x = np.concatenate([intro, jingle(3.0, 2), intro, jingle(3.0, 3)])
+    db = str(tmp_path / 'fingerprints.db')
+    segments = [[0.0, 3.0, 'A'], [3.0, 6.0, 'B'], [6.0, 9.0, 'A'], [9.0, 12.0, 'B'], [12.0, 13.0, 'A']]
+
+    with WavSource(write_wav(tmp_path / 'first.wav', x)) as source:
+        dedupe = SegmentDedupe(FingerprintIndex(db), 'whisper:base')
+        assert [dedupe.match(source, i, s) for i, s in enumerate(segments)] == [None] * 5
+        # the repeated intro waits for the first one's transcript, the short segment isn't fingerprinted
+        assert dedupe.followers == {2: 0} and sorted(dedupe.placeholders) == [0, 1, 3]
+        dedupe.remember(0, 'Welcome to the show.')
+        dedupe.remember(1, 'Today we talk about budgets.')
+        dedupe.forget(3)
+        assert dedupe.follower_texts({0: 'Welcome to the show.', 1: 'Today we talk about budgets.'}) == {2: 'Welcome to the show.'}
+        assert dedupe.index.stats() == {'clips': 2, 'hits': 0}
+        dedupe.index.close()
+
+    # another recording with the same intro, cut a little differently
+    with WavSource(write_wav(tmp_path / 'second.wav', np.concatenate([jingle(2.0, 4), intro]))) as source:
+        dedupe = SegmentDedupe(FingerprintIndex(db), 'whisper:base')
+        assert dedupe.match(source, 0, [2.1, 5.0, 'A']) == 'Welcome to the show.'
+        assert dedupe.index.stats() == {'clips': 2, 'hits': 1}
+        dedupe.index.close()
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import wave
+
+incremental = pytest.importorskip('whatdisay.incremental')
+
+
+def test_reconcile_speakers():
+    old = [[0.0, 4.0, 'SPEAKER_00', ''], [4.0, 9.0, 'SPEAKER_01', ''], [9.0, 10.0, 'SPEAKER_00', '']]
+    # the tail was diarized on its own, so the same people came out with the labels swapped
+    new = [[6.0, 9.0, 'SPEAKER_00', ''], [9.0, 12.0, 'SPEAKER_01', ''], [12.0, 14.0, 'SPEAKER_02', '']]
+    mapping = incremental.reconcileSpeakers(old, new, 6.0, 10.0, ['SPEAKER_00', 'SPEAKER_01'])
+    assert mapping == {'SPEAKER_00': 'SPEAKER_01', 'SPEAKER_01': 'SPEAKER_00', 'SPEAKER_02': 'SPEAKER_02'}
+
+
+def test_reconcile_speakers_one_to_one():
+    old = [[0.0, 10.0, 'SPEAKER_00', '']]
+    new = [[5.0, 9.0, 'SPEAKER_00', ''], [9.0, 10.0, 'SPEAKER_01', '']]
+    # only the speaker with more shared talk time takes the earlier label; the other needs a free one
+    mapping = incremental.reconcileSpeakers(old, new, 5.0, 10.0, ['SPEAKER_00', 'SPEAKER_01'])
+    assert mapping == {'SPEAKER_00': 'SPEAKER_00', 'SPEAKER_01': 'SPEAKER_02'}
+
+    # talk outside the overlap doesn't count
+    mapping = incremental.reconcileSpeakers(old, [[10.0, 12.0, 'Speaker_3', '']], 5.0, 10.0, ['SPEAKER_00'])
+    assert mapping == {'Speaker_3': 'Speaker_3'}
+
+
+def test_prefix_hashes(tmp_path):
+    wav_file = tmp_path / 'growing.wav'
+    x = (np.arange(4000) % 500).astype(np.int16)
+
+    def write(frames):
+        with wave.open(str(wav_file), 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(16000)
+            w.writeframes(frames.tobytes())
+
+    write(x[:2000])
+    with incremental.WavSource(str(wav_file)) as source:
+        before = incremental.prefixHashes(source, [1000, 2000])
+    write(x)
+    with incremental.WavSource(str(wav_file)) as source:
+        after = incremental.prefixHashes(source, [2000, 1000, 4000], block_frames=300)
+
+    # the part that was already there hashes the same after the recording grew
+    assert after[:2] == before[::-1]
+    assert len(set(after)) == 3
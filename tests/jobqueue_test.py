@@ -0,0 +1,159 @@
+from whatdisay.jobqueue import JobQueue, LeaseLost, PENDING, LEASED, DONE, FAILED
+import sqlite3
+import threading
+import time
+import wave
+import pytest
+
+
+def test_claims_oldest_pending_job_once(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    first = queue.submit('b', 0, 'segments', {'n': 0})
+    queue.submit('b', 1, 'segments', {'n': 1})
+
+    job = queue.claim('w1')
+    assert job['id'] == first and job['status'] == LEASED and job['attempts'] == 1
+    assert job['payload'] == {'n': 0}
+    assert queue.claim('w2')['part'] == 1
+    assert queue.claim('w3') is None
+
+
+def test_queue_does_not_use_wal(tmp_path):
+    db = str(tmp_path / 'jobs.db')
+    # a queue created by an earlier version, in WAL mode
+    sqlite3.connect(db).execute('PRAGMA journal_mode=WAL').fetchone()
+    JobQueue(db)
+    assert sqlite3.connect(db).execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    job_id = queue.submit('b', 0, 'segments', {})
+
+    queue.claim('w1', lease_s=0.1)
+    assert queue.claim('w2', lease_s=0.1) is None
+    time.sleep(0.2)
+
+    job = queue.claim('w2')
+    assert job['id'] == job_id and job['worker'] == 'w2' and job['attempts'] == 2
+    # the first worker's lease is gone: it can't renew or complete the job any more
+    with pytest.raises(LeaseLost):
+        queue.heartbeat(job_id, 'w1')
+    with pytest.raises(LeaseLost):
+        queue.complete(job_id, 'w1', {'rows': []})
+
+    queue.complete(job_id, 'w2', {'rows': [[0, 1, 'A', 'hi']]})
+    assert queue.job(job_id)['status'] == DONE
+    assert queue.job(job_id)['result'] == {'rows': [[0, 1, 'A', 'hi']]}
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    job_id = queue.submit('b', 0, 'segments', {})
+    queue.claim('w1', lease_s=0.2)
+    for _ in range(3):
+        time.sleep(0.1)
+        queue.heartbeat(job_id, 'w1', lease_s=0.2)
+    assert queue.claim('w2') is None
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), max_attempts=2)
+    failing = queue.submit('b', 0, 'segments', {})
+    expiring = queue.submit('b', 1, 'segments', {})
+
+    for attempt in range(2):
+        job = queue.claim('w')
+        assert job['id'] == failing
+        queue.fail(failing, 'w', 'boom')
+    assert queue.job(failing)['status'] == FAILED and queue.job(failing)['error'] == 'boom'
+
+    for attempt in range(2):
+        assert queue.claim('w', lease_s=0.05)['id'] == expiring
+        time.sleep(0.1)
+    assert queue.claim('w') is None
+    assert queue.job(expiring)['status'] == FAILED
+    assert queue.counts('b') == {FAILED: 2}
+
+
+def test_concurrent_workers_claim_each_job_once(tmp_path):
+    db = str(tmp_path / 'jobs.db')
+    queue = JobQueue(db)
+    for part in range(40):
+        queue.submit('b', part, 'segments', {'part': part})
+
+    claimed = []
+    lock = threading.Lock()
+
+    def worker(name):
+        q = JobQueue(db)
+        while (job := q.claim(name)) is not None:
+            with lock:
+                claimed.append(job['part'])
+            q.complete(job['id'], name, {'rows': []})
+
+    threads = [threading.Thread(target=worker, args=(f'w{i}',)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(claimed) == list(range(40))
+    assert queue.counts('b') == {DONE: 40}
+
+
+def test_worker_loop(tmp_path, monkeypatch):
+    distributed = pytest.importorskip('whatdisay.distributed')
+    db = str(tmp_path / 'jobs.db')
+    queue = JobQueue(db)
+    ok = queue.submit('b', 0, distributed.SEGMENTS, {'text': 'hello'})
+    bad = queue.submit('b', 1, distributed.SEGMENTS, {'text': None})
+
+    def runJob(job, tp):
+        if job['payload']['text'] is None:
+            raise ValueError('no text')
+        return {'rows': [[0.0, 1.0, 'A', job['payload']['text']]]}
+
+    monkeypatch.setattr(distributed, 'runJob', runJob)
+    completed = distributed._runWorker(db, 'w', 5.0, 0.05, 0.3, None, str(tmp_path) + '/')
+
+    assert completed == 1
+    assert queue.job(ok)['result'] == {'rows': [[0.0, 1.0, 'A', 'hello']]}
+    # the failing job was retried until it ran out of attempts
+    assert queue.job(bad)['status'] == FAILED and queue.job(bad)['attempts'] == queue.max_attempts
+    with pytest.raises(RuntimeError):
+        distributed.waitForBatch(queue, 'b', poll_s=0.01)
+
+
+def test_wait_gives_up_without_workers(tmp_path):
+    distributed = pytest.importorskip('whatdisay.distributed')
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    queue.submit('b', 0, distributed.SEGMENTS, {})
+
+    with pytest.raises(RuntimeError, match='Every worker exited'):
+        distributed.waitForBatch(queue, 'b', poll_s=0.01, alive=lambda: False)
+    with pytest.raises(TimeoutError):
+        distributed.waitForBatch(queue, 'b', poll_s=0.01, timeout=0.05)
+    assert queue.counts('b') == {PENDING: 1}
+
+
+def test_recording_jobs_carry_the_run_settings(tmp_path):
+    distributed = pytest.importorskip('whatdisay.distributed')
+    wav_file = str(tmp_path / 'short.wav')
+    with wave.open(wav_file, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(bytes(3200))
+
+    class tp:
+        task_name = 'short_1683021600000'
+
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    distributed.submitRecording(
+        queue, wav_file, tp, 'pyannote', 'base', use_cache=False, failure_policy='continue', speakers={'num_speakers': 3}
+    )
+    job, = queue.jobs(tp.task_name)
+    assert job['kind'] == distributed.RECORDING
+    assert job['payload']['speakers'] == {'num_speakers': 3} and job['payload']['failure_policy'] == 'continue'
+    assert job['payload']['use_cache'] is False
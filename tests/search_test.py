@@ -0,0 +1,83 @@
+from whatdisay.search import TranscriptIndex, parseTranscript
+import os
+import pytest
+
+
+MARKDOWN = '''---
+tags:
+- planning
+- q3-budget
+---
+# Budget review
+
+Speaker_0: The forecast for next quarter looks fine.
+
+
+Transcript generated from audio file originally created at: 2023-05-02T10:00:00
+'''
+
+
+def write(path, text):
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def test_parse_markdown_transcript():
+    title, tags, created, lines = parseTranscript(MARKDOWN, markdown=True)
+    assert (title, tags, created) == ('Budget review', ['planning', 'q3-budget'], '2023-05-02T10:00:00')
+    assert lines == [(8, 'Speaker_0', None, None, 'The forecast for next quarter looks fine.')]
+
+
+def test_search(tmp_path):
+    archive = tmp_path / 'transcriptions'
+    archive.mkdir()
+    write(archive / 'standup_1683021600000.txt', 'Speaker_0: Shipping the release today.\nSpeaker_1: The budget is approved.\n')
+    write(archive / 'review_1683021600000.txt', 'Speaker_0: The forecast for next quarter looks fine.\n')
+    write(archive / 'review_1683021600000.md', MARKDOWN)
+
+    index = TranscriptIndex(str(tmp_path / 'index' / 'search.db'))
+    assert index.refresh(str(archive)) == {'files': 3, 'indexed': 3, 'removed': 0}
+
+    hits = index.search('budget')
+    assert [(h['task'], h['speaker'], h['line']) for h in hits] == [('standup_1683021600000', 'Speaker_1', 2)]
+    # the .md only adds its tags to the task, its lines come from the .txt
+    hits = index.search('next quarter', tags=['q3 budget'])
+    assert [(h['task'], h['tags']) for h in hits] == [('review_1683021600000', ['planning', 'q3-budget'])]
+    assert len(index.search(speaker='speaker_0')) == 2
+    assert index.search(since='2023-05-03') == []
+    assert len(index.search('(shipping OR forecast*)')) == 2
+    assert len(index.search('(shipping OR forecast*)', limit=1)) == 1
+    with pytest.raises(ValueError):
+        index.search(since='May 2nd')
+
+
+def test_refresh_only_rereads_changes(tmp_path):
+    archive = tmp_path / 'transcriptions'
+    archive.mkdir()
+    a = write(archive / 'a.txt', 'Speaker_0: first meeting\n')
+    b = write(archive / 'b.txt', 'Speaker_0: second meeting\n')
+    index = TranscriptIndex(str(tmp_path / 'search.db'))
+    index.refresh(str(archive))
+
+    write(archive / 'a.txt', 'Speaker_0: first meeting, edited\n')
+    os.remove(b)
+    assert index.refresh(str(archive)) == {'files': 1, 'indexed': 1, 'removed': 1}
+    assert [h['text'] for h in index.search('meeting')] == ['first meeting, edited']
+    assert index.refresh(str(archive)) == {'files': 1, 'indexed': 0, 'removed': 0}
+
+
+def test_rows_appended_as_they_are_written(tmp_path):
+    path = tmp_path / 'live.txt'
+    index = TranscriptIndex(str(tmp_path / 'search.db'))
+
+    write(path, 'Speaker_0: hello there\n')
+    index.update(str(path), [[0.0, 1.5, 'Speaker_0', 'hello there']])
+    offset = os.path.getsize(path)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('Speaker_1: general kenobi\n')
+    assert index.append(str(path), [[1.5, 3.0, 'Speaker_1', 'general kenobi']], offset) == 1
+
+    hit, = index.search('kenobi')
+    assert (hit['line'], hit['start'], hit['end']) == (2, 1.5, 3.0)
+    # an offset the index doesn't know about re-reads the whole file
+    assert index.append(str(path), [], offset) == 2
@@ -0,0 +1,105 @@
+import os
+from whatdisay.stages import Stage, StageGraph, PARTIAL
+import pytest
+
+
+def counting_graph(cache_dir, calls, scale=2, partial=False):
+    def double(numbers, scale):
+        calls.append('double')
+        return {'doubled': [n * scale for n in numbers]}
+
+    def total(doubled):
+        calls.append('total')
+        return {'total': sum(doubled), PARTIAL: partial}
+
+    def label(name):
+        calls.append('label')
+        return {'label': name.upper()}
+
+    return StageGraph([
+        Stage('double', double, inputs={'numbers': list}, outputs={'doubled': list}, params={'scale': scale}),
+        Stage('total', total, inputs={'doubled': list}, outputs={'total': int}),
+        Stage('label', label, inputs={'name': str}, outputs={'label': str}),
+    ], cache_dir=str(cache_dir))
+
+
+def test_results_are_memoized(tmp_path):
+    calls = []
+    values = counting_graph(tmp_path, calls).run({'numbers': [1, 2, 3], 'name': 'a'})
+    assert values['total'] == 12 and values['label'] == 'A'
+    assert sorted(calls) == ['double', 'label', 'total']
+
+    calls.clear()
+    again = counting_graph(tmp_path, calls)
+    assert again.run({'numbers': [1, 2, 3], 'name': 'a'})['total'] == 12
+    assert calls == []
+    assert all(t['cached'] for t in again.timings.values())
+
+    # use_cache=False re-runs everything
+    counting_graph(tmp_path, calls).run({'numbers': [1, 2, 3], 'name': 'a'}, use_cache=False)
+    assert sorted(calls) == ['double', 'label', 'total']
+
+
+def test_changes_only_rerun_downstream_stages(tmp_path):
+    calls = []
+    counting_graph(tmp_path, calls).run({'numbers': [1, 2, 3], 'name': 'a'})
+
+    calls.clear()
+    counting_graph(tmp_path, calls).run({'numbers': [1, 2, 3], 'name': 'b'})
+    assert calls == ['label']
+
+    calls.clear()
+    values = counting_graph(tmp_path, calls, scale=3).run({'numbers': [1, 2, 3], 'name': 'b'})
+    assert values['total'] == 18 and calls == ['double', 'total']
+
+    # a source fingerprint stands in for hashing the value, e.g. a recording's content hash
+    calls.clear()
+    counting_graph(tmp_path, calls, scale=3).run({'numbers': [1, 2, 3], 'name': 'b'}, source_fingerprints={'numbers': 'other'})
+    assert calls == ['double', 'total']
+
+
+def test_partial_results_are_not_memoized(tmp_path):
+    calls = []
+    counting_graph(tmp_path, calls, partial=True).run({'numbers': [1], 'name': 'a'})
+    calls.clear()
+    counting_graph(tmp_path, calls, partial=True).run({'numbers': [1], 'name': 'a'})
+    assert calls == ['total']
+
+
+def test_runs_only_what_outputs_need(tmp_path):
+    calls = []
+    values = counting_graph(tmp_path, calls).run({'name': 'a'}, outputs=['label'])
+    assert values['label'] == 'A' and calls == ['label']
+
+    with pytest.raises(ValueError, match='Missing stage graph sources'):
+        counting_graph(tmp_path, calls).run({'name': 'a'}, outputs=['total'])
+
+
+def test_rejects_bad_graphs():
+    def noop(**kwargs):
+        return {}
+
+    with pytest.raises(ValueError, match='cycle'):
+        StageGraph([Stage('a', noop, inputs={'y': None}, outputs={'x': None}), Stage('b', noop, inputs={'x': None}, outputs={'y': None})])
+    with pytest.raises(ValueError, match='produced by both'):
+        StageGraph([Stage('a', noop, outputs={'x': None}), Stage('b', noop, outputs={'x': None})])
+
+    graph = StageGraph([Stage('a', lambda: {'x': 'text'}, outputs={'x': int})])
+    with pytest.raises(TypeError):
+        graph.run({})
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    calls = []
+    counting_graph(tmp_path, calls).run({'numbers': [1, 2, 3], 'name': 'a'})
+    files = sorted(tmp_path.rglob('*.pkl'))
+    assert len(files) == 3
+    # age the results, then reuse only 'label', which refreshes it
+    for f in files:
+        os.utime(f, (1, 1))
+    one_file = max(f.stat().st_size for f in files)
+
+    graph = counting_graph(tmp_path, calls)
+    graph.max_cache_bytes = one_file
+    graph.run({'name': 'a'}, outputs=['label'])
+    assert [f.parent.name for f in tmp_path.rglob('*.pkl')] == ['label']
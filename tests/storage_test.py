@@ -0,0 +1,35 @@
+from whatdisay.storage import MemoryStorage
+import os
+
+
+def test_rewriting_a_spilled_intermediate():
+    storage = MemoryStorage()
+    with storage.open('channel_0.wav', 'wb') as f:
+        f.write(b'old')
+    spilled = storage.local_path('channel_0.wav')
+
+    with storage.open('channel_0.wav', 'wb') as f:
+        f.write(b'new')
+
+    assert not os.path.exists(spilled)
+    with storage.open('channel_0.wav', 'rb') as f:
+        assert f.read() == b'new'
+    with open(storage.local_path('channel_0.wav'), 'rb') as f:
+        assert f.read() == b'new'
+    storage.remove_all()
+
+
+def test_appending_to_a_spilled_intermediate():
+    storage = MemoryStorage()
+    with storage.open('log.txt', 'w') as f:
+        f.write('a')
+    # an external tool writes to the spilled copy
+    with open(storage.local_path('log.txt'), 'a') as f:
+        f.write('b')
+
+    with storage.open('log.txt', 'a') as f:
+        f.write('c')
+
+    with storage.open('log.txt', 'r') as f:
+        assert f.read() == 'abc'
+    storage.remove_all()
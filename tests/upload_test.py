@@ -0,0 +1,161 @@
+from whatdisay.upload import WavSource, PaddedWavReader, pcmToFloat, SegmentPayload, ByteBudget, SegmentFailures, uploadSegments, wavHeader
+import numpy as np
+import asyncio
+import io
+import os
+import struct
+import wave
+import pytest
+
+
+def write_wav(path, x, channels=1, frame_rate=16000):
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(frame_rate)
+        w.writeframes(x.astype(np.int16).tobytes())
+
+
+def test_padded_reader_stops_at_a_truncated_source(tmp_path):
+    wav_file = tmp_path / 'recording.wav'
+    write_wav(wav_file, np.arange(16000) % 1000)
+
+    with WavSource(str(wav_file)) as source:
+        # the file loses its tail after the header was read, e.g. a recording being rotated away
+        os.truncate(wav_file, 44 + 8000 * 2)
+        reader = PaddedWavReader(source, pad_ms=100)
+        data = io.BufferedReader(reader).read()
+
+    assert len(data) == 44 + 1600 * 2 + 8000 * 2
+    assert np.array_equal(np.frombuffer(data[-16000:], dtype=np.int16), np.arange(8000) % 1000)
+
+
+def test_wav_source_header(tmp_path):
+    wav_file = tmp_path / 'stereo.wav'
+    x = np.arange(2 * 8000)
+    write_wav(wav_file, x, channels=2, frame_rate=8000)
+
+    with WavSource(str(wav_file)) as source:
+        assert (source.channels, source.sample_width, source.frame_rate, source.nframes) == (2, 2, 8000, 8000)
+        assert source.duration == 1.0
+        assert source.frame_at(0.5) == 4000 and source.frame_at(-1) == 0 and source.frame_at(5) == 8000
+        assert np.array_equal(np.frombuffer(source.read_frames(10, 2), dtype=np.int16), x[20:24])
+
+
+def test_wav_source_of_a_file_still_being_written(tmp_path):
+    # a LIST chunk before the data, and a data size the recorder hasn't filled in yet
+    data = (np.arange(1600) % 100).astype(np.int16).tobytes()
+    header = bytearray(wavHeader(0, 1, 2, 16000))
+    list_chunk = b'LIST' + struct.pack('<I', 5) + b'INFO1' + b'\0'
+    header[4:8] = struct.pack('<I', 0xFFFFFFFF)
+    header[40:44] = struct.pack('<I', 0xFFFFFFFF)
+    wav_file = tmp_path / 'growing.wav'
+    wav_file.write_bytes(bytes(header[:36]) + list_chunk + bytes(header[36:]) + data)
+
+    with WavSource(str(wav_file)) as source:
+        assert source.nframes == 1600
+        assert source.read_frames(0, 1600) == data
+
+    wav_file.write_bytes(b'RIFF\0\0\0\0WAVEjunk')
+    with pytest.raises(ValueError):
+        WavSource(str(wav_file))
+
+
+def test_segment_payload(tmp_path):
+    wav_file = tmp_path / 'recording.wav'
+    x = np.arange(16000) % 1000
+    write_wav(wav_file, x)
+
+    async def body(payload):
+        return b''.join([c async for c in payload.chunks()])
+
+    with WavSource(str(wav_file)) as source:
+        payload = SegmentPayload(source, 0.25, 0.5, spacer_ms=100, chunk_bytes=1000)
+        data = asyncio.run(body(payload))
+
+    assert len(data) == payload.size == 44 + (1600 + 4000) * 2
+    with wave.open(io.BytesIO(data)) as w:
+        assert (w.getnchannels(), w.getframerate(), w.getnframes()) == (1, 16000, 5600)
+        samples = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+    assert not samples[:1600].any()
+    assert np.array_equal(samples[1600:], x[4000:8000])
+
+
+def upload(wav_file, segments, send, budget_bytes=10 ** 9, **kwargs):
+    async def main():
+        budget = ByteBudget(budget_bytes)
+        with WavSource(str(wav_file)) as source:
+            results, failures = await uploadSegments(source, segments, send, budget, chunk_bytes=4096, **kwargs)
+        assert budget.in_flight == 0
+        return budget, results, failures
+
+    return asyncio.run(main())
+
+
+def test_upload_segments(tmp_path):
+    wav_file = tmp_path / 'recording.wav'
+    write_wav(wav_file, np.zeros(10 * 16000))
+    segments = [[s, s + 1.0, 'Speaker_0'] for s in range(10)]
+    arrived = []
+
+    async def send(i, segment, payload):
+        size = sum([len(c) async for c in payload.chunks()])
+        await asyncio.sleep(0.01)
+        return size
+
+    budget, results, failures = upload(
+        wav_file, segments, send, budget_bytes=3 * 32044, skip={4},
+        on_result=lambda i, segment, result, error: arrived.append(i)
+    )
+    assert results == [32044] * 4 + [None] + [32044] * 5 and failures == {}
+    assert sorted(arrived) == [0, 1, 2, 3, 5, 6, 7, 8, 9]
+    # never more than 3 segments' worth of audio in flight
+    assert budget.peak == 3 * 32044
+
+
+def test_upload_failure_policies(tmp_path):
+    wav_file = tmp_path / 'recording.wav'
+    write_wav(wav_file, np.zeros(10 * 16000))
+    segments = [[s, s + 1.0, 'Speaker_0'] for s in range(10)]
+
+    async def send(i, segment, payload):
+        if i == 2:
+            raise ValueError('bad segment')
+        await asyncio.sleep(0.05 if i > 2 else 0)
+        return i
+
+    _, results, failures = upload(wav_file, segments, send, policy='continue')
+    assert results == [0, 1, None, 3, 4, 5, 6, 7, 8, 9] and list(failures) == [2]
+
+    with pytest.raises(SegmentFailures) as e:
+        upload(wav_file, segments, send, max_concurrency=4)
+    assert list(e.value.failures) == [2] and 'bad segment' in str(e.value)
+    # the segments that were done are kept, the slow ones were cancelled
+    assert e.value.results[:2] == [0, 1] and e.value.results[3:] == [None] * 7
+
+
+def test_pcm_sample_widths():
+    expected = np.array([[0.0, 0.5], [-0.5, -1.0]], dtype=np.float32)
+    for width in (2, 3, 4):
+        ints = np.round(expected * 2 ** (8 * width - 1)).clip(-2 ** (8 * width - 1), 2 ** (8 * width - 1) - 1).astype('<i4')
+        data = ints.view(np.uint8).reshape(-1, 4)[:, :width].tobytes()
+        assert np.allclose(pcmToFloat(data, width, 2), expected, atol=1e-4), width
+    assert np.allclose(pcmToFloat(bytes([128, 192, 64, 0]), 1, 2), expected, atol=1e-2)
+    with pytest.raises(ValueError):
+        pcmToFloat(b'', 5, 1)
+
+
+def test_24_bit_wav(tmp_path):
+    wav_file = tmp_path / '24bit.wav'
+    x = (np.arange(-800, 800) * 5000).astype('<i4')
+    with wave.open(str(wav_file), 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(3)
+        w.setframerate(8000)
+        w.writeframes(x.view(np.uint8).reshape(-1, 4)[:, :3].tobytes())
+
+    with WavSource(str(wav_file)) as source:
+        assert (source.channels, source.sample_width, source.nframes) == (2, 3, 800)
+        samples = source.read_samples(100, 10)
+    assert samples.shape == (10, 2)
+    assert np.allclose(samples.ravel(), x[200:220] / 2 ** 23)
@@ -0,0 +1,54 @@
+from whatdisay.upload import WavSource
+from whatdisay.vad import frameEnergies, speechRegions, activeRegions, detectSpeech, overlap
+import numpy as np
+import wave
+import pytest
+
+
+def regions(r):
+    return [[round(start, 3), round(end, 3)] for start, end in r]
+
+
+def test_active_regions():
+    active = np.array([0, 1, 1, 1, 0, 1, 1, 0, 0, 0, 0, 1, 0], dtype=bool)
+    # gaps under 2 frames are bridged, regions under 2 frames dropped
+    assert regions(activeRegions(active, frame_ms=100, min_speech_s=0.2, min_silence_s=0.2)) == [[0.1, 0.7]]
+    assert regions(activeRegions(active, frame_ms=100, min_speech_s=0.0, min_silence_s=0.0)) == [[0.1, 0.4], [0.5, 0.7], [1.1, 1.2]]
+    # speech running to the end of the audio
+    assert regions(activeRegions(np.ones(5, dtype=bool), frame_ms=100, min_speech_s=0.0)) == [[0.0, 0.5]]
+    assert activeRegions(np.zeros(5, dtype=bool)) == []
+
+
+def test_speech_regions():
+    energies = np.full(100, -70.0)
+    energies[20:50] = -20.0
+    energies[52:60] = -20.0
+    energies[80:82] = -20.0
+    assert regions(speechRegions(energies, frame_ms=30)) == [[0.6, 1.8]]
+    assert speechRegions(energies, frame_ms=30, threshold_db=-10.0) == []
+    assert speechRegions(np.zeros(0)) == []
+
+
+def write_speech(path, sample_width):
+    rate = 16000
+    t = np.arange(4 * rate) / rate
+    x = 0.25 * np.sin(2 * np.pi * 200 * t) * ((t > 1.0) & (t < 2.5))
+    x = np.round((x + np.random.default_rng(0).normal(0, 1.5e-4, len(t))) * 2 ** (8 * sample_width - 1)).astype('<i4')
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(sample_width)
+        w.setframerate(rate)
+        # the low bytes of each little-endian sample
+        w.writeframes(x.view(np.uint8).reshape(-1, 4)[:, :sample_width].tobytes())
+    return str(path)
+
+
+@pytest.mark.parametrize('sample_width', [2, 3])
+def test_detect_speech(tmp_path, sample_width):
+    wav_file = write_speech(tmp_path / 'speech.wav', sample_width)
+
+    with WavSource(wav_file) as source:
+        assert len(frameEnergies(source, frame_ms=30)) == 4 * 16000 // 480
+    (start, end), = detectSpeech(wav_file)
+    assert abs(start - 1.0) < 0.05 and abs(end - 2.5) < 0.05
+    assert overlap(0.0, 1.5, [[start, end]]) == 1.5 - start
@@ -58,7 +58,8 @@ def truncateAudio(audio_file, t1: int, t2: int, file_names: TaskProps):
 
     newAudio = AudioSegment.from_wav(audio_file)
     a = newAudio[t1:t2]
-    trunc_filename = file_names.task_dir + file_names.event_name + '_trunc.wav'
+    file_names.createTaskDir(file_names.output_dir)
+    trunc_filename = file_names.output_dir + file_names.task_name + '_trunc.wav'
     a.export(trunc_filename, format="wav") 
 
     print('Saved truncated version of audio file at location: {}'.format(trunc_filename))
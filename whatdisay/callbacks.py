@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+from whatdisay.config import Config
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import aiohttp
+import asyncio
+import ipaddress
+import json
+import secrets
+import threading
+import time
+from urllib.parse import urlparse
+
+
+DEFAULT_API_URL = 'https://api.deepgram.com/v1'
+
+
+class CallbackTimeout(TimeoutError):
+    """
+    Raised when neither a callback nor a poll produced the result of a submitted request in time.
+    """
+
+    def __init__(self, request_id: str, timeout_s: float):
+        self.request_id = request_id
+        super().__init__(f'No result for Deepgram request {request_id} after {timeout_s:.0f}s.')
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        receiver = self.server.receiver
+        if self.path.rstrip('/') != receiver.path:
+            self._reply(404)
+            return
+        try:
+            receiver.deliver(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            self._reply(400)
+            return
+        self._reply(200)
+
+
+class CallbackReceiver:
+    """
+    Small embedded HTTP server that Deepgram posts the results of callback requests to.  Results are kept by
+    request id until a waiter picks them up, so a callback that arrives before anyone waits for it isn't lost.
+
+    The callback path has a random token in it, so results can only be posted by whoever the callback url was
+    given to.
+
+    Parameters
+    ----------
+    host, port: str, int
+        Where to listen.  Port 0 picks a free port.
+
+    public_url: str
+        Base url Deepgram reaches the receiver at, when that's not http://host:port (e.g. behind a tunnel or a
+        reverse proxy).
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, public_url=None):
+        self.path = '/callback/' + secrets.token_urlsafe(16)
+        self.server = ThreadingHTTPServer((host, int(port)), _CallbackHandler)
+        self.server.daemon_threads = True
+        self.server.receiver = self
+        self.public_url = public_url
+        self.results = {}
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def callback_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return (self.public_url or f'http://{host}:{port}').rstrip('/') + self.path
+
+    def deliver(self, response: dict):
+        request_id = response['metadata']['request_id']
+        with self.lock:
+            self.results[request_id] = response
+            waiters = self.waiters.pop(request_id, [])
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future, response)
+
+    def pop(self, request_id: str):
+        with self.lock:
+            return self.results.pop(request_id, None)
+
+    async def wait(self, request_id: str, timeout_s: float):
+        """The result for a request, once it's posted, or None after timeout_s seconds."""
+        future = asyncio.get_running_loop().create_future()
+        with self.lock:
+            if request_id in self.results:
+                return self.results.pop(request_id)
+            self.waiters.setdefault(request_id, []).append((asyncio.get_running_loop(), future))
+        try:
+            await asyncio.wait_for(future, timeout_s)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self.lock:
+                w = self.waiters.get(request_id, [])
+                self.waiters[request_id] = [x for x in w if x[1] is not future]
+                if not self.waiters[request_id]:
+                    del self.waiters[request_id]
+        return self.pop(request_id) or future.result()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def _queryParams(options: dict) -> dict:
+    return {k: str(v).lower() if isinstance(v, bool) else str(v) for k, v in options.items() if v is not None}
+
+
+class DeepgramJobs:
+    """
+    Submit-then-collect client for Deepgram's prerecorded API.  Each request is sent with Deepgram's 'callback'
+    option, so the connection is only held while the audio uploads; Deepgram answers with a request id right away
+    and later posts the result to the CallbackReceiver.  Any number of long recordings can be processing at once
+    without a socket open for each.
+
+    Deepgram's prerecorded API has no endpoint that returns the result of a callback request, so by default a
+    request whose callback never arrives fails with CallbackTimeout after timeout_s.  With a poll_url (e.g. the
+    local stub's '<api_url>/listen/{request_id}'), a request whose callback hasn't arrived poll_after_s seconds
+    after it was submitted is also polled for there every poll_interval_s.  A 202 means it's still processing;
+    a 404 means the request is unknown there, and is an error rather than something to wait out.
+
+    Parameters
+    ----------
+    receiver: CallbackReceiver
+        The running receiver to collect results from.
+
+    api_url, api_key: str
+        Where to send requests.  Default to DEEPGRAM_API_URL and DEEPGRAM_API_KEY from config.
+
+    poll_url: str
+        Template of the url to poll for a result at, with a {request_id} placeholder.  None disables polling.
+    """
+
+    def __init__(self, receiver: CallbackReceiver, api_url=None, api_key=None, timeout_s=3600.0, poll_after_s=60.0, poll_interval_s=10.0, poll_url=None):
+        c = Config()
+        self.receiver = receiver
+        self.api_url = (api_url or c.get_optional_param('DEEPGRAM_API_URL') or DEFAULT_API_URL).rstrip('/')
+        self.api_key = api_key or c.get_param('DEEPGRAM_API_KEY')
+        self.timeout_s = timeout_s
+        self.poll_after_s = poll_after_s
+        self.poll_interval_s = poll_interval_s
+        self.poll_url = poll_url
+        self.stats = {'submitted': 0, 'callbacks': 0, 'polled': 0, 'timed_out': 0}
+
+    def _headers(self, mimetype=None) -> dict:
+        h = {'Authorization': f'Token {self.api_key}'}
+        if mimetype:
+            h['Content-Type'] = mimetype
+        return h
+
+    async def submit(self, session: aiohttp.ClientSession, audio, options: dict, mimetype='audio/wav') -> str:
+        """
+        Upload audio (bytes, a file object or an async generator of chunks) and return the request id.
+        """
+        params = _queryParams(dict(options, callback=self.receiver.callback_url))
+        async with session.post(f'{self.api_url}/listen', params=params, data=audio, headers=self._headers(mimetype)) as resp:
+            resp.raise_for_status()
+            request_id = (await resp.json())['request_id']
+        self.stats['submitted'] += 1
+        return request_id
+
+    async def poll(self, session: aiohttp.ClientSession, request_id: str):
+        """The result of a request from poll_url if it's ready, else None.  Raises for a request it doesn't know."""
+        async with session.get(self.poll_url.format(request_id=request_id), headers=self._headers()) as resp:
+            if resp.status == 202:
+                return None
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def collect(self, session: aiohttp.ClientSession, request_id: str) -> dict:
+        """
+        Wait for the result of a submitted request: from its callback, or by polling once poll_after_s has passed.
+        """
+        started = time.monotonic()
+        first_wait = self.poll_after_s if self.poll_url else self.timeout_s
+        result = await self.receiver.wait(request_id, min(first_wait, self.timeout_s))
+        while result is None:
+            elapsed = time.monotonic() - started
+            if elapsed >= self.timeout_s or not self.poll_url:
+                self.stats['timed_out'] += 1
+                raise CallbackTimeout(request_id, self.timeout_s)
+            try:
+                result = await self.poll(session, request_id)
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500:
+                    raise
+                print(f'Polling for Deepgram request {request_id} failed: {e!r}')
+            except aiohttp.ClientConnectionError as e:
+                print(f'Polling for Deepgram request {request_id} failed: {e!r}')
+            if result is not None:
+                # the callback may still turn up; don't keep it around
+                self.receiver.pop(request_id)
+                self.stats['polled'] += 1
+                return result
+            result = await self.receiver.wait(request_id, min(self.poll_interval_s, self.timeout_s - elapsed))
+
+        self.stats['callbacks'] += 1
+        return result
+
+    async def transcribe(self, audio, options: dict, mimetype='audio/wav', session: aiohttp.ClientSession = None, on_submitted=None) -> dict:
+        """
+        Submit audio and wait for its result.  on_submitted is awaited once the audio is uploaded, before waiting,
+        e.g. to free what was reserved for the upload.
+        """
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.transcribe(audio, options, mimetype, session, on_submitted)
+        request_id = await self.submit(session, audio, options, mimetype)
+        if on_submitted is not None:
+            await on_submitted()
+        return await self.collect(session, request_id)
+
+
+_RECEIVER = None
+_RECEIVER_LOCK = threading.Lock()
+
+
+def callbacksEnabled() -> bool:
+    return str(Config().get_optional_param('DEEPGRAM_CALLBACKS', 'false')).lower() in ('true', '1', 'yes')
+
+
+def sharedReceiver() -> CallbackReceiver:
+    """
+    The process-wide receiver, started on first use on CALLBACK_HOST:CALLBACK_PORT (default 127.0.0.1 and a free
+    port) and reachable at CALLBACK_PUBLIC_URL when that's set.
+    """
+    global _RECEIVER
+    with _RECEIVER_LOCK:
+        if _RECEIVER is None:
+            c = Config()
+            _RECEIVER = CallbackReceiver(
+                c.get_optional_param('CALLBACK_HOST', '127.0.0.1'),
+                int(c.get_optional_param('CALLBACK_PORT', 0)),
+                c.get_optional_param('CALLBACK_PUBLIC_URL'),
+            ).start()
+            print(f'Receiving Deepgram callbacks at {_RECEIVER.callback_url.rsplit("/", 1)[0]}/...')
+        return _RECEIVER
+
+
+def _isLocal(host: str) -> bool:
+    # addresses nothing outside this host can send requests to
+    if host in ('localhost', ''):
+        return True
+    try:
+        ip = ipaddress.ip_address(host.strip('[]'))
+    except ValueError:
+        return False
+    return ip.is_loopback or ip.is_unspecified
+
+
+def deepgramJobs() -> DeepgramJobs:
+    """
+    A submit-then-collect client on the shared receiver, with the timeouts and DEEPGRAM_POLL_URL from config.
+
+    Raises ValueError when the receiver can't be reached from the API: when it's only reachable from this host
+    (the default 127.0.0.1, or 0.0.0.0 without a CALLBACK_PUBLIC_URL) and the API isn't on this host too.
+    """
+    c = Config()
+    jobs = DeepgramJobs(
+        sharedReceiver(),
+        timeout_s=float(c.get_optional_param('DEEPGRAM_CALLBACK_TIMEOUT_SECONDS', 3600)),
+        poll_after_s=float(c.get_optional_param('DEEPGRAM_POLL_AFTER_SECONDS', 60)),
+        poll_interval_s=float(c.get_optional_param('DEEPGRAM_POLL_INTERVAL_SECONDS', 10)),
+        poll_url=c.get_optional_param('DEEPGRAM_POLL_URL'),
+    )
+    if _isLocal(urlparse(jobs.receiver.callback_url).hostname or '') and not _isLocal(urlparse(jobs.api_url).hostname or ''):
+        raise ValueError(
+            f'DEEPGRAM_CALLBACKS is on, but Deepgram can\'t reach the callback receiver at {jobs.receiver.callback_url.rsplit("/", 1)[0]}/.  '
+            'Set CALLBACK_PUBLIC_URL to where it can be reached from the internet (e.g. a tunnel), or CALLBACK_HOST to a public address.'
+        )
+    return jobs
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps, TaskMetrics
+from whatdisay.config import Config
+from whatdisay.upload import WavSource, wavHeader
+from whatdisay.vad import channelEnergies, speechThreshold, activeRegions
+import whatdisay.transcribe as transcribe
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import numpy as np
+import queue
+
+
+# speaker label of each channel's turns; the same labels Deepgram diarization produces
+CHANNEL_LABEL = 'Speaker_{}'
+
+
+def channelOf(label: str):
+    """The channel a CHANNEL_LABEL speaker label was made for, or None."""
+    prefix = CHANNEL_LABEL.format('')
+    if isinstance(label, str) and label.startswith(prefix) and label[len(prefix):].isdigit():
+        return int(label[len(prefix):])
+    return None
+
+
+def channelLayout(source: WavSource, frame_ms=30, margin_db=15.0, dominance_db=6.0, energies=None) -> dict:
+    """
+    Whether a recording has one speaker per channel, judged by how the channels' loudness differs while someone
+    is talking: with a participant per channel, one channel is clearly louder than the others for most of the
+    speech (the others only pick up bleed), while a downmix copied to every channel, or a room recorded with a
+    stereo mic, has channels at about the same level.
+
+    Returns 'per_speaker', 'channels', 'separation' (the share of speech frames where the loudest channel is at
+    least dominance_db louder than the next one) and 'shares' (for each channel, the share of speech frames where
+    it's that dominant).  Every channel has to be dominant for at least 5% of the speech for the layout to count.
+    """
+    e = channelEnergies(source, frame_ms) if energies is None else energies
+    result = {'per_speaker': False, 'channels': source.channels, 'separation': 0.0, 'shares': []}
+    if source.channels < 2 or e.shape[1] == 0:
+        return result
+
+    active = np.stack([e[c] > speechThreshold(e[c], margin_db) for c in range(e.shape[0])]).any(axis=0)
+    if not active.any():
+        return result
+
+    ranked = np.sort(e[:, active], axis=0)
+    dominant = (ranked[-1] - ranked[-2]) >= dominance_db
+    loudest = np.argmax(e[:, active], axis=0)
+    shares = [float(np.mean(dominant & (loudest == c))) for c in range(e.shape[0])]
+
+    result.update({
+        'separation': round(float(np.mean(dominant)), 4),
+        'shares': [round(s, 4) for s in shares],
+    })
+    result['per_speaker'] = result['separation'] >= 0.6 and min(shares) >= 0.05
+    return result
+
+
+def channelTurns(source: WavSource, frame_ms=30, margin_db=15.0, bleed_db=10.0, min_speech_s=0.25, min_silence_s=0.5, energies=None) -> list:
+    """
+    Speaker turns of a recording with one speaker per channel, by energy-based speech detection on each channel.
+    A frame only counts as speech on a channel when it's within bleed_db of the loudest channel, so a speaker
+    picked up by the other participants' mics isn't attributed to them as well.
+
+    Returns [start, end, speaker, ''] turns sorted by start, with CHANNEL_LABEL speaker labels.
+    """
+    e = channelEnergies(source, frame_ms) if energies is None else energies
+    if e.shape[1] == 0:
+        return []
+    loudest = e.max(axis=0)
+
+    turns = []
+    for c in range(e.shape[0]):
+        active = (e[c] > speechThreshold(e[c], margin_db)) & (e[c] >= loudest - bleed_db)
+        for start, end in activeRegions(active, frame_ms, min_speech_s, min_silence_s):
+            turns.append([round(start, 3), round(end, 3), CHANNEL_LABEL.format(c), ''])
+    return sorted(turns, key=lambda t: (t[0], t[1]))
+
+
+def extractChannel(source: WavSource, channel: int, f, block_frames=1024 * 1024):
+    """Write one channel of a wav file as a mono wav to the binary file object f, block by block."""
+    f.write(wavHeader(source.nframes, 1, source.sample_width, source.frame_rate))
+    for pos in range(0, source.nframes, block_frames):
+        # the channel's bytes of each frame, whatever the sample width
+        x = np.frombuffer(source.read_frames(pos, min(block_frames, source.nframes - pos)), dtype=np.uint8)
+        f.write(np.ascontiguousarray(x.reshape(-1, source.channels, source.sample_width)[:, channel]).tobytes())
+
+
+def transcribeChannels(wav_file, segments, engine: str, whisper_model: str, tp: TaskProps, failure_policy=None, reuse=True) -> list:
+    """
+    Transcribe the segments of a speaker-per-channel recording from their own channel instead of the downmix.
+    Deepgram channels are all transcribed at once on one event loop.  A whisper model decodes one segment at a
+    time, so local channels only decode in parallel on separate copies of the model: WHISPER_MODEL_COPIES (default
+    1, each copy takes the model's full memory) channels are transcribed at a time, each on its own copy.
+
+    Segments whose speaker isn't a channel label are transcribed from the downmix.  Each channel's metrics are
+    recorded under 'channel_<N>' (or 'downmix') of each metrics section.  Returns [start, end, speaker, text] rows,
+    in no particular order.
+    """
+    groups = {}
+    for s in segments:
+        groups.setdefault(channelOf(s[2]), []).append(s)
+
+    files = {None: wav_file}
+    with WavSource(wav_file) as source:
+        for c in groups:
+            if c is None or c >= source.channels:
+                continue
+            name = tp.tmp_files + f'channel_{c}.wav'
+            with tp.storage.open(name, 'wb') as f:
+                extractChannel(source, c, f)
+            files[c] = tp.storage.local_path(name)
+    # channels the file doesn't have go with the downmix
+    merged = {}
+    for c, segs in groups.items():
+        merged.setdefault(c if c in files else None, []).extend(segs)
+    groups = merged
+
+    def key(c):
+        return f'channel_{c}' if c is not None else 'downmix'
+
+    if engine == 'whisper':
+        copies = max(min(int(Config().get_optional_param('WHISPER_MODEL_COPIES', 1)), len(groups)), 1)
+        print(f'Transcribing {len(groups)} channels, {copies} at a time.')
+        free = queue.Queue()
+        for copy in range(copies):
+            free.put(copy)
+
+        def run(c, segs):
+            # a pool thread per copy, so there's always one free
+            copy = free.get()
+            try:
+                return transcribe.transcribeSegmentsLocal(files[c], segs, whisper_model, tp, metrics_key=key(c), model_copy=copy)
+            finally:
+                free.put(copy)
+
+        with ThreadPoolExecutor(max_workers=copies) as pool:
+            futures = [pool.submit(run, c, segs) for c, segs in groups.items()]
+            parts = [f.result() for f in futures]
+    else:
+        print(f'Transcribing {len(groups)} channels in parallel.')
+        async def run_all():
+            return await asyncio.gather(*[
+                transcribe.transcribeSegmentsDeepgram(files[c], segs, tp, failure_policy, metrics_key=key(c), reuse=reuse)
+                for c, segs in groups.items()
+            ])
+        parts = asyncio.run(run_all())
+
+    TaskMetrics(tp).record('channels', {
+        'transcribed_channels': [c for c in groups if c is not None],
+        'segments_per_channel': {str(c): len(segs) for c, segs in groups.items()},
+    })
+    return [r for rows in parts for r in rows]
@@ -3,15 +3,23 @@
 from whatdisay.utils import TaskProps, MdFileUtil, millisec, check_file_is_valid, getTaskName
 from whatdisay.config import Config
 from whatdisay.diarize import Diarize
+from whatdisay.intermediates import TaskStore
+from whatdisay.storage import makeTaskStorage
 import whatdisay.transcribe as transcribe
+from whatdisay.pipeline import MODES, resolveMode, runDiarizedTranscript
+from whatdisay.distributed import distributeTranscript, runWorker
+from whatdisay.incremental import transcribeIncremental
+from whatdisay.search import indexTranscript, searchTranscripts
+from whatdisay.upload import SegmentFailures
+from whatdisay.governor import ResourceBudgetExceeded
+from whatdisay.profiler import profiling
 from whatdisay.audio import truncateAudio
 from datetime import datetime
-import asyncio
 import time
 import argparse
 import re
 import logging
-import shutil, os
+import os
 import sys
 
 def enableDebugMode():
@@ -51,10 +59,17 @@ def runTranscription(args, tp: TaskProps):
 
     tp.createAllTaskDirectories()
 
-    # If diarization model specified, enforce that it's either 'deepgram' or 'pyannote'.  
+    # If diarization model specified, enforce that it's one of the pipeline's modes, or 'auto'.
     if diarize:
-        if diarize not in ["pyannote","deepgram","whisper_local"]:
-            raise ValueError("Invalid value for --diarize argument.  Must be 'deepgram' or 'pyannote'.")
+        if diarize not in list(MODES) + ['auto']:
+            raise ValueError(f"Invalid value for --diarize argument.  Must be one of {list(MODES) + ['auto']}.")
+
+    if args.get('distribute') and not diarize:
+        raise ValueError("--distribute requires --diarize.")
+    if args.get('incremental') and not diarize:
+        raise ValueError("--incremental requires --diarize.")
+
+    output_file_txt = os.path.join(tp.diarized_transcriptions_dir, tp.task_name + ".txt")
 
     if get_transcript:
         wav_file = get_transcript
@@ -65,32 +80,53 @@ def runTranscription(args, tp: TaskProps):
                 tags = input("Input comma-separated list of tags to add to markdown for Obsidian: ")
 
             if diarize:
+                diarize = resolveMode(wav_file, diarize, tp)
                 print(f'Generating transcript using {diarize} for diarization...')
                 start_time = time.time()
-                if diarize == 'pyannote':
-                    transcribe.diarizedTranscriptPyannote(wav_file,tp)
-                elif diarize == 'whisper_local':
-                    whisper_model = Config().get_param('WHISPER_MODEL')
-                    asyncio.run(transcribe.diarizedTranscriptDeepgramWhisperLocal(wav_file, whisper_model, tp))
-                    run_time = time.time() - start_time
-                    print(f'whisper local run time: {run_time}')
-                else:
-                    asyncio.run(transcribe.diarizedTranscriptAllDeepgram(wav_file,tp))
-                    run_time = time.time() - start_time
-                    print(f'async deepgram run time: {run_time}')
+                whisper_model = Config().get_param('WHISPER_MODEL') if MODES[diarize][1] == 'whisper' else None
+                try:
+                    if args.get('incremental'):
+                        # appends to the transcript of the earlier runs over the same file
+                        output_file_txt = transcribeIncremental(
+                            wav_file, tp, diarize, whisper_model, use_cache=not args.get('no_cache'),
+                            failure_policy=args.get('on_segment_error'), speakers=getSpeakers(args)
+                        )
+                    elif args.get('distribute'):
+                        distributeTranscript(
+                            wav_file, tp, diarize, whisper_model, args.get('queue'), args.get('local_workers') or 0,
+                            use_cache=not args.get('no_cache'), profile=args.get('profile'),
+                            failure_policy=args.get('on_segment_error'), speakers=getSpeakers(args)
+                        )
+                    else:
+                        runDiarizedTranscript(
+                            wav_file, tp, diarize, whisper_model, use_cache=not args.get('no_cache'),
+                            failure_policy=args.get('on_segment_error'), speakers=getSpeakers(args)
+                        )
+                except SegmentFailures as e:
+                    print(f'Transcription stopped: {e}')
+                    print('The segments that completed were saved.  Run the same recording again to retry the rest.')
+                    sys.exit(1)
+                except ResourceBudgetExceeded as e:
+                    print(f'Transcription stopped: {e}')
+                    print('What the resource governor tried first:')
+                    for d in e.decisions:
+                        print(f"  {d['seconds']}s: {d['resource']} at {d['usage_of_budget']:.0%} of budget, {d['action']}: {d['detail']}")
+                    print('Raise MEMORY_BUDGET_MB, or transcribe the recording with a smaller whisper model.')
+                    sys.exit(1)
+                run_time = time.time() - start_time
+                print(f'{diarize} run time: {run_time}')
             else:
                 whisper_model = Config().get_param('WHISPER_MODEL')
-                transcribe.generateWhisperTranscript(wav_file,tp, whisper_model)
+                table = transcribe.generateWhisperTranscript(wav_file,tp, whisper_model)
                 
-                # Move the whisper transcription to the transcriptions directory before the tmp_dir gets deleted later
-                tmp_whisper = os.path.join(tp.whisper_transcriptions_dir, tp.task_name + "_whisper.txt")
+                # Export the whisper transcription to the transcriptions directory before the tmp_dir gets deleted later
                 final_whisper = os.path.join(tp.diarized_transcriptions_dir, tp.task_name + ".txt")
-                shutil.copy(tmp_whisper, final_whisper)
+                TaskStore(tp).export(table, 'txt', final_whisper)
                 print(f'Saved whisper transcription at: {final_whisper}')
+                indexTranscript(tp, final_whisper)
 
             if generate_md:
-                output_file_txt = os.path.join(tp.diarized_transcriptions_dir, tp.task_name + ".txt")
-                output_file_md = os.path.join(tp.diarized_transcriptions_dir, tp.task_name + ".md")
+                output_file_md = os.path.splitext(output_file_txt)[0] + ".md"
 
                 md_file = MdFileUtil(output_file_txt, tags, md_title, tp)
 
@@ -101,10 +137,62 @@ def runTranscription(args, tp: TaskProps):
                 af_ctime = datetime.fromtimestamp(os.path.getctime(wav_file)).strftime('%Y-%m-%dT%H:%M:%S')
                 md_file.append_line(f'\n\n\nTranscript generated from audio file originally created at: {af_ctime}')
                 print(f'Saved Markdown file at location: {output_file_md}')
+                indexTranscript(tp, output_file_md)
                     
-            # Now that the job is done, delete the tmp files unless debug mode is on, in which case we'll save them for troubleshoting.
+            # Now that the job is done, delete the tmp files unless debug mode is on, in which case we'll save them
+            # (plus human-readable exports of the intermediates) for troubleshoting.
             if not debug_mode:
                 tp.cleanupTask()
+            else:
+                TaskStore(tp).export_all()
+
+def getSpeakers(args) -> dict:
+    '''
+    Speaker count constraints for pyannote diarization.
+    '''
+    return {k: args.get(k) for k in ['num_speakers', 'min_speakers', 'max_speakers'] if args.get(k)}
+
+def runSearch(args):
+    '''
+    Search the transcripts in OUTPUT_DIR's diarized_transcriptions/ by phrase, speaker, date range and tags.
+    '''
+    tp = TaskProps('search', Config().get_optional_param('OUTPUT_DIR'))
+    searchTranscripts(
+        tp, args.get('search') or None, speaker=args.get('speaker'), since=args.get('since'), until=args.get('until'),
+        tags=args.get('tag') or [], limit=args.get('limit')
+    )
+
+def runQueueWorker(args):
+    '''
+    Run a worker for distributed mode against the shared job queue until it's interrupted.
+    '''
+    c = Config()
+    output_dir = c.get_optional_param('OUTPUT_DIR')
+    db_path = args.get('queue') or c.get_optional_param('WORK_QUEUE') or TaskProps('worker', output_dir).queue_db
+    runWorker(db_path, lease_s=float(c.get_optional_param('WORKER_LEASE_SECONDS', 60)), output_dir=output_dir, profile=args.get('profile'))
+
+def getTaskProps(task_name, args) -> TaskProps:
+    '''
+    Build the task's props: final outputs go to OUTPUT_DIR, intermediates to the configured task storage.
+    '''
+    c = Config()
+    tp = TaskProps(task_name, c.get_optional_param('OUTPUT_DIR'))
+
+    kind = args.get('task_storage') or c.get_optional_param('TASK_STORAGE', 'disk')
+    root = c.get_optional_param('TASK_STORAGE_DIR')
+
+    # 'auto' keeps short jobs in memory and puts long ones on disk (TASK_STORAGE_DIR if it points at a fast volume).
+    if kind == 'auto':
+        wav_file = args.get('transcript')
+        max_mb = float(c.get_optional_param('MEMORY_STORAGE_MAX_MB', 200))
+        small = wav_file and os.path.exists(wav_file) and os.path.getsize(wav_file) <= max_mb * 1024 * 1024
+        kind = 'memory' if small else 'disk'
+
+    if kind != 'disk' or root:
+        tp.storage = makeTaskStorage(kind, task_name, root if kind != 'tmpfs' else c.get_optional_param('TMPFS_DIR'))
+    logging.debug(f'Using {tp.storage.describe()} task storage.')
+
+    return tp
 
 def cli():
 
@@ -112,11 +200,29 @@ def cli():
     exclusive_group = parser.add_mutually_exclusive_group(required=False)
     exclusive_group.add_argument('--configure', action='store_true', help="Configure the CLI and create or update config yaml file.")
     exclusive_group.add_argument('--transcript', type=str, required=False, help="Generated diarized transcriptiion from an existing recording. Requires the path to the audio file you need a transcript of.")
+    exclusive_group.add_argument('--worker', action='store_true', help="Run as a worker for distributed mode, claiming jobs from the shared job queue.")
+    exclusive_group.add_argument('--search', nargs='?', const='', type=str, help="Search the transcript archive for a phrase. Combine with --speaker, --since, --until and --tag, which also work without a phrase.")
     exclusive_group.add_argument('--truncate_audio', nargs=3, required=False, help="Trim an audio file using timestamps provided.")
-    parser.add_argument('--diarize', nargs='?', const='deepgram', type=str, help="Diarize the transcript. Defaults to Deepgram for diarization model unless 'pyannote' is passed as a value.")
+    parser.add_argument('--diarize', nargs='?', const='deepgram', type=str, help="Diarize the transcript. Defaults to Deepgram for diarization model unless 'pyannote' is passed as a value. 'channels' (or 'channels_deepgram') takes each channel as one speaker instead of running a diarization model, and 'auto' does that for recordings it detects one speaker per channel in.")
     parser.add_argument('--event_name', type=str, required=False)
     parser.add_argument('--reset_pipeline', help="Re-pull pyannote's speaker diarization pipeline.")
     parser.add_argument('--debug', action="store_true", help="Enable debug mode.")
+    parser.add_argument('--profile', action="store_true", help="Profile the whole job with a sampling profiler and save a flamegraph-ready profile under OUTPUT_DIR/profiles/. Event loop stalls are reported as they happen.")
+    parser.add_argument('--no_cache', action="store_true", help="Re-run every pipeline stage instead of reusing memoized stage results.")
+    parser.add_argument('--num_speakers', type=int, required=False, help="Number of speakers, if known, for pyannote diarization. Re-running a recording with a different value only re-clusters its cached speaker embeddings.")
+    parser.add_argument('--min_speakers', type=int, required=False, help="Lower bound on the number of speakers for pyannote diarization.")
+    parser.add_argument('--max_speakers', type=int, required=False, help="Upper bound on the number of speakers for pyannote diarization.")
+    parser.add_argument('--on_segment_error', choices=['fail_fast', 'continue'], required=False, help="When a segment fails to transcribe through Deepgram, stop right away ('fail_fast') or finish the rest and mark it in the transcript ('continue'). Defaults to DEEPGRAM_FAILURE_POLICY from the config, or 'fail_fast'.")
+    parser.add_argument('--distribute', action="store_true", help="Queue the transcript as jobs for workers (see --worker) and assemble their results. Requires --diarize.")
+    parser.add_argument('--incremental', action="store_true", help="Only transcribe the audio added to the file since the last --incremental run over it, and append it to that run's transcript. Requires --diarize.")
+    parser.add_argument('--local_workers', type=int, required=False, help="With --distribute, also start this many worker processes on this host.")
+    parser.add_argument('--queue', type=str, required=False, help="Path of the shared job queue database. Defaults to WORK_QUEUE from the config, or OUTPUT_DIR/queue/jobs.db.")
+    parser.add_argument('--task_storage', choices=['disk', 'tmpfs', 'memory', 'auto'], required=False, help="Where to keep a task's intermediate files. Defaults to TASK_STORAGE from the config, or 'disk'.")
+    parser.add_argument('--speaker', type=str, required=False, help="With --search, only lines by this speaker.")
+    parser.add_argument('--since', type=str, required=False, help="With --search, only transcripts from this date on (YYYY-MM-DD).")
+    parser.add_argument('--until', type=str, required=False, help="With --search, only transcripts up to this date (YYYY-MM-DD).")
+    parser.add_argument('--tag', action='append', required=False, help="With --search, only transcripts with this markdown tag. Can be repeated.")
+    parser.add_argument('--limit', type=int, default=50, help="With --search, the maximum number of lines to show.")
     parser.add_argument('-md', '--generate_markdown',action="store_true", help="Generate a markdown version of the final transcript and add tags for Obsidian.")
     args = parser.parse_args().__dict__
 
@@ -129,13 +235,22 @@ def cli():
     else:
         Config().get_config()
 
+    if args.get('worker'):
+        runQueueWorker(args)
+        return
+
+    if args.get('search') is not None:
+        runSearch(args)
+        return
+
     task_name: str = getTaskName(args)
-    tp = TaskProps(task_name)
+    tp = getTaskProps(task_name, args)
 
     if args.get('reset_pipeline'):
         resetPyannotePipe(tp)
     elif args.get('transcript'):
-        runTranscription(args, tp)
+        with profiling(tp, args.get('profile')):
+            runTranscription(args, tp)
     elif args.get('truncate_audio'):
         runTruncateAudio(args, tp)
     else:
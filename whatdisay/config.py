@@ -5,6 +5,10 @@ import os
 import yaml
 
 
+# Environment variables named ENV_PREFIX + key override the config file, e.g. WHATDISAY_DEEPGRAM_API_URL.
+ENV_PREFIX = 'WHATDISAY_'
+
+
 class Config:
 
     def __init__(self):
@@ -41,6 +45,9 @@ class Config:
 
     def get_param(self,p) -> str:
 
+        if os.environ.get(ENV_PREFIX + p):
+            return os.environ[ENV_PREFIX + p]
+
         config = self.get_config()
 
         try:
@@ -51,3 +58,19 @@ class Config:
         except AttributeError:
             print(f"No config value set for {p}.  Run '--configure' to configure.")
             sys.exit(1)
+
+    def get_optional_param(self, p, default=None):
+        """
+        Like get_param, but for settings that have a sensible default and aren't prompted for by '--configure'.
+        Without a config file, the default is used.
+        """
+        if os.environ.get(ENV_PREFIX + p):
+            return os.environ[ENV_PREFIX + p]
+        if not os.path.exists(self.config_path):
+            return default
+
+        config = self.get_config() or {}
+
+        if p in config.keys() and config[p] is not None and config[p] != '':
+            return config[p]
+        return default
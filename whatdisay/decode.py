@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+import gc
+import numpy as np
+import threading
+import time
+import weakref
+import whisper
+import zlib
+
+
+# Whisper models stay loaded for the life of the process so repeated sessions don't reload them from disk.
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+# whisper decodes through kv-cache hooks installed on the model itself, so a model decodes one segment at a time
+_DECODE_LOCKS = {}
+# live sessions, so evicting a model can drop their references to it too
+_SESSIONS = weakref.WeakSet()
+
+TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+WHISPER_SAMPLE_RATE = whisper.audio.SAMPLE_RATE
+
+
+def modelKey(name: str, copy=0) -> str:
+    """Cache key of one copy of a whisper model.  Only parallel decoding needs more than the first."""
+    return name if not copy else f'{name}#{copy}'
+
+
+def loadWhisperModel(name: str, copy=0):
+    # threads share a copy unless they're given their own, a copy decodes one segment at a time either way
+    key = modelKey(name, copy)
+    with _MODELS_LOCK:
+        if key not in _MODELS:
+            print(f'Loading whisper model: {name}' + (f' (copy {copy + 1})' if copy else ''))
+            _MODELS[key] = whisper.load_model(name)
+        return _MODELS[key]
+
+
+def decodeLock(key: str) -> threading.Lock:
+    """The lock every decode with the cached model of that key (see modelKey) has to hold."""
+    with _MODELS_LOCK:
+        return _DECODE_LOCKS.setdefault(key, threading.Lock())
+
+
+def evictWhisperModels() -> list:
+    """
+    Drop the cached whisper models that aren't decoding right now, along with the references the live sessions
+    hold to them; the sessions load them again the next time they decode.  A model something else still holds on
+    to is put back, since dropping it would only free the cache entry and the next load would make a second copy.
+
+    Returns the names of the models that were freed.
+    """
+    with _MODELS_LOCK:
+        locks = {name: _DECODE_LOCKS.setdefault(name, threading.Lock()) for name in _MODELS}
+
+    dropped = {}
+    for name, lock in locks.items():
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            with _MODELS_LOCK:
+                model = _MODELS.pop(name, None)
+            if model is None:
+                continue
+            for s in list(_SESSIONS):
+                if s._model is model:
+                    s._model = None
+            dropped[name] = weakref.ref(model)
+            del model
+        finally:
+            lock.release()
+
+    gc.collect()
+    freed = []
+    for name, ref in dropped.items():
+        model = ref()
+        if model is None:
+            freed.append(name)
+            continue
+        with _MODELS_LOCK:
+            _MODELS.setdefault(name, model)
+        print(f'Whisper model {name} is still referenced, keeping it loaded.')
+    return freed
+
+
+def audioSegmentToWhisper(segment) -> np.ndarray:
+    """
+    Convert a pydub AudioSegment into the 16kHz mono float32 array whisper decodes, so segments don't
+    have to be exported to wav and re-read through ffmpeg.
+    """
+    s = segment.set_frame_rate(WHISPER_SAMPLE_RATE).set_channels(1).set_sample_width(2)
+    return np.array(s.get_array_of_samples(), dtype=np.float32) / 32768.0
+
+
+class DecodeSession:
+    """
+    Decoding state shared by every segment of one recording.
+
+    The language is detected once on a representative sample and pinned for all segments, each speaker's
+    most recent text is carried over as the prompt for their next segment, and temperature fallbacks are
+    capped.  Counters for decode passes and fallbacks (per 30 second window) are available from stats().
+
+    Parameters
+    ----------
+    model: str
+        The whisper model instance (tiny, base, small, medium, large).
+
+    max_fallbacks: int
+        How many times each 30 second window of a segment may be re-decoded at a higher temperature after failing
+        the quality thresholds.
+
+    prompt_chars: int
+        How much of a speaker's previous text is carried over as the prompt for their next segment.  0 disables it.
+
+    language: str
+        Optionally pin the language up front and skip detection.
+
+    copy: int
+        Which copy of the model to decode with.  Sessions on different copies decode in parallel.
+    """
+
+    def __init__(
+        self,
+        model="large",
+        max_fallbacks=2,
+        prompt_chars=200,
+        language=None,
+        compression_ratio_threshold=2.4,
+        logprob_threshold=-1.0,
+        no_speech_threshold=0.6,
+        copy=0
+        ):
+        self.model_name = model
+        self.model_key = modelKey(model, copy)
+        self.copy = copy
+        self._model = None
+        _SESSIONS.add(self)
+        self.temperatures = TEMPERATURES[:max(int(max_fallbacks), 0) + 1]
+        self.prompt_chars = prompt_chars
+        self.language = language
+        self.language_probability = None
+        self.compression_ratio_threshold = compression_ratio_threshold
+        self.logprob_threshold = logprob_threshold
+        self.no_speech_threshold = no_speech_threshold
+        self.prompts = {}
+
+        self.segments = 0
+        self.decode_passes = 0
+        self.fallbacks = 0
+        self.exhausted = 0
+        self.detect_passes = 0
+        self.decode_seconds = 0.0
+        self.audio_seconds = 0.0
+
+    @property
+    def model(self):
+        # loaded on first use, so a session that never decodes (e.g. a cascade's large pass) costs nothing
+        if self._model is None:
+            self._model = loadWhisperModel(self.model_name, self.copy)
+        return self._model
+
+    def detect_language(self, audio) -> str:
+        """
+        Detect the language from a representative sample (e.g. the longest diarized segment) and pin it for
+        the rest of the session.  Only the first 30 seconds of the sample are used.
+        """
+        if not self.model.is_multilingual:
+            # English-only checkpoints (base.en, ...) have no language tokens to detect with
+            self.language = 'en'
+            return self.language
+        if isinstance(audio, str):
+            audio = whisper.load_audio(audio)
+
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), **self._mel_kwargs()).to(self.model.device)
+        with decodeLock(self.model_key):
+            _, probs = self.model.detect_language(mel)
+        self.detect_passes += 1
+        self.language = max(probs, key=probs.get)
+        self.language_probability = float(probs[self.language])
+        print(f'Detected language {self.language} (p={self.language_probability:.2f}) for this recording.')
+        return self.language
+
+    def _mel_kwargs(self) -> dict:
+        # large-v3 uses 128 mel bins; older checkpoints don't expose n_mels at all.
+        n_mels = getattr(self.model.dims, 'n_mels', None)
+        return {'n_mels': n_mels} if n_mels else {}
+
+    def needs_fallback(self, result) -> bool:
+        for seg in result["segments"]:
+            if seg['no_speech_prob'] > self.no_speech_threshold and seg['avg_logprob'] < self.logprob_threshold:
+                # whisper treats this as silence, re-decoding won't help
+                continue
+            if seg['compression_ratio'] > self.compression_ratio_threshold or seg['avg_logprob'] < self.logprob_threshold:
+                return True
+        return False
+
+    def count_passes(self, result):
+        """Count the decode passes and fallbacks of a result from the temperature each window ended up at."""
+        windows = {}
+        for seg in result["segments"]:
+            windows.setdefault(seg.get('seek', 0), []).append(seg)
+        if not windows:
+            self.decode_passes += 1
+        for segs in windows.values():
+            n = min(range(len(self.temperatures)), key=lambda i: abs(self.temperatures[i] - segs[0].get('temperature', 0.0)))
+            self.decode_passes += n + 1
+            self.fallbacks += n
+            if n + 1 == len(self.temperatures) and n > 0 and self.needs_fallback({'segments': segs}):
+                self.exhausted += 1
+
+    def transcribe(self, audio, speaker=None, remember=True) -> dict:
+        """
+        Decode one segment.  Accepts a file path or a 16kHz float32 array.  Returns whisper's result dict.
+        With remember unset, the result isn't carried over into the speaker's prompt.
+        """
+        if isinstance(audio, str):
+            audio = whisper.load_audio(audio)
+        if self.language is None:
+            self.detect_language(audio)
+
+        prompt = self.prompts.get(speaker) if self.prompt_chars else None
+
+        started = time.time()
+        # whisper falls back to the next temperature per 30s window, so only the windows that failed are re-decoded
+        with decodeLock(self.model_key):
+            result = self.model.transcribe(
+                audio,
+                language=self.language,
+                temperature=self.temperatures,
+                initial_prompt=prompt,
+                compression_ratio_threshold=self.compression_ratio_threshold,
+                logprob_threshold=self.logprob_threshold,
+                no_speech_threshold=self.no_speech_threshold
+            )
+        self.count_passes(result)
+        self.decode_seconds += time.time() - started
+        self.audio_seconds += len(audio) / WHISPER_SAMPLE_RATE
+        self.segments += 1
+
+        if remember:
+            self.remember(speaker, result["text"])
+
+        return result
+
+    def remember(self, speaker, text):
+        text = text.strip()
+        if self.prompt_chars and text:
+            self.prompts[speaker] = ((self.prompts.get(speaker) or '') + ' ' + text)[-self.prompt_chars:].strip()
+
+    def stats(self) -> dict:
+        return {
+            'model': self.model_name,
+            'language': self.language,
+            'language_probability': self.language_probability,
+            'segments': self.segments,
+            'detect_passes': self.detect_passes,
+            'decode_passes': self.decode_passes,
+            'fallbacks': self.fallbacks,
+            'fallbacks_exhausted': self.exhausted,
+            'decode_seconds': round(self.decode_seconds, 3),
+            'audio_seconds': round(self.audio_seconds, 3),
+        }
+
+
+
+# Approximate decode speed of each whisper model relative to 'large' (from the whisper README), used to estimate
+# what decoding every segment with the large model would have cost.
+RELATIVE_SPEED = {'tiny': 32, 'base': 16, 'small': 6, 'medium': 2, 'large': 1}
+
+
+def quality(result) -> dict:
+    """
+    The quality signals of a whisper result: the duration-weighted avg log-prob, the compression ratio of the
+    whole text and the highest no-speech probability.
+    """
+    segs = result["segments"]
+    if not segs:
+        return {'avg_logprob': 0.0, 'compression_ratio': 0.0, 'no_speech_prob': 1.0}
+
+    weights = [max(s['end'] - s['start'], 1e-3) for s in segs]
+    text = result["text"].strip().encode('utf-8')
+    return {
+        'avg_logprob': float(np.average([s['avg_logprob'] for s in segs], weights=weights)),
+        'compression_ratio': len(text) / len(zlib.compress(text)) if text else 0.0,
+        'no_speech_prob': float(max(s['no_speech_prob'] for s in segs)),
+    }
+
+
+class CascadeDecoder:
+    """
+    Decode every segment with a small, fast model first and only re-decode the segments whose result fails the
+    quality thresholds with the large model.  Has the same interface as DecodeSession.
+
+    Parameters
+    ----------
+    small: DecodeSession
+        Session for the fast first-pass model.
+
+    large: DecodeSession
+        Session for the model segments are escalated to.  Its model is only loaded once a segment escalates.
+
+    min_avg_logprob: float
+        Escalate when the first pass' avg log-prob is below this.
+
+    max_compression_ratio: float
+        Escalate when the first pass' text compresses better than this (a sign of repetition loops).
+
+    max_no_speech_prob: float
+        Escalate when the first pass thinks the segment is likely silence, since diarized segments rarely are.
+    """
+
+    def __init__(self, small: DecodeSession, large: DecodeSession, min_avg_logprob=-0.8, max_compression_ratio=2.2, max_no_speech_prob=0.5):
+        self.small = small
+        self.large = large
+        self.min_avg_logprob = min_avg_logprob
+        self.max_compression_ratio = max_compression_ratio
+        self.max_no_speech_prob = max_no_speech_prob
+        # both passes carry over the same per-speaker prompt context
+        self.large.prompts = self.small.prompts
+
+        self.segments = 0
+        self.escalations = 0
+        self.small_seconds = 0.0
+        self.large_seconds = 0.0
+        self.audio_seconds = 0.0
+        self.escalated_audio_seconds = 0.0
+
+    @property
+    def language(self):
+        return self.small.language
+
+    def detect_language(self, audio) -> str:
+        # detect once and pin it for both passes; with the small model, so the large one isn't loaded for it
+        language = self.small.detect_language(audio)
+        self.large.language = language
+        return language
+
+    def should_escalate(self, result) -> bool:
+        q = quality(result)
+        return (
+            q['avg_logprob'] < self.min_avg_logprob
+            or q['compression_ratio'] > self.max_compression_ratio
+            or q['no_speech_prob'] > self.max_no_speech_prob
+        )
+
+    def transcribe(self, audio, speaker=None) -> dict:
+        if isinstance(audio, str):
+            audio = whisper.load_audio(audio)
+        if self.language is None:
+            self.detect_language(audio)
+        seconds = len(audio) / WHISPER_SAMPLE_RATE
+
+        started = time.time()
+        result = self.small.transcribe(audio, speaker, remember=False)
+        self.small_seconds += time.time() - started
+
+        if self.should_escalate(result):
+            started = time.time()
+            result = self.large.transcribe(audio, speaker, remember=False)
+            self.large_seconds += time.time() - started
+            self.escalations += 1
+            self.escalated_audio_seconds += seconds
+
+        self.small.remember(speaker, result["text"])
+        self.segments += 1
+        self.audio_seconds += seconds
+        return result
+
+    def estimated_large_seconds(self):
+        """
+        What decoding every segment with the large model would have taken, extrapolated from the measured
+        speed of the large model on escalated segments, or from the models' relative speeds if nothing escalated.
+        """
+        if self.escalated_audio_seconds > 0:
+            return self.large_seconds / self.escalated_audio_seconds * self.audio_seconds
+        small_speed = RELATIVE_SPEED.get(self.small.model_name.split('.')[0].split('-')[0])
+        large_speed = RELATIVE_SPEED.get(self.large.model_name.split('.')[0].split('-')[0])
+        if not small_speed or not large_speed:
+            return None
+        return self.small_seconds * small_speed / large_speed
+
+    def stats(self) -> dict:
+        estimate = self.estimated_large_seconds()
+        actual = self.small_seconds + self.large_seconds
+        return {
+            'cascade': {
+                'segments': self.segments,
+                'escalations': self.escalations,
+                'escalation_rate': round(self.escalations / self.segments, 3) if self.segments else 0.0,
+                'small_decode_seconds': round(self.small_seconds, 3),
+                'large_decode_seconds': round(self.large_seconds, 3),
+                'estimated_all_large_seconds': round(estimate, 3) if estimate is not None else None,
+                'estimated_seconds_saved': round(estimate - actual, 3) if estimate is not None else None,
+            },
+            'small': self.small.stats(),
+            'large': self.large.stats(),
+        }
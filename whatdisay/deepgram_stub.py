@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+
+from whatdisay.vad import speechRegions
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import urllib.request
+import numpy as np
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+import uuid
+
+
+WORDS = (
+    'so we should probably look at the numbers again before the next meeting because last time the '
+    'estimate was off by quite a bit and nobody really knew where that came from I think it was the '
+    'migration but we never checked the logs properly let me share my screen and walk through it'
+).split()
+
+
+class StubSettings:
+    """
+    How the stub behaves.
+
+    Parameters
+    ----------
+    latency: str
+        Response latency distribution as 'kind:ms[:spread]', where kind is 'fixed', 'uniform' (ms +/- spread ms),
+        'lognormal' (median ms, sigma spread) or 'pareto' (minimum ms, shape spread).
+
+    per_mb_ms: float
+        Extra latency per MB of uploaded audio.
+
+    error_429_rate, error_5xx_rate: float
+        Fraction of requests that randomly fail with a 429 or a 500/502/503.
+
+    rate_limit: float
+        Requests per second allowed (token bucket with a burst of one second's worth).  Requests over the limit
+        get a 429 with a Retry-After header.  0 disables it.
+
+    max_concurrency: int
+        Requests allowed in flight at once; more get a 429.  0 disables it.
+
+    words_per_second: float
+        Speaking rate of the synthesized transcripts.
+
+    callback_drop_rate: float
+        Fraction of callback requests whose result is never posted back, so only polling finds it.
+    """
+
+    def __init__(self, latency='lognormal:300:0.5', per_mb_ms=50.0, error_429_rate=0.0, error_5xx_rate=0.0,
+                 rate_limit=0.0, max_concurrency=0, words_per_second=2.5, seed=None, callback_drop_rate=0.0):
+        self.latency = latency
+        self.per_mb_ms = float(per_mb_ms)
+        self.error_429_rate = float(error_429_rate)
+        self.error_5xx_rate = float(error_5xx_rate)
+        self.rate_limit = float(rate_limit)
+        self.max_concurrency = int(max_concurrency)
+        self.words_per_second = float(words_per_second)
+        self.seed = seed
+        self.callback_drop_rate = float(callback_drop_rate)
+        self.sample_latency = latencySampler(latency, random.Random(seed))
+
+
+def latencySampler(spec: str, rng: random.Random):
+    """A function returning latencies in seconds for a 'kind:ms[:spread]' spec."""
+    parts = spec.split(':')
+    kind, ms = parts[0], float(parts[1]) if len(parts) > 1 else 300.0
+    spread = float(parts[2]) if len(parts) > 2 else None
+    lock = threading.Lock()
+
+    def sample():
+        with lock:
+            if kind == 'fixed':
+                v = ms
+            elif kind == 'uniform':
+                s = ms / 2 if spread is None else spread
+                v = rng.uniform(ms - s, ms + s)
+            elif kind == 'lognormal':
+                v = ms * rng.lognormvariate(0.0, 0.5 if spread is None else spread)
+            elif kind == 'pareto':
+                v = ms * rng.paretovariate(2.0 if spread is None else spread)
+            else:
+                raise ValueError(f'Unknown latency distribution: {kind}')
+        return max(v, 0.0) / 1000
+
+    if kind not in ('fixed', 'uniform', 'lognormal', 'pareto'):
+        raise ValueError(f'Unknown latency distribution: {kind}')
+    return sample
+
+
+class StubStats:
+    """
+    Per-request log of the stub, for load tests to compute latency percentiles and error counts from.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+            self.in_flight = 0
+            self.peak_in_flight = 0
+
+    def enter(self) -> int:
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return self.in_flight
+
+    def leave(self, record: dict):
+        with self.lock:
+            self.in_flight -= 1
+            self.requests.append(record)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            requests = list(self.requests)
+            peak = self.peak_in_flight
+        statuses = {}
+        for r in requests:
+            statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+        return {'requests': requests, 'statuses': statuses, 'peak_in_flight': peak}
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """Take a token.  Returns 0 on success, else how long to wait for the next one."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+def parseWav(body: bytes):
+    """(samples as float mono, frame rate) of a PCM wav body."""
+    if len(body) < 12 or body[0:4] != b'RIFF' or body[8:12] != b'WAVE':
+        raise ValueError('Not a RIFF/WAVE body')
+    pos = 12
+    fmt = None
+    while pos + 8 <= len(body):
+        cid, size = body[pos:pos + 4], struct.unpack('<I', body[pos + 4:pos + 8])[0]
+        if cid == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', body[pos + 8:pos + 24])
+        elif cid == b'data':
+            if fmt is None:
+                raise ValueError('No fmt chunk before the data chunk')
+            _, channels, frame_rate, _, block_align, bits = fmt
+            data = body[pos + 8:pos + 8 + min(size, len(body) - pos - 8)]
+            data = data[:len(data) // block_align * block_align]
+            dtype = {8: np.uint8, 16: np.int16, 32: np.int32}[bits]
+            x = np.frombuffer(data, dtype=dtype).astype(np.float32).reshape(-1, channels).mean(axis=1)
+            if bits == 8:
+                x -= 128
+            return x / float(2 ** (bits - 1)), frame_rate
+        pos += 8 + size + (size & 1)
+    raise ValueError('No data chunk found')
+
+
+def synthesizeResponse(body: bytes, params: dict, settings: StubSettings, rng: random.Random) -> dict:
+    """
+    A Deepgram-shaped prerecorded response for the uploaded audio.  Utterances are the regions with energy in
+    them, and the speaker of each is picked by its dominant frequency, so synthetic recordings made of tones (see
+    whatdisay.loadtest) come back with consistent speakers.
+    """
+    x, rate = parseWav(body)
+    duration = len(x) / rate if rate else 0.0
+    diarize = params.get('diarize') == 'true'
+
+    frame = max(int(rate * 0.03), 1)
+    usable = len(x) // frame * frame
+    rms = np.sqrt(np.mean(x[:usable].reshape(-1, frame) ** 2, axis=1)) if usable else np.zeros(0)
+    regions = speechRegions(20 * np.log10(np.maximum(rms, 1e-10)), 30)
+
+    buckets = []
+    utterances = []
+    all_words = []
+    for start, end in regions:
+        seg = x[int(start * rate):int(min(end, start + 1.0) * rate)]
+        spectrum = np.abs(np.fft.rfft(seg))
+        freq = int(np.argmax(spectrum[1:]) + 1) * rate / max(len(seg), 1) if len(seg) > 1 else 0.0
+        bucket = int(round(freq / 40))
+        if bucket not in buckets:
+            buckets.append(bucket)
+        speaker = buckets.index(bucket)
+
+        n = max(int(round((end - start) * settings.words_per_second)), 1)
+        step = (end - start) / n
+        words = []
+        for i in range(n):
+            w = rng.choice(WORDS)
+            punctuated = (w.capitalize() if i == 0 else w) + ('.' if i == n - 1 else '')
+            word = {
+                'word': w,
+                'start': round(start + i * step, 3),
+                'end': round(start + (i + 1) * step, 3),
+                'confidence': round(rng.uniform(0.8, 1.0), 4),
+                'punctuated_word': punctuated,
+            }
+            if diarize:
+                word['speaker'] = speaker
+                word['speaker_confidence'] = round(rng.uniform(0.5, 1.0), 4)
+            words.append(word)
+        all_words.extend(words)
+
+        utterances.append({
+            'start': round(start, 3),
+            'end': round(end, 3),
+            'confidence': round(float(np.mean([w['confidence'] for w in words])), 4),
+            'channel': 0,
+            'transcript': ' '.join(w['punctuated_word'] for w in words),
+            'words': words,
+            'speaker': speaker,
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+        })
+
+    response = {
+        'metadata': {
+            'transaction_key': 'deprecated',
+            'request_id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'sha256': '',
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            'duration': round(duration, 3),
+            'channels': 1,
+            'models': [params.get('model', 'general')],
+        },
+        'results': {
+            'channels': [{
+                'alternatives': [{
+                    'transcript': ' '.join(w['punctuated_word'] for w in all_words),
+                    'confidence': round(float(np.mean([w['confidence'] for w in all_words])), 4) if all_words else 0.0,
+                    'words': all_words,
+                }],
+            }],
+        },
+    }
+    if params.get('utterances') == 'true':
+        response['results']['utterances'] = utterances
+    return response
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _read_body(self) -> bytes:
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # trailers, up to the empty line
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/')
+        if path.endswith('/stats'):
+            self._send_json(200, self.server.stats.snapshot())
+        elif '/listen/' in path:
+            # results of callback requests, for clients that poll instead of waiting for the callback
+            request_id = path.rsplit('/', 1)[1]
+            with self.server.jobs_lock:
+                known = request_id in self.server.jobs
+                result = self.server.jobs.get(request_id)
+            if result is not None:
+                self._send_json(200, result)
+            elif known:
+                self._send_json(202, {'request_id': request_id, 'status': 'processing'})
+            else:
+                self._send_json(404, {'err_code': 'NOT_FOUND', 'err_msg': f'Unknown request: {request_id}'})
+        else:
+            self._send_json(404, {'err_code': 'NOT_FOUND', 'err_msg': self.path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/').endswith('/stats/reset'):
+            self.server.stats.reset()
+            self._send_json(200, {})
+            return
+        if not url.path.rstrip('/').endswith('/listen'):
+            self._send_json(404, {'err_code': 'NOT_FOUND', 'err_msg': self.path})
+            return
+
+        arrived = time.time()
+        body = self._read_body()
+        settings = self.server.settings
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        in_flight = self.server.stats.enter()
+        status, payload, headers = 200, None, {}
+
+        try:
+            if not self.headers.get('Authorization', '').startswith('Token '):
+                status, payload = 401, {'err_code': 'INVALID_AUTH', 'err_msg': 'Invalid credentials.'}
+            elif settings.max_concurrency and in_flight > settings.max_concurrency:
+                status, payload = 429, {'err_code': 'TOO_MANY_REQUESTS', 'err_msg': 'Too many concurrent requests.'}
+            elif self.server.bucket and self.server.bucket.take() > 0:
+                status, payload = 429, {'err_code': 'TOO_MANY_REQUESTS', 'err_msg': 'Rate limit exceeded.'}
+                headers['Retry-After'] = '1'
+            elif 'callback' in params:
+                payload = {'request_id': self._accept_callback(body, params)}
+            else:
+                time.sleep(settings.sample_latency() + settings.per_mb_ms * len(body) / (1024 * 1024) / 1000)
+                roll = self.server.rng_random()
+                if roll < settings.error_429_rate:
+                    status, payload = 429, {'err_code': 'TOO_MANY_REQUESTS', 'err_msg': 'Injected 429.'}
+                    headers['Retry-After'] = '1'
+                elif roll < settings.error_429_rate + settings.error_5xx_rate:
+                    status = self.server.rng_choice([500, 502, 503])
+                    payload = {'err_code': 'INTERNAL_SERVER_ERROR', 'err_msg': f'Injected {status}.'}
+                else:
+                    try:
+                        payload = synthesizeResponse(body, params, settings, random.Random(self.server.rng_random()))
+                    except ValueError as e:
+                        status, payload = 400, {'err_code': 'Bad Request', 'err_msg': str(e)}
+            self._send_json(status, payload, headers)
+        finally:
+            self.server.stats.leave({
+                'arrived': arrived,
+                'finished': time.time(),
+                'latency': time.time() - arrived,
+                'status': status,
+                'bytes': len(body),
+                'in_flight': in_flight,
+            })
+
+
+    def _accept_callback(self, body: bytes, params: dict) -> str:
+        # answer with a request id right away and post the result to the callback url once it's "processed"
+        settings = self.server.settings
+        request_id = str(uuid.UUID(int=int(self.server.rng_random() * 2 ** 128)))
+        latency = settings.sample_latency() + settings.per_mb_ms * len(body) / (1024 * 1024) / 1000
+        drop = self.server.rng_random() < settings.callback_drop_rate
+        seed = self.server.rng_random()
+        with self.server.jobs_lock:
+            self.server.jobs[request_id] = None
+
+        def process():
+            time.sleep(latency)
+            try:
+                result = synthesizeResponse(body, params, settings, random.Random(seed))
+            except ValueError as e:
+                result = {'err_code': 'Bad Request', 'err_msg': str(e)}
+            result.setdefault('metadata', {})['request_id'] = request_id
+            with self.server.jobs_lock:
+                self.server.jobs[request_id] = result
+            if drop:
+                return
+            req = urllib.request.Request(
+                params['callback'], data=json.dumps(result).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}, method='POST'
+            )
+            for attempt in range(3):
+                try:
+                    urllib.request.urlopen(req, timeout=10).close()
+                    return
+                except OSError:
+                    time.sleep(0.5 * (attempt + 1))
+
+        threading.Thread(target=process, daemon=True).start()
+        return request_id
+
+
+class DeepgramStub:
+    """
+    Offline stand-in for Deepgram's prerecorded transcription API, with configurable latency, error injection
+    and rate limits.  Point the client at it with DEEPGRAM_API_URL (the url property).
+
+    Requests with a 'callback' parameter are answered with a request id right away and their result is posted to
+    the callback url later.  Their results can also be fetched with GET <url>/listen/<request_id>.
+
+    Parameters
+    ----------
+    settings: StubSettings
+        How the stub behaves.
+
+    host, port: str, int
+        Where to listen.  Port 0 picks a free port.
+    """
+
+    def __init__(self, settings: StubSettings = None, host='127.0.0.1', port=0, verbose=False):
+        self.settings = settings or StubSettings()
+        self.server = ThreadingHTTPServer((host, port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.settings = self.settings
+        self.server.stats = StubStats()
+        self.server.bucket = TokenBucket(self.settings.rate_limit) if self.settings.rate_limit else None
+        self.server.verbose = verbose
+        self.server.jobs = {}
+        self.server.jobs_lock = threading.Lock()
+        rng = random.Random(self.settings.seed)
+        rng_lock = threading.Lock()
+
+        def rng_random():
+            with rng_lock:
+                return rng.random()
+
+        def rng_choice(seq):
+            with rng_lock:
+                return rng.choice(seq)
+
+        self.server.rng_random = rng_random
+        self.server.rng_choice = rng_choice
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    @property
+    def stats(self) -> StubStats:
+        return self.server.stats
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def addStubArguments(parser):
+    parser.add_argument('--latency', default='lognormal:300:0.5', help="Latency distribution, 'kind:ms[:spread]' with kind fixed, uniform, lognormal or pareto.")
+    parser.add_argument('--per_mb_ms', type=float, default=50.0, help="Extra latency per MB uploaded.")
+    parser.add_argument('--error_429', type=float, default=0.0, help="Fraction of requests answered with a 429.")
+    parser.add_argument('--error_5xx', type=float, default=0.0, help="Fraction of requests answered with a 500/502/503.")
+    parser.add_argument('--rate_limit', type=float, default=0.0, help="Requests per second before answering with 429s (0 for no limit).")
+    parser.add_argument('--max_concurrency', type=int, default=0, help="Concurrent requests before answering with 429s (0 for no limit).")
+    parser.add_argument('--callback_drop', type=float, default=0.0, help="Fraction of callback requests whose result is never posted back.")
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def stubSettingsFromArgs(args) -> StubSettings:
+    return StubSettings(
+        latency=args.latency, per_mb_ms=args.per_mb_ms, error_429_rate=args.error_429, error_5xx_rate=args.error_5xx,
+        rate_limit=args.rate_limit, max_concurrency=args.max_concurrency, seed=args.seed,
+        callback_drop_rate=args.callback_drop
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local Deepgram stand-in.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--verbose', action='store_true', help="Log every request.")
+    addStubArguments(parser)
+    args = parser.parse_args()
+
+    stub = DeepgramStub(stubSettingsFromArgs(args), args.host, args.port, args.verbose)
+    print(f'Deepgram stub listening at {stub.url}.  Set DEEPGRAM_API_URL (or WHATDISAY_DEEPGRAM_API_URL) to use it.')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,71 @@
 #!/usr/bin/env python3
 
 from pyannote.audio import Pipeline
-from whatdisay.utils import TaskProps
+from pyannote.audio.utils.signal import binarize
+from pyannote.core import SlidingWindow, SlidingWindowFeature
+from whatdisay.utils import TaskProps, TaskMetrics
 from whatdisay.config import Config
-from pydub import AudioSegment
+from whatdisay.intermediates import TaskStore, TURNS, WORDS
+from whatdisay.upload import WavSource, PaddedWavReader
+from whatdisay.stages import fileFingerprint, hashValue
+from whatdisay.callbacks import callbacksEnabled, deepgramJobs
 import os, shutil
-import re
 from deepgram import Deepgram
-import json
 import asyncio
 import aiofiles
+import gc
+import json
+import numpy as np
+import threading
+import time
+import torch
+import weakref
+import yaml
+
+
+SNAPSHOT_FILE = 'pipeline.pt'
+
+# Pipeline steps whose outputs are cached so clustering can be re-run without them (pyannote hook step names).
+CLUSTERING_INPUTS = ['segmentation', 'speaker_counting', 'embeddings']
+
+# Instantiated pipelines shared by every Diarize in the process, keyed by snapshot location.
+_PIPELINES = {}
+_PIPELINE_LOCK = threading.Lock()
+
+
+def deepgramClient() -> Deepgram:
+    '''
+    A Deepgram SDK client for the configured API key.  DEEPGRAM_API_URL points it somewhere other than Deepgram's
+    API, e.g. at the local stub in whatdisay.deepgram_stub.
+    '''
+    c = Config()
+    api_key = c.get_param('DEEPGRAM_API_KEY')
+    api_url = c.get_optional_param('DEEPGRAM_API_URL')
+    return Deepgram({'api_key': api_key, 'api_url': api_url} if api_url else api_key)
+
+
+def evictPipelines() -> list:
+    '''
+    Drop the cached pyannote pipelines.  A pipeline that's still in use (e.g. diarizing right now) is put back,
+    since dropping it would only free the cache entry and the next load would make a second copy.
+
+    Returns the snapshot locations of the pipelines that were freed.
+    '''
+    with _PIPELINE_LOCK:
+        dropped = {key: weakref.ref(p) for key, p in _PIPELINES.items()}
+        _PIPELINES.clear()
+
+    gc.collect()
+    freed = []
+    for key, ref in dropped.items():
+        pipeline = ref()
+        if pipeline is None:
+            freed.append(key)
+            continue
+        with _PIPELINE_LOCK:
+            _PIPELINES.setdefault(key, pipeline)
+        print(f'The pyannote pipeline at {key} is in use, keeping it loaded.')
+    return freed
 
 
 class Diarize():
@@ -18,88 +74,265 @@ class Diarize():
         if not type(tp) == TaskProps:
             raise ValueError('Parameter tp must be of type TaskProps.')
         self.tp = tp
-        self.tmp_file_dir = tp.tmp_file_dir
+        self.storage = tp.storage
         self.pipelines_cash_dir = tp.pipelines_dir
         self.sd_pipe_cash_dir = tp.sd_pipeline
-        self.pyannote_dia_txt_file = tp.pyannote_diarization_txt
-        self.diarized_audio_file = tp.diarized_audio_file
+        self.sd_snapshot_dir = tp.sd_snapshot
+        self.embeddings_cache_dir = tp.embeddings_cache_dir
         self.spacermilli = 2000
 
-    def add_intro_spacer(self,audio_file):
-        raw_audio = AudioSegment.from_wav(audio_file)
-        spacer = AudioSegment.silent(duration=self.spacermilli)
-        audio = spacer.append(raw_audio,crossfade=0)
-        return audio
+    def add_intro_spacer(self, source: WavSource) -> PaddedWavReader:
+        # The spacer is supplied on the fly as the audio is read, instead of writing out a padded copy of it.
+        return PaddedWavReader(source, pad_ms=self.spacermilli)
 
     def load_pipeline(self):
         '''
-        Instantiate pretrained speaker diarization pipeline
+        Instantiate pretrained speaker diarization pipeline.  The pipeline is loaded once per process and shared;
+        the first load comes from the local snapshot if there is one, and only falls back to resolving it through
+        the HuggingFace hub (and then snapshotting it) if there isn't.
         '''
+        started = time.time()
+
+        with _PIPELINE_LOCK:
+            key = self.sd_snapshot_dir
+            if key in _PIPELINES:
+                pipeline, source = _PIPELINES[key], 'memory'
+            else:
+                pipeline = self.load_snapshot()
+                source = 'snapshot'
+                if pipeline is None:
+                    pipeline = self.load_pretrained()
+                    source = 'hub'
+                    self.save_snapshot(pipeline)
+                _PIPELINES[key] = pipeline
+
+        load_time = time.time() - started
+        print(f'Loaded pyannote pipeline from {source} in {load_time:.2f}s')
+        TaskMetrics(self.tp).record('pipeline', {'source': source, 'load_seconds': round(load_time, 3)})
         
+        return pipeline
+
+    def warm_pipeline(self):
+        '''
+        Load the pipeline into the process-wide cache ahead of the first diarization.
+        '''
+        self.load_pipeline()
+
+    def load_pretrained(self):
         pipe_type: str = 'pyannote/speaker-diarization'
 
         huggingface_token = Config().get_param('HUGGINGFACE_TOKEN')
 
         print('instantiating pretrained pipeline')
         cd = self.pipelines_cash_dir
-        pipeline = Pipeline.from_pretrained(pipe_type,use_auth_token=huggingface_token,cache_dir=cd)
-        
+        return Pipeline.from_pretrained(pipe_type,use_auth_token=huggingface_token,cache_dir=cd)
+
+    def save_snapshot(self, pipeline):
+        '''
+        Serialize the instantiated pipeline along with its hyperparameters so later loads don't touch the hub.
+        '''
+        d = self.sd_snapshot_dir
+        os.makedirs(d, exist_ok=True)
+        tmp = os.path.join(d, SNAPSHOT_FILE + '.tmp')
+        try:
+            torch.save(pipeline, tmp)
+        except Exception as e:
+            print(f'Could not snapshot the pyannote pipeline, it will keep loading from the hub: {str(e)}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        os.replace(tmp, os.path.join(d, SNAPSHOT_FILE))
+
+        with open(os.path.join(d, 'hyperparameters.yaml'), 'w') as f:
+            yaml.dump(_plainParams(pipeline.parameters(instantiated=True)), f)
+        print(f'Saved pyannote pipeline snapshot at: {d}')
+        return d
+
+    def load_snapshot(self):
+        f = os.path.join(self.sd_snapshot_dir, SNAPSHOT_FILE)
+        if not os.path.exists(f):
+            return None
+
+        try:
+            pipeline = torch.load(f, map_location='cpu', weights_only=False)
+        except TypeError:
+            # older torch versions don't have the weights_only argument
+            pipeline = torch.load(f, map_location='cpu')
+
+        params_file = os.path.join(self.sd_snapshot_dir, 'hyperparameters.yaml')
+        if os.path.exists(params_file):
+            with open(params_file) as p:
+                pipeline.instantiate(yaml.safe_load(p))
         return pipeline
 
-    def apply_pipeline(self, audio_file):
-        
+    def apply_pipeline(self, audio_file, num_speakers=None, min_speakers=None, max_speakers=None, reuse_embeddings=True):
+        '''
+        Diarize an audio file, optionally with a known speaker count or bounds on it.  The segmentation scores and
+        speaker embeddings of the run are cached, so when reuse_embeddings is set and the recording was diarized
+        before, only the clustering step is re-run.
+        '''
+        speakers = _speakerArgs(num_speakers, min_speakers, max_speakers)
+        if reuse_embeddings:
+            diarization = self.recluster(audio_file, missing_ok=True, **speakers)
+            if diarization is not None:
+                return diarization
+
+        pipeline = self.load_pipeline()
+
+        # Keep the final artefacts of the steps before clustering (embeddings also report progress in batches).
+        captured = {}
+
+        def hook(step_name, step_artefact, file=None, total=None, completed=None):
+            if completed is None:
+                captured[step_name] = step_artefact
+
         # pyannote.audio apparently misses the first 0.5 seconds of the audio, so we'll add a spacer at the beginning to compensate
-        audio_intro_spacer = self.add_intro_spacer(audio_file)
-        new_audio = os.path.join(self.tmp_file_dir,'spaced_audio.wav')
-        audio_intro_spacer.export(new_audio,format="wav")
-        print(f'Added intro spacer to audio_file and saved new wav file at: {new_audio}')
+        with WavSource(audio_file) as source:
+            spaced = self.add_intro_spacer(source)
+            print('Applying the pipeline to audio file')
+            diarization = pipeline({'uri': os.path.basename(audio_file), 'audio': spaced}, hook=hook, **speakers)
+        print(f'Finished applying pipeline to audio_file named: {audio_file}')
+
+        self.save_embeddings(audio_file, pipeline, captured)
+        return diarization
+
+    def embeddings_dir(self, audio_file):
+        return os.path.join(self.embeddings_cache_dir, fileFingerprint(audio_file))
+
+    def save_embeddings(self, audio_file, pipeline, captured: dict):
+        '''
+        Persist the segmentation scores, speaker counts and embeddings of a pipeline run for recluster().
+        '''
+        missing = [k for k in CLUSTERING_INPUTS if k not in captured]
+        if missing:
+            print(f'This pyannote version did not report {missing}, so speaker embeddings are not cached.')
+            return None
+
+        d = self.embeddings_dir(audio_file)
+        os.makedirs(d, exist_ok=True)
+        meta = {'pipeline': _pipelineKey(pipeline, self.spacermilli), 'windows': {}}
+        for name in CLUSTERING_INPUTS:
+            a = captured[name]
+            if hasattr(a, 'sliding_window'):
+                sw = a.sliding_window
+                meta['windows'][name] = {'start': sw.start, 'duration': sw.duration, 'step': sw.step}
+                a = a.data
+            np.save(os.path.join(d, name + '.npy'), np.asarray(a))
+        with open(os.path.join(d, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+        print(f'Cached speaker embeddings at: {d}')
+        return d
+
+    def recluster(self, audio_file, num_speakers=None, min_speakers=None, max_speakers=None, missing_ok=False):
+        '''
+        Re-run only the clustering step of the pipeline for a previously diarized recording, from its cached
+        segmentation scores and speaker embeddings, e.g. with a different number of speakers.  Takes seconds,
+        where a full pipeline run re-extracts every embedding.
+
+        Returns the diarization, or None if there is nothing cached for the recording and missing_ok is set.
+        '''
+        d = self.embeddings_dir(audio_file)
+        meta_file = os.path.join(d, 'meta.json')
+        if not os.path.exists(meta_file):
+            if missing_ok:
+                return None
+            raise FileNotFoundError(f'No cached speaker embeddings for {audio_file}.  Diarize it with pyannote first.')
 
         pipeline = self.load_pipeline()
-        # apply the pipeline to an audio file
-        print('Applying the pipeline to audio file')
-        diarization = pipeline(new_audio)
-        print(f'Finished applying pipeline to audio_file named: {new_audio}')
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta['pipeline'] != _pipelineKey(pipeline, self.spacermilli):
+            if missing_ok:
+                print('Cached speaker embeddings were made with different pipeline settings, re-running the pipeline.')
+                return None
+            raise ValueError(f'Cached speaker embeddings for {audio_file} were made with different pipeline settings.')
+
+        started = time.time()
+        arrays = {}
+        for name in CLUSTERING_INPUTS:
+            a = np.load(os.path.join(d, name + '.npy'))
+            w = meta['windows'].get(name)
+            arrays[name] = SlidingWindowFeature(a, SlidingWindow(**w)) if w else a
+        segmentations, count, embeddings = arrays['segmentation'], arrays['speaker_counting'], arrays['embeddings']
+
+        speakers = _speakerArgs(num_speakers, min_speakers, max_speakers)
+        num_speakers, min_speakers, max_speakers = speakers.get('num_speakers'), speakers.get('min_speakers'), speakers.get('max_speakers')
+        if hasattr(pipeline, 'set_num_speakers'):
+            num_speakers, min_speakers, max_speakers = pipeline.set_num_speakers(num_speakers, min_speakers, max_speakers)
+
+        # The rest of SpeakerDiarization.apply, from clustering on.
+        binarized = binarize(segmentations, onset=pipeline.segmentation.threshold, initial_state=False)
+        file = {'uri': os.path.basename(audio_file)}
+        frames = _clusteringFrames(pipeline)
+        clustered = pipeline.clustering(
+            embeddings=embeddings,
+            segmentations=binarized,
+            num_clusters=num_speakers,
+            min_clusters=min_speakers,
+            max_clusters=max_speakers,
+            file=file,
+            **({'frames': frames} if frames is not None else {}),
+        )
+        # (hard_clusters, soft_clusters) in pyannote.audio 3.0, with the centroids as well from 3.1
+        hard_clusters = clustered[0] if isinstance(clustered, tuple) else clustered
+        inactive_speakers = np.sum(binarized.data, axis=1) == 0
+        hard_clusters[inactive_speakers] = -2
+        discrete_diarization = pipeline.reconstruct(segmentations, hard_clusters, count)
+        diarization = pipeline.to_annotation(
+            discrete_diarization,
+            min_duration_on=0.0,
+            min_duration_off=pipeline.segmentation.min_duration_off,
+        )
+        diarization.uri = file['uri']
+        diarization = diarization.rename_labels(
+            {label: expected for label, expected in zip(diarization.labels(), pipeline.classes())}
+        )
+
+        recluster_time = time.time() - started
+        print(f'Re-clustered cached speaker embeddings into {len(diarization.labels())} speakers in {recluster_time:.2f}s')
+        TaskMetrics(self.tp).record('pipeline', {'reclustered': True, 'recluster_seconds': round(recluster_time, 3), **speakers})
         return diarization
 
 
-    def diarize_pyannote(
+    def pyannote_groups(
         self,
         audio_file,
-        num_speaker=None
+        num_speaker=None,
+        min_speakers=None,
+        max_speakers=None,
+        reuse_embeddings=True
     ):
+        '''
+        Run the pyannote pipeline and merge consecutive turns of the same speaker into groups of
+        [start, end, speaker] turns.  Times are on the spaced audio's timeline.
+        '''
 
-        diarization = self.apply_pipeline(audio_file)
+        diarization = self.apply_pipeline(audio_file, num_speaker, min_speakers, max_speakers, reuse_embeddings)
         
-        # dump the diarization output to disk using text format
-        print('Dumping the diarization output to a text file for now.')
-        
-        with open(self.pyannote_dia_txt_file, "w", encoding="utf-8") as text_file:
-            text_file.write(str(diarization))
-        print('Generated diarization file at {}'.format(self.pyannote_dia_txt_file))
-
-        af_w_intro_spacer = os.path.join(self.tmp_file_dir,'spaced_audio.wav')
-        audio = AudioSegment.from_wav(af_w_intro_spacer)
-
-        ## Now it's time to create the diarization
-        def millisec(timeStr):
-            spl = timeStr.split(":")
-            s = (int)((int(spl[0]) * 60 * 60 + int(spl[1]) * 60 + float(spl[2]) )* 1000)
-            return s
-        
-        raw_dz = open(self.pyannote_dia_txt_file).read().splitlines()
+        # Read the speaker turns straight off the annotation instead of dumping it to text and regex-parsing it back.
+        turns = [[turn.start, turn.end, speaker] for turn, _, speaker in diarization.itertracks(yield_label=True)]
+
+        # Persist the turns on the original audio's timeline (i.e. without the intro spacer).
+        spacer = self.spacermilli / 1000
+        TaskStore(self.tp).write_table(TURNS, {
+            'start': [max(t[0] - spacer, 0) for t in turns],
+            'end': [max(t[1] - spacer, 0) for t in turns],
+            'speaker': [t[2] for t in turns],
+        })
+        print('Saved pyannote speaker turns to the task intermediates.')
+
         groups = []
         g = []
         previous_end = 0
 
-        for d in raw_dz: 
-            if g and (g[0].split()[-1] != d.split()[-1]):      #same speaker
+        for t in turns: 
+            if g and (g[0][2] != t[2]):      #same speaker
                 groups.append(g)
                 g = []
   
-            g.append(d)
+            g.append(t)
             
-            end = re.findall('[0-9]+:[0-9]+:[0-9]+\.[0-9]+', string=d)[1]
-            end = millisec(end)
+            end = t[1]
             if (previous_end > end):       #segment engulfed by a previous segment
                 groups.append(g)
                 g = [] 
@@ -109,22 +342,43 @@ class Diarize():
         if g:
             groups.append(g)     
 
-        # Make sure there's a directory to save the audio segment files in
-        self.tp.createTaskDir(self.tp.dia_segments_dir)
+        return groups
+
+    def pyannote_segments(self, audio_file, num_speaker=None, min_speakers=None, max_speakers=None, reuse_embeddings=True) -> list:
+        '''
+        Pyannote diarization as [start, end, speaker, caption] segments on the original audio's timeline, the
+        same shape diarize_deepgram returns (pyannote has no captions, so they're empty).
+        '''
+        spacer = self.spacermilli / 1000
+        return [
+            [max(g[0][0] - spacer, 0), max(g[-1][1] - spacer, 0), g[0][2], '']
+            for g in self.pyannote_groups(audio_file, num_speaker, min_speakers, max_speakers, reuse_embeddings)
+        ]
+
+    def diarize_pyannote(
+        self,
+        audio_file,
+        num_speaker=None,
+        min_speakers=None,
+        max_speakers=None
+    ):
 
-        af_w_intro_spacer = os.path.join(self.tmp_file_dir,'spaced_audio.wav')
-        audio = AudioSegment.from_wav(af_w_intro_spacer)
+        groups = self.pyannote_groups(audio_file, num_speaker, min_speakers, max_speakers)
+
+        # Group times are on the spaced timeline, so a segment that starts inside the spacer gets that much silence.
+        spacer = self.spacermilli / 1000
         gidx = -1
-        for g in groups:
-            start = re.findall('[0-9]+:[0-9]+:[0-9]+\.[0-9]+', string=g[0])[0]
-            end = re.findall('[0-9]+:[0-9]+:[0-9]+\.[0-9]+', string=g[-1])[1]
-            start = millisec(start) #- spacermilli
-            end = millisec(end)  #- spacermilli
-            print(start, end)
-            gidx += 1
-            output_af_name = os.path.join(self.tmp_file_dir, 'audio_segments/' + str(gidx) + '.wav')
-            audio[start:end].export(output_af_name, format='wav')
-            print(f'Saved segment audio file at: {output_af_name}')
+        with WavSource(audio_file) as source:
+            for g in groups:
+                start = g[0][0] - spacer
+                end = g[-1][1] - spacer
+                print(start, end)
+                gidx += 1
+                output_af_name = self.tp.dia_segments + str(gidx) + '.wav'
+                segment = PaddedWavReader(source, pad_ms=max(-start, 0) * 1000, start=max(start, 0), end=max(end, 0))
+                with self.storage.open(output_af_name, 'wb') as f:
+                    shutil.copyfileobj(segment, f)
+                print(f'Saved segment audio file at: {output_af_name}')
 
         return groups, gidx
 
@@ -132,33 +386,31 @@ class Diarize():
     async def diarize_deepgram(self, audio_file):
 
         print('Getting speaker diarization using Deepgram...')
-        deepgram_api_key = Config().get_param('DEEPGRAM_API_KEY')
         deepgram_model = Config().get_param('DEEPGRAM_MODEL')
 
-        # Initialize the Deepgram SDK
-        deepgram = Deepgram(deepgram_api_key)
-
-        with open(audio_file,'rb') as audio:
-            source = {'buffer': audio, 'mimetype': 'audio/wav'}
-            response = await asyncio.create_task(
-                deepgram.transcription.prerecorded(
-                    source,
-                    {
-                        'punctuate': True, 
-                        'diarize': True, 
-                        'utterances': True,
-                        'tier': 'enhanced', 
-                        'model': deepgram_model}
-                )
-            )
+        options = {
+            'punctuate': True, 
+            'diarize': True, 
+            'utterances': True,
+            'tier': 'enhanced', 
+            'model': deepgram_model}
+
+        if callbacksEnabled():
+            # submit, then collect the result from the callback instead of holding the connection while it's processed
+            with open(audio_file,'rb') as audio:
+                response = await deepgramJobs().transcribe(audio, options)
+        else:
+            # Initialize the Deepgram SDK
+            deepgram = deepgramClient()
 
-        output_json = json.dumps(response)
-        j = json.loads(output_json)
-        utterances = j['results']['utterances']
+            with open(audio_file,'rb') as audio:
+                source = {'buffer': audio, 'mimetype': 'audio/wav'}
+                response = await asyncio.create_task(
+                    deepgram.transcription.prerecorded(source, options)
+                )
 
-        deepgram_to_file = os.path.join(self.tmp_file_dir,'deepgram_output.json')
-        with open(deepgram_to_file,'w',encoding='utf-8') as f:
-            json.dump(response,f, ensure_ascii=False, indent=4)
+        utterances = response['results']['utterances']
+        self.store_deepgram_utterances(utterances or [])
             
         segments = []
         if utterances:
@@ -193,10 +445,33 @@ class Diarize():
 
         return segments
 
+    def store_deepgram_utterances(self, utterances):
+        '''
+        Keep the utterances and their words from a Deepgram response as columnar intermediates.
+        '''
+        store = TaskStore(self.tp)
+        store.write_table(TURNS, {
+            'start': [u['start'] for u in utterances],
+            'end': [u['end'] for u in utterances],
+            'speaker': [str(u['speaker']) for u in utterances],
+            'confidence': [u['confidence'] for u in utterances],
+            'text': [u['transcript'] for u in utterances],
+        })
+
+        words = [w for u in utterances for w in u.get('words', [])]
+        store.write_table(WORDS, {
+            'start': [w['start'] for w in words],
+            'end': [w['end'] for w in words],
+            'speaker': [str(w.get('speaker', '')) for w in words],
+            'confidence': [w['confidence'] for w in words],
+            'word': [w.get('punctuated_word', w['word']) for w in words],
+        })
+        print('Saved Deepgram utterances to the task intermediates.')
+
 
     def reset_pretrained_pipeline(self):
 
-        # delete previously cached model if it exists
+        # delete previously cached model and snapshot if they exist
         s = self.sd_pipe_cash_dir
         print(s)
         if os.path.exists(s):
@@ -205,12 +480,56 @@ class Diarize():
         else:
             print('No cached pipeline found.  proceeding to download one.')
         
-        cd = self.pipelines_cash_dir
-        huggingface_token = Config().get_param('HUGGINGFACE_TOKEN')
+        if os.path.exists(self.sd_snapshot_dir):
+            print('Deleting previous pipeline snapshot...')
+            shutil.rmtree(self.sd_snapshot_dir)
+        _PIPELINES.pop(self.sd_snapshot_dir, None)
 
         try:
-            pipeline = Pipeline.from_pretrained('pyannote/speaker-diarization',use_auth_token=huggingface_token,cache_dir=cd)
+            started = time.time()
+            pipeline = self.load_pretrained()
+            hub_time = time.time() - started
         except OSError:
             print('Something went wrong trying to get pyannote pipeline.')
         else:
             print('Successfully downloaded pyannote/speaker-diarization pre-trained model.')
+
+            if self.save_snapshot(pipeline):
+                started = time.time()
+                self.load_snapshot()
+                snapshot_time = time.time() - started
+                print(f'Pipeline load time from the hub: {hub_time:.2f}s, from the snapshot: {snapshot_time:.2f}s')
+
+
+def _plainParams(params):
+    # pipeline hyperparameters come back as nested dicts of numpy/torch scalars
+    if isinstance(params, dict):
+        return {k: _plainParams(v) for k, v in params.items()}
+    return params.item() if hasattr(params, 'item') else params
+
+
+def _speakerArgs(num_speakers=None, min_speakers=None, max_speakers=None) -> dict:
+    args = {'num_speakers': num_speakers, 'min_speakers': min_speakers, 'max_speakers': max_speakers}
+    return {k: int(v) for k, v in args.items() if v}
+
+
+def _clusteringFrames(pipeline):
+    # the segmentation model's frames, which the pipeline keeps under a private name that moved in pyannote.audio 3.1
+    frames = getattr(pipeline, '_frames', None)
+    if frames is None:
+        model = getattr(getattr(pipeline, '_segmentation', None), 'model', None)
+        frames = getattr(model, 'receptive_field', None)
+    return frames
+
+
+def _pipelineKey(pipeline, spacermilli) -> str:
+    # what the cached segmentations and embeddings depend on: the models, how they're applied, and the spacer
+    params = _plainParams(pipeline.parameters(instantiated=True))
+    return hashValue({
+        'segmentation_model': str(getattr(pipeline, 'segmentation_model', '')),
+        'embedding': str(getattr(pipeline, 'embedding', '')),
+        'embedding_exclude_overlap': str(getattr(pipeline, 'embedding_exclude_overlap', '')),
+        'segmentation_step': str(getattr(pipeline, 'segmentation_step', '')),
+        'segmentation': params.get('segmentation'),
+        'spacermilli': spacermilli,
+    })
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps
+from whatdisay.config import Config
+from whatdisay.jobqueue import JobQueue, LeaseLost, DONE, FAILED
+from whatdisay.pipeline import MODES, buildTranscriptionGraph, transcribeStage, assembleStage, exportStage, governed
+from whatdisay.stages import fileFingerprint
+from whatdisay.upload import WavSource
+from whatdisay.profiler import profiling
+import multiprocessing
+import threading
+import signal
+import socket
+import sys
+import time
+import os
+
+
+# job kinds
+RECORDING = 'recording'
+SEGMENTS = 'segments'
+
+
+def submitRecording(queue: JobQueue, wav_file, tp: TaskProps, mode: str, whisper_model: str = None, range_seconds=600.0, use_cache=True, failure_policy: str = None, speakers: dict = None) -> dict:
+    """
+    Split a recording into jobs on the queue.  The jobs of one recording share a batch named after the task.
+
+    A recording up to range_seconds long becomes a single job that runs the whole pipeline on a worker.  A longer
+    one is diarized here, so speaker labels are consistent across the whole recording, and its diarized segments
+    are split into ranges of about range_seconds that workers transcribe independently.
+
+    Returns what assembleRecording needs besides the queue: the batch name and the diarization turns (if the
+    recording was diarized here).  failure_policy and speakers (see buildTranscriptionGraph) go with the jobs.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Invalid diarization mode '{mode}'.  Must be one of {list(MODES)}.")
+    wav_file = os.path.abspath(wav_file)
+    batch = tp.task_name
+    queue.remove_batch(batch)
+
+    with WavSource(wav_file) as source:
+        duration = source.duration
+
+    if duration <= range_seconds:
+        queue.submit(batch, 0, RECORDING, {
+            'wav_file': wav_file, 'mode': mode, 'whisper_model': whisper_model, 'use_cache': use_cache,
+            'failure_policy': failure_policy, 'speakers': speakers or {},
+        })
+        print(f'Queued {wav_file} as a single job.')
+        return {'batch': batch, 'turns': None}
+
+    graph = buildTranscriptionGraph(tp, mode, whisper_model, speakers=speakers, reuse_embeddings=use_cache)
+    values = graph.run({'wav_file': wav_file}, {'wav_file': fileFingerprint(wav_file)}, use_cache=use_cache, outputs=['turns', 'segments'])
+
+    ranges = []
+    for s in values['segments']:
+        if not ranges or float(s[0]) >= ranges[-1]['start'] + range_seconds:
+            ranges.append({'start': float(s[0]), 'segments': []})
+        ranges[-1]['segments'].append(list(s))
+
+    for part, r in enumerate(ranges):
+        queue.submit(batch, part, SEGMENTS, {
+            'wav_file': wav_file, 'mode': mode, 'whisper_model': whisper_model, 'segments': r['segments'],
+            'use_cache': use_cache, 'failure_policy': failure_policy,
+        })
+    print(f'Queued {len(values["segments"])} diarized segments of {wav_file} as {len(ranges)} jobs.')
+
+    return {'batch': batch, 'turns': values['turns']}
+
+
+def waitForBatch(queue: JobQueue, batch: str, poll_s=2.0, timeout=None, alive=None) -> list:
+    """
+    Block until every job of a batch is done.  Raises RuntimeError if any of them failed for good, or when alive is
+    given and returns False (e.g. every worker this process started has exited) while jobs are still outstanding,
+    and TimeoutError after timeout seconds.
+    """
+    started = time.time()
+    last = None
+    while True:
+        counts = queue.counts(batch)
+        if counts != last:
+            print('Jobs: ' + ', '.join(f'{n} {status}' for status, n in sorted(counts.items())))
+            last = counts
+
+        if counts.get(FAILED):
+            errors = [f"part {j['part']}: {j['error']}" for j in queue.jobs(batch) if j['status'] == FAILED]
+            raise RuntimeError(f'{len(errors)} jobs of {batch} failed:\n' + '\n'.join(errors))
+        if counts and set(counts) == {DONE}:
+            return queue.jobs(batch)
+        if timeout and time.time() - started > timeout:
+            raise TimeoutError(f'Jobs of {batch} not done after {timeout}s: {counts}')
+        if alive is not None and not alive():
+            raise RuntimeError(f'Every worker exited with jobs of {batch} still outstanding: {counts}')
+        time.sleep(poll_s)
+
+
+def assembleRecording(queue: JobQueue, submitted: dict, tp: TaskProps) -> str:
+    """
+    Merge the results of a finished batch into the final transcript.  Returns the path of the transcript.
+    """
+    rows = []
+    turns = list(submitted.get('turns') or [])
+    for job in queue.jobs(submitted['batch']):
+        rows.extend(job['result']['rows'])
+        turns.extend(job['result'].get('turns') or [])
+
+    transcript = assembleStage(rows)['transcript']
+    return exportStage(sorted(turns, key=lambda t: float(t[0])), transcript, tp)['output_file']
+
+
+def runJob(job: dict, tp: TaskProps) -> dict:
+    with governed(tp):
+        return _runJob(job, tp)
+
+
+def _runJob(job: dict, tp: TaskProps) -> dict:
+    p = job['payload']
+    if job['kind'] == RECORDING:
+        use_cache = p.get('use_cache', True)
+        graph = buildTranscriptionGraph(
+            tp, p['mode'], p['whisper_model'], p.get('failure_policy'), p.get('speakers'),
+            reuse_embeddings=use_cache, reuse_segments=use_cache
+        )
+        values = graph.run(
+            {'wav_file': p['wav_file']}, {'wav_file': fileFingerprint(p['wav_file'])},
+            use_cache=use_cache, outputs=['turns', 'transcript']
+        )
+        return {'rows': values['transcript'], 'turns': values['turns']}
+
+    if job['kind'] == SEGMENTS:
+        # the decode settings come from this host's config, like they do for the transcribe stage
+        diarizer, engine = MODES[p['mode']]
+        rows = transcribeStage(
+            p['wav_file'], p['segments'], engine, p['whisper_model'], {}, tp, failure_policy=p.get('failure_policy'),
+            per_channel=diarizer == 'channels', reuse_segments=p.get('use_cache', True)
+        )['rows']
+        return {'rows': rows}
+
+    raise ValueError(f"Unknown job kind: {job['kind']}")
+
+
+def runWorker(db_path: str, worker_id: str = None, lease_s=60.0, poll_s=2.0, idle_exit_s=None, max_jobs=None, output_dir=None, profile=False) -> int:
+    """
+    Claim and run jobs from the queue until there's been nothing to do for idle_exit_s seconds (or forever, when
+    it's None) or max_jobs jobs were run.  The lease of the running job is renewed every lease_s / 3 seconds.
+    With profile, the worker's whole run is profiled into the 'profiles' dir, under the worker's id.
+
+    Returns the number of jobs completed.
+    """
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    if profile and threading.current_thread() is threading.main_thread():
+        # local workers are terminated once their batch is done; exit cleanly so the profile gets written
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with profiling(TaskProps(f'worker_{worker_id}', output_dir), profile):
+        return _runWorker(db_path, worker_id, lease_s, poll_s, idle_exit_s, max_jobs, output_dir)
+
+
+def _runWorker(db_path, worker_id, lease_s, poll_s, idle_exit_s, max_jobs, output_dir) -> int:
+    queue = JobQueue(db_path)
+    completed = 0
+    idle_since = time.time()
+    print(f'Worker {worker_id} polling {db_path}')
+
+    while max_jobs is None or completed < max_jobs:
+        job = queue.claim(worker_id, lease_s)
+        if job is None:
+            if idle_exit_s is not None and time.time() - idle_since > idle_exit_s:
+                break
+            time.sleep(poll_s)
+            continue
+
+        print(f"Worker {worker_id} running job {job['id']} ({job['kind']}, part {job['part']} of {job['batch']}, attempt {job['attempts']})")
+        tp = TaskProps(f"{job['batch']}_part{job['part']}_{worker_id}", output_dir)
+        tp.createAllTaskDirectories()
+
+        lost = threading.Event()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(lease_s / 3):
+                try:
+                    queue.heartbeat(job['id'], worker_id, lease_s)
+                except LeaseLost:
+                    lost.set()
+                    return
+
+        hb = threading.Thread(target=heartbeat, daemon=True)
+        hb.start()
+        try:
+            result = runJob(job, tp)
+            queue.complete(job['id'], worker_id, result)
+            completed += 1
+        except LeaseLost:
+            print(f"Worker {worker_id} lost the lease on job {job['id']}; dropping its result.")
+        except Exception as e:
+            print(f"Worker {worker_id} failed job {job['id']}: {e!r}")
+            if not lost.is_set():
+                try:
+                    queue.fail(job['id'], worker_id, repr(e))
+                except LeaseLost:
+                    pass
+        finally:
+            stop.set()
+            hb.join()
+            tp.cleanupTask()
+        idle_since = time.time()
+
+    return completed
+
+
+def startLocalWorkers(db_path: str, n: int, **kwargs) -> list:
+    """
+    Start n worker processes on this host, e.g. to try out distributed mode or to use every core of one box.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    procs = []
+    for i in range(n):
+        p = ctx.Process(target=runWorker, args=(db_path, f'{socket.gethostname()}-local{i}'), kwargs=kwargs, daemon=True)
+        p.start()
+        procs.append(p)
+    return procs
+
+
+def distributeTranscript(wav_file, tp: TaskProps, mode: str, whisper_model: str = None, db_path: str = None, local_workers=0, use_cache=True, profile=False, failure_policy: str = None, speakers: dict = None) -> str:
+    """
+    Coordinator for distributed mode: queue the recording, optionally start local workers, wait for the jobs to
+    finish and assemble the final transcript.  With profile, the local workers are profiled too.  Returns the path of
+    the transcript.
+    """
+    c = Config()
+    db_path = db_path or c.get_optional_param('WORK_QUEUE') or tp.queue_db
+    range_seconds = float(c.get_optional_param('DISTRIBUTE_RANGE_SECONDS', 600))
+    lease_s = float(c.get_optional_param('WORKER_LEASE_SECONDS', 60))
+    timeout = float(c.get_optional_param('DISTRIBUTE_TIMEOUT_SECONDS', 6 * 3600))
+
+    queue = JobQueue(db_path)
+    submitted = submitRecording(queue, wav_file, tp, mode, whisper_model, range_seconds, use_cache, failure_policy, speakers)
+
+    procs = startLocalWorkers(
+        db_path, local_workers, lease_s=lease_s, idle_exit_s=5 * lease_s, output_dir=tp.output_dir, profile=profile
+    ) if local_workers else []
+    # with local workers, don't wait on a queue nobody is working on any more once they've all exited
+    alive = (lambda: any(p.is_alive() for p in procs)) if procs else None
+    try:
+        waitForBatch(queue, submitted['batch'], timeout=timeout, alive=alive)
+    finally:
+        for p in procs:
+            p.terminate()
+            p.join()
+
+    output_file = assembleRecording(queue, submitted, tp)
+    queue.remove_batch(submitted['batch'])
+    return output_file
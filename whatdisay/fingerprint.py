@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps, TaskMetrics
+from whatdisay.config import Config
+from whatdisay.upload import WavSource
+import collections
+import numpy as np
+import os
+import sqlite3
+
+
+# sub-fingerprints of quieter frames than this are noise, and aren't used to look clips up
+MIN_FRAME_DB = -55.0
+# a clip needs this many loud frames (about half a second) to be worth fingerprinting
+MIN_LOUD_FRAMES = 32
+# sub-fingerprints of a query that are looked up in the index
+MAX_QUERY_VALUES = 256
+# abandoned placeholders of clips that never got a transcript are dropped after this long
+STALE_PLACEHOLDER_DAYS = 1
+
+
+def samplesOf(source: WavSource, start: float, end: float) -> np.ndarray:
+    """The mono (downmixed) float samples of [start, end) of a wav file, scaled to [-1, 1]."""
+    first = source.frame_at(start)
+    return source.read_samples(first, max(source.frame_at(end) - first, 0)).mean(axis=1)
+
+
+def spectralFingerprint(samples: np.ndarray, frame_rate: int, hop_s=1 / 64, window_s=0.37, low_hz=300, high_hz=2000, bands=33):
+    """
+    Compact spectral fingerprint of a clip: one 32 bit sub-fingerprint per hop_s of audio, whose bits are the signs
+    of the change over time of the energy differences between 33 adjacent log-spaced bands from 300Hz to 2kHz (the
+    Haitsma-Kalker scheme).  The bits survive re-encoding, resampling and volume changes, and the long, heavily
+    overlapping windows keep them stable when a clip is cut at a slightly different point, so the same audio gives
+    nearly the same fingerprint wherever it turns up, at 256 bytes per second.
+
+    Returns (values, loud): the uint32 sub-fingerprints, and whether each one's frame is loud enough to be more than
+    noise.
+    """
+    # nothing above high_hz is used, so work at about 5kHz (averaging as a crude low-pass filter)
+    factor = max(int(frame_rate // 5000), 1)
+    samples = samples[:len(samples) // factor * factor].reshape(-1, factor).mean(axis=1)
+    frame_rate = frame_rate / factor
+
+    n = 1 << int(np.round(np.log2(window_s * frame_rate)))
+    hop = max(int(frame_rate * hop_s), 1)
+    count = (len(samples) - n) // hop + 1
+    if count < 2:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+
+    # bins -> bands, as a one-hot matrix so band energies are one matrix product
+    band_of = np.digitize(np.fft.rfftfreq(n, 1 / frame_rate), np.geomspace(low_hz, high_hz, bands + 1)) - 1
+    inside = (band_of >= 0) & (band_of < bands)
+    to_bands = np.zeros((len(band_of), bands), dtype=np.float32)
+    to_bands[np.nonzero(inside)[0], band_of[inside]] = 1
+
+    window = np.hanning(n).astype(np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, n)[::hop][:count]
+    energies = np.empty((count, bands), dtype=np.float32)
+    level = np.empty(count, dtype=np.float32)
+    # a block of frames at a time, so a long clip doesn't need all of its spectra in memory at once
+    for a in range(0, count, 512):
+        x = frames[a:a + 512] * window
+        energies[a:a + 512] = (np.abs(np.fft.rfft(x, axis=1)) ** 2) @ to_bands
+        level[a:a + 512] = 10 * np.log10(np.maximum(np.mean(x * x, axis=1), 1e-12))
+
+    diff = np.diff(np.log(energies + 1e-10), axis=1)
+    bits = (diff[1:] - diff[:-1]) < 0
+    values = np.packbits(bits, axis=1).view('>u4').ravel().astype(np.uint32)
+    return values, level[1:] > MIN_FRAME_DB
+
+
+def bitErrorRate(a: np.ndarray, b: np.ndarray, offset: int, min_overlap: float) -> float:
+    """
+    Share of differing bits between fingerprint a and fingerprint b shifted by offset (a[i] against b[i + offset]),
+    or 1.0 when they overlap by less than min_overlap of the shorter one.
+    """
+    lo, hi = max(0, -offset), min(len(a), len(b) - offset)
+    if hi - lo < min_overlap * min(len(a), len(b)) or hi <= lo:
+        return 1.0
+    xor = np.bitwise_xor(a[lo:hi], b[lo + offset:hi + offset])
+    return float(np.unpackbits(xor.view(np.uint8)).sum()) / (32 * (hi - lo))
+
+
+class FingerprintIndex:
+    """
+    Persistent index of the fingerprints of transcribed clips and their transcripts, in a SQLite database.
+
+    Every loud sub-fingerprint of a clip is stored with its position, so a query finds candidate clips by looking
+    up a sample of its own sub-fingerprints and voting on (clip, offset) pairs; the best candidates are then
+    compared bit by bit at their offset.  That finds a clip again even when its boundaries moved a little, as they
+    do when diarization cuts the same intro out of two recordings.
+
+    Clips are kept per key (the engine and model that transcribed them), so a transcript is only reused for the
+    engine that produced it.
+
+    Parameters
+    ----------
+    db_path: str
+        Path of the index database.  It's created if it doesn't exist.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.con = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS clips (
+                id INTEGER PRIMARY KEY,
+                key TEXT NOT NULL,
+                seconds REAL NOT NULL,
+                fingerprint BLOB NOT NULL,
+                text TEXT,
+                created TEXT NOT NULL DEFAULT (datetime('now')),
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS subprints (
+                value INTEGER NOT NULL,
+                clip INTEGER NOT NULL,
+                pos INTEGER NOT NULL
+            )
+        ''')
+        self.con.execute('CREATE INDEX IF NOT EXISTS subprints_value ON subprints (value)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS subprints_clip ON subprints (clip)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS clips_key ON clips (key, seconds)')
+        stale = [r[0] for r in self.con.execute(
+            f"SELECT id FROM clips WHERE text IS NULL AND created < datetime('now', '-{STALE_PLACEHOLDER_DAYS} day')"
+        )]
+        for clip in stale:
+            self.remove(clip)
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, key: str, values: np.ndarray, loud: np.ndarray, seconds: float, text=None) -> int:
+        """
+        Store a clip's fingerprint, with its transcript, or None for a placeholder whose transcript is set once
+        it's known.  Returns the clip id.
+        """
+        try:
+            self.con.execute('BEGIN IMMEDIATE')
+            clip = self.con.execute(
+                'INSERT INTO clips (key, seconds, fingerprint, text) VALUES (?, ?, ?, ?)',
+                (key, float(seconds), values.astype('<u4').tobytes(), text)
+            ).lastrowid
+            self.con.executemany(
+                'INSERT INTO subprints (value, clip, pos) VALUES (?, ?, ?)',
+                ((int(values[p]), clip, int(p)) for p in np.nonzero(loud)[0])
+            )
+            self.con.execute('COMMIT')
+        except BaseException:
+            self.con.execute('ROLLBACK')
+            raise
+        return clip
+
+    def set_text(self, clip: int, text: str):
+        self.con.execute('UPDATE clips SET text = ? WHERE id = ?', (text, clip))
+
+    def remove(self, clip: int):
+        try:
+            self.con.execute('BEGIN IMMEDIATE')
+            self.con.execute('DELETE FROM subprints WHERE clip = ?', (clip,))
+            self.con.execute('DELETE FROM clips WHERE id = ?', (clip,))
+            self.con.execute('COMMIT')
+        except BaseException:
+            self.con.execute('ROLLBACK')
+            raise
+
+    def hit(self, clip: int):
+        self.con.execute('UPDATE clips SET hits = hits + 1 WHERE id = ?', (clip,))
+
+    def lookup(self, key: str, values: np.ndarray, loud: np.ndarray, seconds: float, max_ber=0.2, tolerance=0.1, candidates=5):
+        """
+        The best matching clip for a fingerprint, as (clip id, text, bit error rate), or None.  A match has to be
+        within tolerance of the query's duration and have a bit error rate of at most max_ber.  Its text is None
+        when it's a placeholder.
+        """
+        positions = np.nonzero(loud)[0]
+        if len(positions) == 0:
+            return None
+        positions = positions[np.linspace(0, len(positions) - 1, min(len(positions), MAX_QUERY_VALUES)).astype(int)]
+        query = collections.defaultdict(list)
+        for p in positions:
+            query[int(values[p])].append(int(p))
+
+        votes = collections.Counter()
+        keys = list(query)
+        for a in range(0, len(keys), 500):
+            chunk = keys[a:a + 500]
+            # CROSS JOIN keeps SQLite from scanning every clip of the key instead of probing by value
+            rows = self.con.execute(
+                f'''SELECT s.value, s.clip, s.pos FROM subprints s CROSS JOIN clips c ON c.id = s.clip
+                    WHERE s.value IN ({",".join("?" * len(chunk))}) AND c.key = ? AND c.seconds BETWEEN ? AND ?''',
+                (*chunk, key, seconds * (1 - tolerance), seconds * (1 + tolerance))
+            )
+            for value, clip, pos in rows:
+                for p in query[value]:
+                    votes[(clip, pos - p)] += 1
+
+        best = None
+        for (clip, offset), n in votes.most_common(candidates):
+            if n < min(3, len(positions)):
+                break
+            fingerprint, text = self.con.execute('SELECT fingerprint, text FROM clips WHERE id = ?', (clip,)).fetchone()
+            ber = bitErrorRate(values, np.frombuffer(fingerprint, dtype='<u4').astype(np.uint32), offset, 1 - tolerance)
+            if ber <= max_ber and (best is None or ber < best[2]):
+                best = (clip, text, ber)
+        return best
+
+    def stats(self) -> dict:
+        clips, hits = self.con.execute('SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM clips WHERE text IS NOT NULL').fetchone()
+        return {'clips': clips, 'hits': hits}
+
+
+class SegmentDedupe:
+    """
+    Reuse the transcripts of segments whose audio was transcribed before: hold music, recorded intros and
+    disclaimers, or the same recording uploaded twice.
+
+    match() fingerprints a segment and looks it up in the index.  A segment without a match gets a placeholder in
+    the index, so later segments with the same audio (in this recording too) wait for its transcript instead of
+    being transcribed again; remember() then stores the transcript, or forget() drops the placeholder when the
+    segment failed.
+
+    Parameters
+    ----------
+    index: FingerprintIndex
+        The index to look segments up in and add them to.
+
+    key: str
+        The engine and model segments are transcribed with.
+    """
+
+    def __init__(self, index: FingerprintIndex, key: str, max_ber=0.2, min_seconds=2.0, tolerance=0.1):
+        self.index = index
+        self.key = key
+        self.max_ber = max_ber
+        self.min_seconds = min_seconds
+        self.tolerance = tolerance
+        self.placeholders = {}
+        self.followers = {}
+        self.stats = {'segments': 0, 'fingerprinted': 0, 'hits': 0, 'seconds': 0.0, 'seconds_skipped': 0.0, 'indexed': 0}
+
+    def match(self, source: WavSource, i: int, segment):
+        """
+        The transcript of earlier audio matching segment i, or None.  When the match is a placeholder of this run,
+        None is returned and the segment is added to followers, to be filled in from the leader's transcript.
+        """
+        start, end = float(segment[0]), float(segment[1])
+        self.stats['segments'] += 1
+        self.stats['seconds'] += end - start
+        if end - start < self.min_seconds:
+            return None
+        values, loud = spectralFingerprint(samplesOf(source, start, end), source.frame_rate)
+        if loud.sum() < MIN_LOUD_FRAMES:
+            return None
+        self.stats['fingerprinted'] += 1
+
+        hit = self.index.lookup(self.key, values, loud, end - start, self.max_ber, self.tolerance)
+        leaders = {clip: j for j, clip in self.placeholders.items()}
+        if hit is not None and (hit[1] is not None or hit[0] in leaders):
+            self.stats['hits'] += 1
+            self.stats['seconds_skipped'] += end - start
+            if hit[1] is None:
+                self.followers[i] = leaders[hit[0]]
+                return None
+            self.index.hit(hit[0])
+            return hit[1]
+
+        self.placeholders[i] = self.index.add(self.key, values, loud, end - start)
+        return None
+
+    def remember(self, i: int, text: str):
+        clip = self.placeholders.pop(i, None)
+        if clip is not None:
+            self.index.set_text(clip, text or '')
+            self.stats['indexed'] += 1
+
+    def forget(self, i: int):
+        clip = self.placeholders.pop(i, None)
+        if clip is not None:
+            self.index.remove(clip)
+
+    def follower_texts(self, texts: dict) -> dict:
+        """The transcripts of the followers, given the leaders' transcripts by segment index."""
+        return {i: texts[j] for i, j in self.followers.items() if texts.get(j) is not None}
+
+    def close(self, tp: TaskProps, metrics_key=None):
+        """
+        Drop the placeholders that never got a transcript, and print and record the hit rate, under metrics_key of
+        the 'dedupe' metrics when that's set.
+        """
+        for i in list(self.placeholders):
+            self.forget(i)
+        self.index.close()
+
+        s = dict(self.stats, key=self.key)
+        s['seconds'] = round(s['seconds'], 3)
+        s['seconds_skipped'] = round(s['seconds_skipped'], 3)
+        s['hit_rate'] = round(s['hits'] / s['segments'], 4) if s['segments'] else 0.0
+        if s['hits']:
+            print(f"Reused the transcripts of {s['hits']} of {s['segments']} segments with previously transcribed audio "
+                  f"({s['hit_rate']:.0%}), skipping {s['seconds_skipped']:.1f}s of {s['seconds']:.1f}s.")
+        TaskMetrics(tp).record('dedupe', {metrics_key: s} if metrics_key else s)
+
+
+def dedupeFor(tp: TaskProps, key: str):
+    """
+    A SegmentDedupe on the task's fingerprint index, or None unless FINGERPRINT_DEDUPE is turned on.  The thresholds
+    are FINGERPRINT_MAX_BER (default 0.2), FINGERPRINT_MIN_SECONDS (default 2) and FINGERPRINT_DURATION_TOLERANCE
+    (default 0.1).
+    """
+    c = Config()
+    if str(c.get_optional_param('FINGERPRINT_DEDUPE', 'false')).lower() not in ('true', '1', 'yes'):
+        return None
+    return SegmentDedupe(
+        FingerprintIndex(tp.fingerprint_index),
+        key,
+        max_ber=float(c.get_optional_param('FINGERPRINT_MAX_BER', 0.2)),
+        min_seconds=float(c.get_optional_param('FINGERPRINT_MIN_SECONDS', 2.0)),
+        tolerance=float(c.get_optional_param('FINGERPRINT_DURATION_TOLERANCE', 0.1)),
+    )
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps, TaskMetrics
+from whatdisay.config import Config
+import os
+import resource
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class ResourceBudgetExceeded(MemoryError):
+    """
+    Raised at a checkpoint when a job stayed over its memory budget after every degradation was tried, so it
+    fails on its own terms instead of being OOM-killed along with everything else on the host.  Carries the
+    governor's decisions up to that point.
+    """
+
+    def __init__(self, message: str, decisions=()):
+        super().__init__(message)
+        self.decisions = list(decisions)
+
+
+def readRss() -> int:
+    """Resident set size of this process, in bytes."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # peak rather than current RSS, but better than nothing (KB on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def readCpuSeconds() -> float:
+    t = os.times()
+    return t.user + t.system
+
+
+class _Action:
+
+    def __init__(self, name, fn, resource, level, repeat):
+        self.name = name
+        self.fn = fn
+        self.resource = resource
+        self.level = level
+        self.repeat = repeat
+        self.last = None
+        self.exhausted = False
+
+
+class ResourceGovernor:
+    """
+    Samples the process's RSS and CPU use while a job runs and degrades the job when it gets close to its budget.
+
+    Parts of the pipeline register degradation actions while they run (halve the Deepgram upload budget and
+    concurrency, switch to streaming audio reads, evict cached models, use fewer threads, ...).  When usage of a
+    resource crosses soft_ratio of its budget, 'soft' actions for it are run, one per sample, cheapest first
+    (in the order they were registered); 'hard' actions are only run once usage is over the budget.  An action
+    returns a short description of what it did, or None once it can't degrade any further.
+
+    If memory stays over the budget for grace_s after every action is exhausted, checkpoint() raises
+    ResourceBudgetExceeded.  Every decision is logged in the task's metrics.
+
+    Parameters
+    ----------
+    tp: TaskProps
+        The task whose metrics the decisions are logged in.
+
+    memory_mb: float
+        Memory budget.  None to only monitor memory.
+
+    cpu_percent: float
+        CPU budget, as a percentage of one core (400 is four cores).  None to only monitor CPU.
+    """
+
+    def __init__(self, tp: TaskProps, memory_mb=None, cpu_percent=None, interval_s=0.5, soft_ratio=0.8, cooldown_s=2.0, grace_s=10.0):
+        self.tp = tp
+        self.budgets = {
+            'memory': float(memory_mb) * 1024 * 1024 if memory_mb else None,
+            'cpu': float(cpu_percent) if cpu_percent else None,
+        }
+        self.interval_s = interval_s
+        self.soft_ratio = soft_ratio
+        self.cooldown_s = cooldown_s
+        self.grace_s = grace_s
+
+        self.actions = []
+        self.decisions = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.exceeded = False
+        self.over_since = None
+
+        self.samples = 0
+        self.rss = 0
+        self.peak_rss = 0
+        self.cpu = 0.0
+        self.peak_cpu = 0.0
+        self.cpu_total = 0.0
+        self.started = None
+        self.previous = None
+
+    def add_action(self, name: str, fn, resource='memory', level='soft', repeat=True):
+        """Register a degradation.  Returns a handle for remove_action."""
+        a = _Action(name, fn, resource, level, repeat)
+        with self.lock:
+            self.actions.append(a)
+        return a
+
+    def remove_action(self, handle):
+        with self.lock:
+            if handle in self.actions:
+                self.actions.remove(handle)
+
+    def checkpoint(self):
+        """Called by long-running loops between units of work."""
+        if self.exceeded:
+            raise ResourceBudgetExceeded(
+                f'Task {self.tp.task_name} stayed over its {self.budgets["memory"] / 1024 / 1024:.0f}MB memory budget '
+                f'({self.rss / 1024 / 1024:.0f}MB) after every degradation was tried.',
+                self.decisions
+            )
+
+    def sample(self):
+        now = time.time()
+        cpu_seconds = readCpuSeconds()
+        self.rss = readRss()
+        if self.previous:
+            wall = now - self.previous[0]
+            self.cpu = 100 * (cpu_seconds - self.previous[1]) / wall if wall > 0 else 0.0
+        self.previous = (now, cpu_seconds)
+        self.samples += 1
+        self.peak_rss = max(self.peak_rss, self.rss)
+        self.peak_cpu = max(self.peak_cpu, self.cpu)
+        return self.rss, self.cpu
+
+    def usage(self, resource) -> float:
+        """Usage of a resource as a fraction of its budget (0 when it has no budget)."""
+        budget = self.budgets[resource]
+        if not budget:
+            return 0.0
+        return (self.rss if resource == 'memory' else self.cpu) / budget
+
+    def _tick(self):
+        self.sample()
+        now = time.time()
+
+        for resource in ('memory', 'cpu'):
+            u = self.usage(resource)
+            if u < self.soft_ratio:
+                if resource == 'memory':
+                    self.over_since = None
+                continue
+
+            with self.lock:
+                eligible = [
+                    a for a in self.actions
+                    if a.resource == resource and not a.exhausted
+                    and (a.level == 'soft' or u >= 1.0)
+                    and (a.last is None or (a.repeat and now - a.last >= self.cooldown_s))
+                ]
+            # soft actions first, even when over the budget
+            eligible.sort(key=lambda a: a.level != 'soft')
+
+            acted = False
+            for a in eligible:
+                a.last = now
+                try:
+                    detail = a.fn()
+                except Exception as e:
+                    detail = None
+                    print(f'Resource governor action {a.name} failed: {e!r}')
+                if not detail or not a.repeat:
+                    a.exhausted = True
+                if detail:
+                    self._log(a, resource, u, detail)
+                    acted = True
+                    break
+
+            if resource == 'memory' and u >= 1.0:
+                with self.lock:
+                    remaining = [a for a in self.actions if a.resource == 'memory' and not a.exhausted]
+                if acted or remaining:
+                    self.over_since = None
+                elif self.over_since is None:
+                    self.over_since = now
+                elif now - self.over_since >= self.grace_s and not self.exceeded:
+                    self.exceeded = True
+                    self._log(None, resource, u, 'over budget with nothing left to degrade, failing the job at its next checkpoint')
+
+    def _log(self, action, resource, usage, detail):
+        d = {
+            'seconds': round(time.time() - self.started, 3),
+            'action': action.name if action else 'abort',
+            'resource': resource,
+            'usage_of_budget': round(usage, 3),
+            'rss_mb': round(self.rss / 1024 / 1024, 1),
+            'cpu_percent': round(self.cpu, 1),
+            'detail': detail,
+        }
+        self.decisions.append(d)
+        print(f"Resource governor: {resource} at {usage:.0%} of budget, {d['action']}: {detail}")
+        self.record()
+
+    def record(self):
+        TaskMetrics(self.tp).record('governor', {
+            'memory_budget_mb': self.budgets['memory'] / 1024 / 1024 if self.budgets['memory'] else None,
+            'cpu_budget_percent': self.budgets['cpu'],
+            'samples': self.samples,
+            'peak_rss_mb': round(self.peak_rss / 1024 / 1024, 1),
+            'peak_cpu_percent': round(self.peak_cpu, 1),
+            'mean_cpu_percent': round(100 * self.cpu_total / (time.time() - self.started), 1) if self.started and time.time() > self.started else None,
+            'decisions': self.decisions,
+        })
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval_s):
+            try:
+                self._tick()
+            except Exception as e:
+                print(f'Resource governor sample failed: {e!r}')
+
+    def start(self):
+        global _CURRENT
+        self.started = time.time()
+        self.cpu_start = readCpuSeconds()
+        self.sample()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        _CURRENT = self
+        return self
+
+    def stop(self):
+        global _CURRENT
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.cpu_total = readCpuSeconds() - self.cpu_start
+        if _CURRENT is self:
+            _CURRENT = None
+        self.record()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _NullGovernor:
+    # what currentGovernor() returns when no job is being governed, so callers don't need to check
+
+    def add_action(self, *args, **kwargs):
+        return None
+
+    def remove_action(self, handle):
+        pass
+
+    def checkpoint(self):
+        pass
+
+
+_CURRENT = None
+_NULL = _NullGovernor()
+
+
+def currentGovernor():
+    """The governor of the running job, or a no-op stand-in."""
+    return _CURRENT or _NULL
+
+
+def governorFor(tp: TaskProps) -> ResourceGovernor:
+    """
+    A governor with the budgets from the config: MEMORY_BUDGET_MB and CPU_BUDGET_PERCENT.  Without either, it
+    only monitors and records peak usage.
+    """
+    c = Config()
+    return ResourceGovernor(
+        tp,
+        memory_mb=c.get_optional_param('MEMORY_BUDGET_MB'),
+        cpu_percent=c.get_optional_param('CPU_BUDGET_PERCENT'),
+        interval_s=float(c.get_optional_param('GOVERNOR_INTERVAL_SECONDS', 0.5)),
+    )
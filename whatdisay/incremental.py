@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps, TaskMetrics
+from whatdisay.config import Config
+from whatdisay.pipeline import buildTranscriptionGraph, governed
+from whatdisay.stages import fileFingerprint
+from whatdisay.search import indexTranscript
+from whatdisay.upload import WavSource, wavHeader
+import collections
+import hashlib
+import json
+import os
+import re
+
+
+def sourceId(wav_file) -> str:
+    return hashlib.sha256(os.path.realpath(wav_file).encode('utf-8')).hexdigest()[:24]
+
+
+def prefixHashes(source: WavSource, nframes: list, block_frames=1024 * 1024) -> list:
+    """
+    Content hashes of the first n frames of the audio, for each n in nframes, computed in a single pass.
+    """
+    h = hashlib.sha256(f'{source.channels}:{source.sample_width}:{source.frame_rate}'.encode('ascii'))
+    hashes = {}
+    pos = 0
+    for n in sorted(set(nframes)):
+        while pos < n:
+            k = min(block_frames, n - pos)
+            h.update(source.read_frames(pos, k))
+            pos += k
+        hashes[n] = h.copy().hexdigest()
+    return [hashes[n] for n in nframes]
+
+
+def reconcileSpeakers(old_turns: list, new_turns: list, start: float, end: float, labels: list) -> dict:
+    """
+    Map the speaker labels of a newly diarized tail onto the labels used for the earlier part of the recording.
+
+    Each new speaker is matched to the earlier speaker it shares the most talk time with inside the overlap
+    [start, end], greedily and one-to-one.  New speakers without a match keep their label unless it's already in
+    use, in which case they get the next unused one.
+    """
+    overlaps = collections.Counter()
+    for n in new_turns:
+        for o in old_turns:
+            ov = min(float(n[1]), float(o[1]), end) - max(float(n[0]), float(o[0]), start)
+            if ov > 0:
+                overlaps[(n[2], o[2])] += ov
+
+    mapping = {}
+    taken = set()
+    for (new, old), ov in overlaps.most_common():
+        if new not in mapping and old not in taken:
+            mapping[new] = old
+            taken.add(old)
+
+    used = set(labels) | taken
+    for new in sorted({t[2] for t in new_turns}):
+        if new in mapping:
+            continue
+        label = new if new not in used else _nextLabel(new, used)
+        mapping[new] = label
+        used.add(label)
+
+    return mapping
+
+
+def _nextLabel(label: str, used: set) -> str:
+    m = re.match(r'^(.*?)(\d+)$', label)
+    prefix, width = (m.group(1), len(m.group(2))) if m else (label + '_', 1)
+    n = 0
+    while f'{prefix}{n:0{width}d}' in used:
+        n += 1
+    return f'{prefix}{n:0{width}d}'
+
+
+def _shift(rows: list, offset: float, mapping: dict) -> list:
+    return [[float(r[0]) + offset, float(r[1]) + offset, mapping.get(r[2], r[2])] + list(r[3:]) for r in rows]
+
+
+def transcribeIncremental(wav_file, tp: TaskProps, mode: str, whisper_model: str = None, use_cache=True, failure_policy: str = None, speakers: dict = None) -> str:
+    """
+    Transcribe only the part of a recording that is new since the last incremental run, and append it to the
+    transcript from the earlier runs.  For recordings that are still being written or that grow in parts.
+
+    What has been processed is remembered per source file, along with a content hash of the processed prefix, so
+    a file whose earlier audio changed is transcribed from scratch.  Each run diarizes and transcribes the new
+    tail plus INCREMENTAL_OVERLAP_SECONDS (default 30) of audio before it, and maps the tail's speaker labels
+    onto the earlier ones by who talks when in the overlap.
+
+    Segments that run up to the end of the audio are probably cut off, so they're held back and transcribed again
+    with the next tail.  Running again after the recording has stopped growing appends the held-back segments.
+
+    failure_policy and speakers are as for buildTranscriptionGraph; speaker counts constrain each tail's
+    diarization on its own.
+
+    Returns the path of the transcript.
+    """
+    c = Config()
+    overlap_s = float(c.get_optional_param('INCREMENTAL_OVERLAP_SECONDS', 30))
+    holdback_s = float(c.get_optional_param('INCREMENTAL_HOLDBACK_SECONDS', 1.0))
+
+    state_file = os.path.join(tp.incremental_dir, sourceId(wav_file) + '.json')
+    state = None
+    if os.path.exists(state_file):
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+
+    with WavSource(wav_file) as source:
+        total = source.nframes
+        if state and (state['mode'], state['whisper_model']) != (mode, whisper_model):
+            print(f"{wav_file} was transcribed incrementally with different settings before.  Starting over.")
+            state = None
+        if state and state['frames'] > total:
+            print(f'{wav_file} is shorter than when it was last transcribed.  Starting over.')
+            state = None
+
+        if state:
+            old_hash, new_hash = prefixHashes(source, [state['frames'], total])
+            if old_hash != state['prefix_sha256']:
+                print(f'The audio transcribed earlier in {wav_file} has changed.  Starting over.')
+                state = None
+        else:
+            new_hash = prefixHashes(source, [total])[0]
+
+        end_s = total / source.frame_rate
+        output_file = state['output_file'] if state else os.path.join(tp.diarized_transcriptions_dir, tp.task_name + '.txt')
+
+        if state and total == state['frames']:
+            # Nothing new since the last run, so the recording is presumably done: flush what was held back.
+            _append(tp, output_file, state['pending'])
+            print(f"No new audio in {wav_file}.  Appended {len(state['pending'])} held-back segments to {output_file}")
+            state['pending'] = []
+            state['committed_until'] = end_s
+            _saveState(state_file, state)
+            return output_file
+
+        committed_until = state['committed_until'] if state else 0.0
+        start_s = max(committed_until - overlap_s, 0.0)
+        start_frame = source.frame_at(start_s)
+        start_s = start_frame / source.frame_rate
+
+        # a standalone wav of the tail, with a header that matches its length even if the source's doesn't yet
+        tail = tp.tmp_files + 'incremental_tail.wav'
+        with tp.storage.open(tail, 'wb') as f:
+            f.write(wavHeader(total - start_frame, source.channels, source.sample_width, source.frame_rate))
+            block = 1024 * 1024
+            for pos in range(start_frame, total, block):
+                f.write(source.read_frames(pos, min(block, total - pos)))
+
+    tail_file = tp.storage.local_path(tail)
+    print(f'Transcribing {wav_file} from {start_s:.1f}s to {end_s:.1f}s ({committed_until:.1f}s already transcribed).')
+    graph = buildTranscriptionGraph(tp, mode, whisper_model, failure_policy, speakers, reuse_embeddings=use_cache, reuse_segments=use_cache)
+    with governed(tp):
+        values = graph.run({'wav_file': tail_file}, {'wav_file': fileFingerprint(tail_file)}, use_cache=use_cache, outputs=['turns', 'transcript'])
+
+    turns = _shift(values['turns'], start_s, {})
+    mapping = reconcileSpeakers(state['turns'] if state else [], turns, start_s, committed_until, state['labels'] if state else [])
+    turns = _shift(turns, 0.0, mapping)
+    rows = [r for r in _shift(values['transcript'], start_s, mapping) if r[0] >= committed_until - 0.01]
+
+    # Hold back everything from the first segment that runs into the end of the audio onwards.
+    cut = min((r[0] for r in rows if r[1] >= end_s - holdback_s), default=end_s)
+    commit = [r for r in rows if r[0] < cut]
+    pending = [r for r in rows if r[0] >= cut]
+
+    if not state:
+        tp.createTaskDir(tp.diarized_transcriptions_dir)
+        open(output_file, 'w', encoding='utf-8').close()
+    _append(tp, output_file, commit)
+
+    renamed = {k: v for k, v in mapping.items() if k != v}
+    print(f'Appended {len(commit)} segments to {output_file}, holding back {len(pending)}.' + (f'  Speaker labels mapped: {renamed}' if renamed else ''))
+
+    _saveState(state_file, {
+        'source': os.path.realpath(wav_file),
+        'mode': mode,
+        'whisper_model': whisper_model,
+        'output_file': output_file,
+        'frames': total,
+        'prefix_sha256': new_hash,
+        'seconds': end_s,
+        'committed_until': cut,
+        'pending': pending,
+        'turns': [t for t in turns if t[1] >= cut - 2 * overlap_s],
+        'labels': sorted(set(state['labels'] if state else []) | {t[2] for t in turns}),
+    })
+    TaskMetrics(tp).record('incremental', {
+        'tail_start': round(start_s, 3),
+        'tail_seconds': round(end_s - start_s, 3),
+        'recording_seconds': round(end_s, 3),
+        'appended': len(commit),
+        'held_back': len(pending),
+    })
+    return output_file
+
+
+def _append(tp, output_file, rows):
+    offset = os.path.getsize(output_file)
+    with open(output_file, 'a', encoding='utf-8') as f:
+        for r in rows:
+            f.write(f'{r[2]}: {r[3]}\n')
+    indexTranscript(tp, output_file, rows, offset)
+
+
+def _saveState(state_file, state):
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(tmp, state_file)
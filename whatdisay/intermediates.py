@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps
+import numpy as np
+import io
+import json
+import os
+
+
+TURNS = 'turns'
+SEGMENTS = 'segments'
+WORDS = 'words'
+
+
+class TextColumn:
+    """
+    A column of strings stored as one UTF-8 byte buffer plus row offsets, so it can be memory-mapped
+    like the numeric columns.  Rows are only decoded when they are accessed.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        return list(self)
+
+
+class TaskStore:
+    """
+    Compact columnar store for the intermediate artifacts of a task (diarization turns, transcript segments, words).
+
+    Every table is a directory under the task's intermediates holding one '.npy' file per column.  Numeric
+    columns are plain arrays; text columns are a byte buffer ('<col>.text.npy') plus offsets ('<col>.offsets.npy').
+    Keeping one file per column (rather than a single '.npz') means each column can be memory-mapped on its own and
+    readers only touch the columns they ask for.  Columns are only memory-mapped when the task storage keeps
+    them on a real filesystem.
+
+    Parameters
+    ----------
+    tp: TaskProps
+        An instantiated utils.TaskProps class that provides all the necessary directory names.
+    """
+
+    def __init__(self, tp: TaskProps):
+        if not type(tp) == TaskProps:
+            raise ValueError('Parameter tp must be of type TaskProps.')
+        self.tp = tp
+        self.storage = tp.storage
+        self.root = tp.intermediates
+
+    def table_dir(self, name):
+        return os.path.join(self.root, name)
+
+    def tables(self) -> list:
+        return [d for d in self.storage.listdir(self.root) if self.storage.isdir(self.table_dir(d))]
+
+    def has_table(self, name) -> bool:
+        return self.storage.isdir(self.table_dir(name))
+
+    def columns(self, name) -> list:
+        cols = []
+        for f in self.storage.listdir(self.table_dir(name)):
+            if f.endswith('.offsets.npy'):
+                continue
+            cols.append(f[:-len('.text.npy')] if f.endswith('.text.npy') else f[:-len('.npy')])
+        return cols
+
+    def write_table(self, name, columns: dict):
+        """
+        Write a table, replacing it if it already exists.  Columns holding strings are stored as text columns,
+        everything else is stored as a numpy array.
+        """
+        lengths = {len(v) for v in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f'All columns of table {name} must have the same length.')
+
+        d = self.table_dir(name)
+        self.storage.remove(d)
+        self.storage.makedirs(d)
+
+        for col, values in columns.items():
+            if isinstance(values, TextColumn) or (len(values) and isinstance(values[0], str)):
+                encoded = [str(v).encode('utf-8') for v in values]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum([len(e) for e in encoded])
+                self._save(os.path.join(d, col + '.text.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+                self._save(os.path.join(d, col + '.offsets.npy'), offsets)
+            else:
+                self._save(os.path.join(d, col + '.npy'), np.asarray(values))
+
+    def _save(self, name, arr):
+        with self.storage.open(name, 'wb') as f:
+            np.save(f, arr)
+
+    def _load(self, name, mmap):
+        path = self.storage.mmap_path(name) if mmap else None
+        if path:
+            return np.load(path, mmap_mode='r')
+        return np.load(io.BytesIO(self.storage.read_bytes(name)))
+
+    def read_table(self, name, columns=None, mmap=True) -> dict:
+        """
+        Read some or all columns of a table.  With mmap set, columns are memory-mapped instead of loaded.
+        """
+        if not self.has_table(name):
+            raise FileNotFoundError(f'No intermediate table named {name} for task: {self.tp.task_name}')
+
+        d = self.table_dir(name)
+        out = {}
+        for col in columns or self.columns(name):
+            text_file = os.path.join(d, col + '.text.npy')
+            if self.storage.exists(text_file):
+                out[col] = TextColumn(self._load(text_file, mmap), self._load(os.path.join(d, col + '.offsets.npy'), mmap))
+            else:
+                out[col] = self._load(os.path.join(d, col + '.npy'), mmap)
+        return out
+
+    def rows(self, name, columns=None) -> list:
+        t = self.read_table(name, columns)
+        cols = list(t.keys())
+        n = len(t[cols[0]]) if cols else 0
+        return [{c: _plain(t[c][i]) for c in cols} for i in range(n)]
+
+    def export(self, name, fmt='json', path=None) -> str:
+        """
+        Write a human-readable copy of a table ('json', 'txt' or 'vtt'), either to the given path or next to the
+        columnar data in the task storage.
+        """
+        rows = self.rows(name)
+        if path:
+            f = open(path, 'w', encoding='utf-8')
+        else:
+            path = os.path.join(self.root, f'{name}.{fmt}')
+            f = self.storage.open(path, 'w')
+
+        with f:
+            if fmt == 'json':
+                json.dump(rows, f, ensure_ascii=False, indent=4)
+            elif fmt == 'txt':
+                for r in rows:
+                    speaker = f"{r['speaker']}: " if 'speaker' in r else ''
+                    f.write(f"{speaker}{r.get('text', r.get('word', ''))}\n")
+            elif fmt == 'vtt':
+                f.write('WEBVTT\n\n')
+                for r in rows:
+                    f.write(f"{_vtt_ts(r['start'])} --> {_vtt_ts(r['end'])}\n{r.get('text', r.get('word', ''))}\n\n")
+            else:
+                raise ValueError(f'Unsupported export format: {fmt}')
+
+        print(f'Exported intermediate table {name} at: {path}')
+        return path
+
+    def export_all(self, fmt='json'):
+        return [self.export(t, fmt) for t in self.tables()]
+
+
+def _plain(v):
+    return v.item() if isinstance(v, np.generic) else v
+
+
+def _vtt_ts(seconds) -> str:
+    ms = int(round(float(seconds) * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f'{h:02d}:{m:02d}:{s:02d}.{ms:03d}'
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class LeaseLost(Exception):
+    """
+    Raised when a worker touches a job whose lease expired and was handed to another worker.
+    """
+
+
+class JobQueue:
+    """
+    A work queue in a SQLite database, shared by a coordinator and any number of workers.
+
+    Workers claim a job by taking a lease on it, keep the lease alive with heartbeats while they work, and write
+    the result back when they're done.  A job whose lease runs out (its worker crashed, hung or lost its host) goes
+    back to the queue and is claimed by the next worker, up to max_attempts times.
+
+    The database file has to be reachable by every host, e.g. on a shared filesystem, and so do the recordings
+    the jobs point at.  Claims are serialized with SQLite's write lock, which is fine for a handful of jobs per
+    second but relies on the shared filesystem honoring file locks.  The database uses a rollback journal rather
+    than WAL, since WAL's shared-memory index only works for processes on the same host.
+
+    Parameters
+    ----------
+    db_path: str
+        Path of the queue database.  It's created if it doesn't exist.
+
+    max_attempts: int
+        How many times a job is handed out before it's marked as failed.
+    """
+
+    def __init__(self, db_path: str, max_attempts=3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with contextlib.closing(self._connect()) as con:
+            # also switches queues created in WAL mode back, workers on other hosts can't share its -shm index
+            con.execute('PRAGMA journal_mode=DELETE')
+            con.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    batch TEXT NOT NULL,
+                    part INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            ''')
+            con.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)')
+            con.execute('CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch, part)')
+
+    def _connect(self):
+        # autocommit mode, so transactions are only the explicit BEGIN IMMEDIATE blocks, and callers close the
+        # connection when they're done with it (a sqlite3 connection's own context manager doesn't)
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def submit(self, batch: str, part: int, kind: str, payload: dict) -> int:
+        now = time.time()
+        with contextlib.closing(self._connect()) as con:
+            cur = con.execute(
+                'INSERT INTO jobs (batch, part, kind, payload, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (batch, part, kind, json.dumps(payload), now, now)
+            )
+            return cur.lastrowid
+
+    def claim(self, worker: str, lease_s=60.0):
+        """
+        Lease the oldest job that is pending or whose lease has expired.  Returns the job as a dict, or None when
+        there's nothing to do.
+        """
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            # jobs that keep losing their lease are given up on rather than handed out forever
+            con.execute(
+                "UPDATE jobs SET status = ?, error = 'lease expired too many times', updated = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, self.max_attempts)
+            )
+            row = con.execute(
+                'SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1',
+                (PENDING, LEASED, now)
+            ).fetchone()
+            if row is None:
+                con.execute('COMMIT')
+                return None
+            con.execute(
+                'UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?',
+                (LEASED, worker, now + lease_s, now, row[0])
+            )
+            con.execute('COMMIT')
+            return self.job(row[0])
+        except Exception:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+
+    def _update_leased(self, job_id: int, worker: str, sql: str, params: tuple):
+        with contextlib.closing(self._connect()) as con:
+            cur = con.execute(sql + ' WHERE id = ? AND status = ? AND worker = ?', params + (job_id, LEASED, worker))
+            if cur.rowcount == 0:
+                raise LeaseLost(f'Job {job_id} is no longer leased to worker {worker}.')
+
+    def heartbeat(self, job_id: int, worker: str, lease_s=60.0):
+        """Extend a job's lease.  Raises LeaseLost if the job was handed to another worker in the meantime."""
+        now = time.time()
+        self._update_leased(job_id, worker, 'UPDATE jobs SET lease_expires = ?, updated = ?', (now + lease_s, now))
+
+    def complete(self, job_id: int, worker: str, result):
+        self._update_leased(
+            job_id, worker, 'UPDATE jobs SET status = ?, result = ?, error = NULL, updated = ?',
+            (DONE, json.dumps(result), time.time())
+        )
+
+    def fail(self, job_id: int, worker: str, error: str):
+        """Give a job back after an error.  It's retried by the next claim until it runs out of attempts."""
+        job = self.job(job_id)
+        status = FAILED if job and job['attempts'] >= self.max_attempts else PENDING
+        self._update_leased(
+            job_id, worker, 'UPDATE jobs SET status = ?, error = ?, lease_expires = NULL, updated = ?',
+            (status, str(error), time.time())
+        )
+
+    def job(self, job_id: int):
+        with contextlib.closing(self._connect()) as con:
+            con.row_factory = sqlite3.Row
+            row = con.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return _jobDict(row) if row else None
+
+    def jobs(self, batch: str) -> list:
+        with contextlib.closing(self._connect()) as con:
+            con.row_factory = sqlite3.Row
+            rows = con.execute('SELECT * FROM jobs WHERE batch = ? ORDER BY part', (batch,)).fetchall()
+        return [_jobDict(r) for r in rows]
+
+    def counts(self, batch: str = None) -> dict:
+        sql = 'SELECT status, COUNT(*) FROM jobs' + (' WHERE batch = ?' if batch else '') + ' GROUP BY status'
+        with contextlib.closing(self._connect()) as con:
+            return dict(con.execute(sql, (batch,) if batch else ()).fetchall())
+
+    def remove_batch(self, batch: str):
+        with contextlib.closing(self._connect()) as con:
+            con.execute('DELETE FROM jobs WHERE batch = ?', (batch,))
+
+
+def _jobDict(row) -> dict:
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    job['result'] = json.loads(job['result']) if job['result'] is not None else None
+    return job
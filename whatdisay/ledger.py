@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+from whatdisay.stages import hashValue
+import json
+import os
+import threading
+
+
+class SegmentLedger:
+    """
+    Append-only record of per-segment transcription results for one recording, written as each result arrives.
+
+    The ledger lives outside the task's tmp files (under the output 'partial' dir, keyed by the recording's
+    content hash) so that after a failed or interrupted run, a retry of the same recording only has to redo
+    the segments that are missing or failed and can merge in the rest.
+
+    Parameters
+    ----------
+    partial_dir: str
+        Directory ledgers are kept in.
+
+    recording_id: str
+        Content hash of the recording.
+
+    engine: str
+        What produced the results (e.g. 'deepgram-whisper').  Results from another engine aren't reused.
+    """
+
+    def __init__(self, partial_dir: str, recording_id: str, engine: str):
+        self.dir = os.path.join(partial_dir, recording_id)
+        self.file = os.path.join(self.dir, engine + '.jsonl')
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self) -> dict:
+        entries = {}
+        if not os.path.exists(self.file):
+            return entries
+        with open(self.file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except json.JSONDecodeError:
+                    # a run killed mid-write can leave a truncated last line
+                    continue
+                entries[e['key']] = e
+        return entries
+
+    @staticmethod
+    def key(segment) -> str:
+        return hashValue([round(float(segment[0]), 3), round(float(segment[1]), 3), str(segment[2])])[:24]
+
+    def completed(self, segment):
+        """The stored result for a segment if it was transcribed successfully before, else None."""
+        e = self.entries.get(self.key(segment))
+        return e if e and e['status'] == 'ok' else None
+
+    def record(self, i, segment, text=None, error=None):
+        e = {
+            'key': self.key(segment),
+            'i': i,
+            'start': float(segment[0]),
+            'end': float(segment[1]),
+            'speaker': str(segment[2]),
+            'status': 'failed' if error is not None else 'ok',
+            'text': text or '',
+            'error': str(error) if error is not None else None,
+        }
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            with open(self.file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(e, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[e['key']] = e
+
+    def failed(self) -> list:
+        return [e for e in self.entries.values() if e['status'] == 'failed']
+
+    def clear(self):
+        if os.path.exists(self.file):
+            os.remove(self.file)
+        self.entries = {}
+
+    def discard(self, segments):
+        """
+        Forget the results of these segments, and remove the ledger once it's empty.  Other runs over the same
+        recording (e.g. distributed jobs transcribing other ranges of it) keep theirs.
+        """
+        keys = {self.key(s) for s in segments}
+        with self.lock:
+            self.entries = {k: e for k, e in self.entries.items() if k not in keys}
+            if not self.entries:
+                if os.path.exists(self.file):
+                    os.remove(self.file)
+                return
+            tmp = self.file + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for e in self.entries.values():
+                    f.write(json.dumps(e, ensure_ascii=False) + '\n')
+            os.replace(tmp, self.file)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps, TaskMetrics
+from whatdisay.config import ENV_PREFIX
+from whatdisay.deepgram_stub import DeepgramStub, addStubArguments, stubSettingsFromArgs
+import whatdisay.transcribe as transcribe
+from whatdisay.diarize import Diarize
+import numpy as np
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import time
+import wave
+
+
+def synthesizeRecording(path, seconds: float, speakers=2, frame_rate=16000, seed=0):
+    """
+    Write a wav file that looks like a conversation to the stub: turns of 2-8 seconds, each a tone at its
+    speaker's pitch with a syllable-rate tremolo, separated by short near-silent gaps.
+    """
+    rng = np.random.default_rng(seed)
+    pitches = [140 + 90 * i for i in range(speakers)]
+    pieces = []
+    t = 0.0
+    speaker = 0
+    while t < seconds:
+        gap = rng.uniform(0.3, 1.0)
+        turn = min(rng.uniform(2.0, 8.0), max(seconds - t - gap, 0.0))
+        pieces.append(rng.normal(0, 30, int(gap * frame_rate)))
+        n = np.arange(int(turn * frame_rate)) / frame_rate
+        tremolo = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * n)
+        pieces.append(8000 * tremolo * np.sin(2 * np.pi * pitches[speaker] * n))
+        t += gap + turn
+        speaker = (speaker + rng.integers(1, speakers)) % speakers if speakers > 1 else 0
+
+    x = np.clip(np.concatenate(pieces), -32768, 32767).astype(np.int16)
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(frame_rate)
+        w.writeframes(x.tobytes())
+    return path
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    v = np.asarray(values)
+    return {
+        'p50': round(float(np.percentile(v, 50)), 4),
+        'p95': round(float(np.percentile(v, 95)), 4),
+        'p99': round(float(np.percentile(v, 99)), 4),
+        'max': round(float(v.max()), 4),
+    }
+
+
+class _Env:
+    # point the real client code at the stub through the config's environment overrides
+    def __init__(self, values: dict):
+        self.values = {ENV_PREFIX + k: str(v) for k, v in values.items()}
+        self.saved = {}
+
+    def __enter__(self):
+        for k, v in self.values.items():
+            self.saved[k] = os.environ.get(k)
+            os.environ[k] = v
+
+    def __exit__(self, *exc):
+        for k, v in self.saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def _summarize(stub: DeepgramStub, wall: float, units: int, failed: int, audio_seconds: float) -> dict:
+    s = stub.stats.snapshot()
+    ok = [r['latency'] for r in s['requests'] if r['status'] == 200]
+    return {
+        'wall_seconds': round(wall, 3),
+        'requests': len(s['requests']),
+        'statuses': s['statuses'],
+        'failed': failed,
+        'throughput_per_s': round((units - failed) / wall, 3) if wall else None,
+        'audio_seconds_per_s': round(audio_seconds / wall, 3) if wall else None,
+        'mb_per_s': round(sum(r['bytes'] for r in s['requests']) / (1024 * 1024) / wall, 3) if wall else None,
+        'latency': percentiles(ok),
+        'server_peak_in_flight': s['peak_in_flight'],
+    }
+
+
+def runSegmentsLoad(stub, wav_file, duration, segment_seconds, concurrency, work_dir) -> dict:
+    """
+    One run of the real segment fan-out (transcribe.transcribeSegmentsDeepgram) against the stub.
+    """
+    segments = []
+    t = 0.0
+    while t < duration:
+        segments.append([t, min(t + segment_seconds, duration), f'Speaker_{len(segments) % 2}', ''])
+        t += segment_seconds
+
+    out = os.path.join(work_dir, f'segments_c{concurrency}_s{segment_seconds:g}')
+    tp = TaskProps(f'loadtest_c{concurrency}_s{segment_seconds:g}', out)
+    tp.createAllTaskDirectories()
+    stub.stats.reset()
+
+    # every segment has to reach the stub: the synthesized speech repeats, so dedupe would skip some of it
+    with _Env({'DEEPGRAM_MAX_CONCURRENCY': concurrency, 'DEEPGRAM_FAILURE_POLICY': 'continue', 'FINGERPRINT_DEDUPE': 'false'}):
+        started = time.time()
+        rows = asyncio.run(transcribe.transcribeSegmentsDeepgram(wav_file, segments, tp))
+        wall = time.time() - started
+
+    failed = sum(1 for r in rows if r[3] == transcribe.FAILED_SEGMENT_TEXT)
+    result = _summarize(stub, wall, len(segments), failed, duration)
+    result.update({
+        'workload': 'segments',
+        'concurrency': concurrency,
+        'payload_seconds': segment_seconds,
+        'units': len(segments),
+        'client_peak_in_flight_bytes': TaskMetrics(tp).load().get('upload', {}).get('peak_in_flight_bytes'),
+    })
+    shutil.rmtree(out, ignore_errors=True)
+    return result
+
+
+def runDiarizeLoad(stub, wav_file, duration, concurrency, work_dir) -> dict:
+    """
+    concurrency simultaneous runs of the real whole-file diarization request (Diarize.diarize_deepgram).
+    """
+    out = os.path.join(work_dir, f'diarize_c{concurrency}_s{duration:g}')
+    tps = [TaskProps(f'loadtest_diarize_{i}', out) for i in range(concurrency)]
+    for tp in tps:
+        tp.createAllTaskDirectories()
+    stub.stats.reset()
+
+    async def one(tp):
+        try:
+            await Diarize(tp).diarize_deepgram(wav_file)
+            return 0
+        except Exception as e:
+            print(f'Diarization request failed: {e!r}')
+            return 1
+
+    async def run_all():
+        return await asyncio.gather(*[one(tp) for tp in tps])
+
+    started = time.time()
+    failed = sum(asyncio.run(run_all()))
+    wall = time.time() - started
+
+    result = _summarize(stub, wall, concurrency, failed, duration * concurrency)
+    result.update({'workload': 'diarize', 'concurrency': concurrency, 'payload_seconds': duration, 'units': concurrency})
+    shutil.rmtree(out, ignore_errors=True)
+    return result
+
+
+def plotResults(results: list, out_dir) -> list:
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, skipping the plots.  The results are in loadtest.json.')
+        return []
+
+    files = []
+    for workload in sorted({r['workload'] for r in results}):
+        rs = [r for r in results if r['workload'] == workload]
+        fig, (ax_tp, ax_lat) = plt.subplots(1, 2, figsize=(12, 4.5))
+        for payload in sorted({r['payload_seconds'] for r in rs}):
+            pts = sorted((r for r in rs if r['payload_seconds'] == payload), key=lambda r: r['concurrency'])
+            c = [r['concurrency'] for r in pts]
+            ax_tp.plot(c, [r['audio_seconds_per_s'] for r in pts], marker='o', label=f'{payload:g}s payloads')
+            ax_lat.plot(c, [r['latency']['p50'] for r in pts], marker='o', linestyle=':', label=f'{payload:g}s p50')
+            ax_lat.plot(c, [r['latency']['p99'] for r in pts], marker='o', label=f'{payload:g}s p99')
+        for ax in (ax_tp, ax_lat):
+            ax.set_xscale('log', base=2)
+            ax.set_xlabel('concurrency')
+            ax.legend()
+            ax.grid(True, alpha=0.3)
+        ax_tp.set_ylabel('audio seconds transcribed per second')
+        ax_lat.set_ylabel('request latency (s)')
+        fig.suptitle(f'{workload} against the Deepgram stub')
+        fig.tight_layout()
+        f = os.path.join(out_dir, f'loadtest_{workload}.png')
+        fig.savefig(f)
+        plt.close(fig)
+        files.append(f)
+        print(f'Saved plot at: {f}')
+    return files
+
+
+def runSweep(stub, concurrency: list, segment_seconds: list, diarize_seconds: list, recording_seconds: float, out_dir) -> list:
+    os.makedirs(out_dir, exist_ok=True)
+    work_dir = os.path.join(out_dir, 'runs')
+    results = []
+
+    with _Env({'DEEPGRAM_API_URL': stub.url, 'DEEPGRAM_API_KEY': 'stub', 'DEEPGRAM_MODEL': 'meeting'}):
+        recording = synthesizeRecording(os.path.join(out_dir, f'synthetic_{recording_seconds:g}s.wav'), recording_seconds)
+        for s in segment_seconds:
+            for c in concurrency:
+                r = runSegmentsLoad(stub, recording, recording_seconds, s, c, work_dir)
+                print(f"segments {s:g}s x{c}: {r['audio_seconds_per_s']} audio s/s, p99 {r['latency']['p99']}s, {r['failed']} failed")
+                results.append(r)
+
+        for d in diarize_seconds:
+            f = synthesizeRecording(os.path.join(out_dir, f'synthetic_{d:g}s.wav'), d, seed=1)
+            for c in concurrency:
+                r = runDiarizeLoad(stub, f, d, c, work_dir)
+                print(f"diarize {d:g}s x{c}: {r['audio_seconds_per_s']} audio s/s, p99 {r['latency']['p99']}s, {r['failed']} failed")
+                results.append(r)
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    with open(os.path.join(out_dir, 'loadtest.json'), 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Saved load test results at: {os.path.join(out_dir, 'loadtest.json')}")
+    plotResults(results, out_dir)
+    return results
+
+
+def _floats(s: str) -> list:
+    return [float(v) for v in s.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test the Deepgram client code against a local stub, sweeping concurrency and payload size.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--concurrency', default='1,4,16,64', help="Comma-separated concurrency levels.")
+    parser.add_argument('--segment_seconds', default='2,10,30', help="Comma-separated segment lengths for the segment fan-out.")
+    parser.add_argument('--diarize_seconds', default='60,600', help="Comma-separated recording lengths for whole-file diarization requests (empty to skip).")
+    parser.add_argument('--recording_seconds', type=float, default=300.0, help="Length of the synthetic recording the segments are cut from.")
+    parser.add_argument('--out', default=os.path.join('output', 'loadtest'), help="Where to write results and plots.")
+    addStubArguments(parser)
+    args = parser.parse_args()
+
+    with DeepgramStub(stubSettingsFromArgs(args)) as stub:
+        print(f'Deepgram stub listening at {stub.url}')
+        runSweep(
+            stub, [int(c) for c in _floats(args.concurrency)], _floats(args.segment_seconds),
+            _floats(args.diarize_seconds), args.recording_seconds, args.out
+        )
+
+
+if __name__ == '__main__':
+    main()
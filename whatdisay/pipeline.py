@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps, TaskMetrics
+from whatdisay.channels import channelLayout, channelTurns, transcribeChannels
+from whatdisay.config import Config
+from whatdisay.diarize import Diarize, evictPipelines
+from whatdisay.decode import evictWhisperModels
+from whatdisay.governor import governorFor
+from whatdisay.intermediates import TaskStore, TURNS
+from whatdisay.stages import Stage, StageGraph, PARTIAL, fileFingerprint
+from whatdisay.upload import WavSource
+from whatdisay.vad import detectSpeech, overlap
+import whatdisay.transcribe as transcribe
+import asyncio
+import contextlib
+
+
+# --diarize value -> (diarization model, transcription engine)
+MODES = {
+    'pyannote': ('pyannote', 'whisper'),
+    'whisper_local': ('deepgram', 'whisper'),
+    'deepgram': ('deepgram', 'deepgram'),
+    # one speaker per channel: turns come from each channel's energy, no diarization model runs
+    'channels': ('channels', 'whisper'),
+    'channels_deepgram': ('channels', 'deepgram'),
+}
+
+
+def decodeStage(wav_file):
+    with WavSource(wav_file) as source:
+        audio = {
+            'duration': source.duration,
+            'frame_rate': source.frame_rate,
+            'channels': source.channels,
+            'sample_width': source.sample_width,
+        }
+    print(f"Decoded {wav_file}: {audio['duration']:.1f}s, {audio['channels']} channel(s) at {audio['frame_rate']}Hz")
+    return {'audio': audio}
+
+
+def vadStage(wav_file, audio, margin_db, min_silence_s):
+    speech = detectSpeech(wav_file, margin_db=margin_db, min_silence_s=min_silence_s)
+    print(f'Detected {len(speech)} speech regions covering {sum(r[1] - r[0] for r in speech):.1f}s of {audio["duration"]:.1f}s')
+    return {'speech': speech}
+
+
+def diarizeStage(wav_file, audio, diarizer, tp, deepgram_model=None, speakers=None, reuse_embeddings=True):
+    if diarizer == 'pyannote':
+        # with cached embeddings for the recording, a different speaker count only re-runs the clustering
+        s = speakers or {}
+        turns = Diarize(tp).pyannote_segments(
+            wav_file, s.get('num_speakers'), s.get('min_speakers'), s.get('max_speakers'), reuse_embeddings
+        )
+    elif diarizer == 'channels':
+        with WavSource(wav_file) as source:
+            turns = channelTurns(source)
+        print(f"Found {len(turns)} turns on {audio['channels']} channels.")
+    else:
+        turns = asyncio.run(transcribe.diarizeDeepgram(wav_file, tp))
+    return {'turns': turns}
+
+
+def segmentStage(turns, speech, min_segment_s):
+    # Turns the diarizer already heard words in are always kept, however short ("Yes.").  Other turns are dropped
+    # when no speech was detected in them, or when they're too short to transcribe.
+    segments, silent, short = [], 0, 0
+    for t in turns:
+        if not t[3]:
+            if overlap(float(t[0]), float(t[1]), speech) <= 0:
+                silent += 1
+                continue
+            if float(t[1]) - float(t[0]) < min_segment_s:
+                short += 1
+                continue
+        segments.append(t)
+    if silent:
+        print(f'Skipping {silent} diarized segments without speech.')
+    if short:
+        print(f'Skipping {short} diarized segments shorter than {min_segment_s}s.')
+    return {'segments': segments}
+
+
+def transcribeStage(wav_file, segments, engine, whisper_model, decode, tp, failure_policy=None, per_channel=False, reuse_segments=True):
+    # the decode settings are read from config by newDecodeSession, they're params here so they're fingerprinted
+    if per_channel:
+        rows = transcribeChannels(wav_file, segments, engine, whisper_model, tp, failure_policy, reuse_segments)
+    elif engine == 'whisper':
+        rows = transcribe.transcribeSegmentsLocal(wav_file, segments, whisper_model, tp)
+    else:
+        rows = asyncio.run(transcribe.transcribeSegmentsDeepgram(wav_file, segments, tp, failure_policy, reuse=reuse_segments))
+    # a transcript with failed segments isn't memoized, so the next run retries them
+    return {'rows': rows, PARTIAL: any(r[3] == transcribe.FAILED_SEGMENT_TEXT for r in rows)}
+
+
+def assembleStage(rows):
+    transcript = sorted((r for r in rows if r[3]), key=lambda r: float(r[0]))
+    return {'transcript': transcript}
+
+
+def exportStage(turns, transcript, tp):
+    TaskStore(tp).write_table(TURNS, {
+        'start': [float(t[0]) for t in turns],
+        'end': [float(t[1]) for t in turns],
+        'speaker': [str(t[2]) for t in turns],
+        'text': [str(t[3]) for t in turns],
+    })
+    return {'output_file': transcribe.writeDiarizedTranscript(tp, transcript)}
+
+
+def buildTranscriptionGraph(tp: TaskProps, mode: str, whisper_model: str = None, failure_policy: str = None, speakers: dict = None, reuse_embeddings=True, reuse_segments=True) -> StageGraph:
+    """
+    The diarized transcription pipeline as a stage graph:
+    decode -> (VAD, diarize) -> segment -> transcribe -> assemble -> export.
+
+    Parameters
+    ----------
+    tp: TaskProps
+        An instantiated utils.TaskProps class that provides all the necessary directory names.
+
+    mode: str
+        One of the --diarize values in MODES.  'auto' has to be resolved with resolveMode first.
+
+    whisper_model: str
+        The whisper model for modes that transcribe locally.
+
+    failure_policy: str
+        'fail_fast' or 'continue' for segments that fail to transcribe through Deepgram.  Defaults to
+        DEEPGRAM_FAILURE_POLICY from the config.
+
+    speakers: dict
+        Optional 'num_speakers', 'min_speakers' and 'max_speakers' for pyannote diarization.
+
+    reuse_embeddings: bool
+        Whether pyannote diarization may re-cluster cached speaker embeddings instead of re-running the pipeline.
+
+    reuse_segments: bool
+        Whether Deepgram transcription may reuse the segment results saved by an earlier failed run.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Invalid diarization mode '{mode}'.  Must be one of {list(MODES)}.")
+    diarizer, engine = MODES[mode]
+    c = Config()
+
+    if diarizer == 'deepgram':
+        diarize_params = {'diarizer': diarizer, 'deepgram_model': c.get_param('DEEPGRAM_MODEL')}
+    elif diarizer == 'channels':
+        diarize_params = {'diarizer': diarizer}
+    else:
+        diarize_params = {'diarizer': diarizer, 'speakers': {k: int(v) for k, v in (speakers or {}).items() if v}}
+
+    if engine == 'whisper':
+        transcribe_params = {
+            'engine': engine,
+            'whisper_model': whisper_model,
+            'decode': {
+                'max_fallbacks': c.get_optional_param('WHISPER_MAX_FALLBACKS', 2),
+                'prompt_chars': c.get_optional_param('WHISPER_PROMPT_CHARS', 200),
+                'language': c.get_optional_param('WHISPER_LANGUAGE'),
+                'cascade_model': c.get_optional_param('WHISPER_CASCADE_MODEL'),
+                'cascade_thresholds': transcribe.cascadeThresholds(),
+            },
+        }
+    else:
+        transcribe_params = {'engine': engine, 'whisper_model': 'deepgram-whisper', 'decode': {}}
+    if diarizer == 'channels':
+        transcribe_params['per_channel'] = True
+
+    # how failures are handled doesn't change a successful result, so it's bound rather than fingerprinted
+    failure_policy = failure_policy or c.get_optional_param('DEEPGRAM_FAILURE_POLICY', 'fail_fast')
+
+    # tp is handed to the stages that write intermediates, but isn't part of any fingerprint
+    def bind(fn, **bound):
+        return lambda **kw: fn(tp=tp, **bound, **kw)
+
+    stages = [
+        Stage('decode', decodeStage, {'wav_file': str}, {'audio': dict}, memoize=False),
+        Stage('vad', vadStage, {'wav_file': str, 'audio': dict}, {'speech': list},
+              params={'margin_db': float(c.get_optional_param('VAD_MARGIN_DB', 15.0)), 'min_silence_s': 0.5}),
+        Stage('diarize', bind(diarizeStage, reuse_embeddings=reuse_embeddings), {'wav_file': str, 'audio': dict}, {'turns': list}, params=diarize_params),
+        Stage('segment', segmentStage, {'turns': list, 'speech': list}, {'segments': list},
+              params={'min_segment_s': float(c.get_optional_param('MIN_SEGMENT_SECONDS', 0.2))}),
+        Stage('transcribe', bind(transcribeStage, failure_policy=failure_policy, reuse_segments=reuse_segments), {'wav_file': str, 'segments': list}, {'rows': list}, params=transcribe_params),
+        Stage('assemble', assembleStage, {'rows': list}, {'transcript': list}),
+        Stage('export', bind(exportStage), {'turns': list, 'transcript': list}, {'output_file': str}, memoize=False),
+    ]
+
+    max_mb = float(c.get_optional_param('STAGE_CACHE_MAX_MB', 2048))
+    return StageGraph(stages, cache_dir=tp.stage_cache_dir, max_cache_bytes=int(max_mb * 1024 * 1024) if max_mb > 0 else None)
+
+
+def resolveMode(wav_file, mode: str, tp: TaskProps = None) -> str:
+    """
+    The --diarize mode to run a recording with.  'auto' picks 'channels' (or 'channels_deepgram', when
+    AUTO_FALLBACK_MODE transcribes through Deepgram) for recordings with one speaker per channel, and
+    AUTO_FALLBACK_MODE (default 'deepgram') for everything else.  Other modes are returned as they are.
+    """
+    if mode != 'auto':
+        return mode
+    fallback = Config().get_optional_param('AUTO_FALLBACK_MODE', 'deepgram')
+    if fallback not in MODES:
+        raise ValueError(f"Invalid AUTO_FALLBACK_MODE '{fallback}'.  Must be one of {list(MODES)}.")
+
+    with WavSource(wav_file) as source:
+        layout = channelLayout(source)
+    if layout['per_speaker']:
+        resolved = 'channels' if MODES[fallback][1] == 'whisper' else 'channels_deepgram'
+    else:
+        resolved = fallback if MODES[fallback][0] != 'channels' else 'deepgram'
+    print(f"Channel layout: {layout['channels']} channel(s), {layout['separation']:.0%} of speech separated by channel. "
+          f"Using --diarize {resolved}.")
+    if tp is not None:
+        TaskMetrics(tp).record('channels', dict(layout, mode=resolved))
+    return resolved
+
+
+@contextlib.contextmanager
+def governed(tp: TaskProps):
+    """
+    Run a job under the resource governor configured for it (see governor.governorFor).  Besides whatever the
+    running stages register, evicting the cached whisper models and pyannote pipelines is the last resort when
+    the job goes over its memory budget; they're loaded again the next time they're needed.  Models that are in
+    use can't be freed, and evicting nothing counts as having nothing left to degrade.
+    """
+    def evict_models():
+        evicted = evictWhisperModels() + evictPipelines()
+        if not evicted:
+            return None
+        return f'evicted cached models: {evicted}'
+
+    with governorFor(tp) as governor:
+        governor.add_action('evict_models', evict_models, 'memory', level='hard')
+        yield governor
+
+
+def runDiarizedTranscript(wav_file, tp: TaskProps, mode: str, whisper_model: str = None, use_cache=True, failure_policy: str = None, speakers: dict = None) -> str:
+    """
+    Generate a diarized transcript by running the stage graph for the given --diarize mode.  Stages whose inputs
+    and params haven't changed since a previous run of the same recording reuse their memoized results.
+
+    Returns the path of the final transcript.
+    """
+    graph = buildTranscriptionGraph(tp, mode, whisper_model, failure_policy, speakers, reuse_embeddings=use_cache, reuse_segments=use_cache)
+    with governed(tp):
+        values = graph.run({'wav_file': wav_file}, {'wav_file': fileFingerprint(wav_file)}, use_cache=use_cache)
+
+    TaskMetrics(tp).record('stages', graph.timings)
+    for name, t in graph.timings.items():
+        print(f"  {name}: {t['seconds']}s{' (memoized)' if t['cached'] else ''}")
+
+    return values['output_file']
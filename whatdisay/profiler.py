@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps, TaskMetrics
+from whatdisay.config import Config
+import asyncio
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+class _WatchingPolicy(asyncio.DefaultEventLoopPolicy):
+    # every event loop created while the profiler runs (asyncio.run creates one per call) gets a heartbeat
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+
+    def new_event_loop(self):
+        loop = super().new_event_loop()
+        self.profiler.watch_loop(loop)
+        return loop
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler for a whole job.  A background thread takes the stack of every thread in the
+    process each interval_s with sys._current_frames(), so the job runs at full speed between samples and nothing
+    needs to be instrumented.  Time spent waiting (on a subprocess, a lock, the network) shows up as the stack that
+    is waiting, which is usually what you want to know about a slow job.
+
+    Event loops created while it runs get a heartbeat callback.  When a heartbeat is late by more than stall_s,
+    something blocked the loop for that long, and the stall is reported with the stack the loop's thread was stuck in.
+
+    On stop, the samples are written to out_dir as <name>.collapsed (one 'thread;frame;...;frame count' line per
+    stack, for flamegraph.pl, inferno and the like) and <name>.speedscope.json (for https://www.speedscope.app).
+    """
+
+    def __init__(self, name: str, out_dir: str, interval_s=0.01, stall_s=0.1):
+        self.name = name
+        self.out_dir = out_dir
+        self.interval_s = interval_s
+        self.stall_s = stall_s
+
+        self.stacks = collections.defaultdict(collections.Counter)
+        self.thread_names = {}
+        self.samples = 0
+        self.stalls = []
+        self.beats = {}
+        self.stalled = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.started = None
+        self.elapsed = 0.0
+        self.policy = None
+
+    def watch_loop(self, loop):
+        loop.call_soon(self._beat, loop, None)
+
+    def _beat(self, loop, expected):
+        now = time.perf_counter()
+        tid = threading.get_ident()
+        if expected is not None and now - expected > self.stall_s:
+            with self.lock:
+                stuck = self.stalled.pop(tid, collections.Counter())
+            stack = stuck.most_common(1)[0][0] if stuck else ()
+            self.stalls.append({
+                'thread': self.thread_names.get(tid, str(tid)),
+                'at_seconds': round(expected - self.started, 3),
+                'ms': round((now - expected) * 1000, 1),
+                'stack': list(stack),
+            })
+            where = stack[-1] if stack else 'unknown'
+            print(f'Event loop blocked for {(now - expected) * 1000:.0f}ms in {where}')
+        else:
+            with self.lock:
+                self.stalled.pop(tid, None)
+        nxt = now + self.stall_s / 4
+        self.beats[tid] = (nxt, loop)
+        loop.call_later(self.stall_s / 4, self._beat, loop, nxt)
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        frames = sys._current_frames()
+        now = time.perf_counter()
+        with self.lock:
+            for tid, frame in frames.items():
+                if tid == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                self.thread_names[tid] = names.get(tid, str(tid))
+                self.stacks[tid][stack] += 1
+
+                beat = self.beats.get(tid)
+                if beat and beat[1].is_running() and now - beat[0] > self.stall_s:
+                    self.stalled[tid][stack] += 1
+            self.samples += 1
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval_s):
+            self._sample()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.policy = asyncio.get_event_loop_policy()
+        asyncio.set_event_loop_policy(_WatchingPolicy(self))
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> list:
+        self.stop_event.set()
+        self.thread.join()
+        asyncio.set_event_loop_policy(self.policy)
+        self.elapsed = time.perf_counter() - self.started
+        return self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def write(self) -> list:
+        os.makedirs(self.out_dir, exist_ok=True)
+        collapsed = os.path.join(self.out_dir, self.name + '.collapsed')
+        with open(collapsed, 'w', encoding='utf-8') as f:
+            for tid, stacks in self.stacks.items():
+                thread = self.thread_names[tid].replace(';', ':').replace(' ', '_')
+                for stack, n in stacks.most_common():
+                    f.write(';'.join([thread] + [s.replace(';', ':') for s in stack]) + f' {n}\n')
+
+        frames, index = [], {}
+        profiles = []
+        for tid, stacks in self.stacks.items():
+            samples, weights = [], []
+            for stack, n in stacks.items():
+                ids = []
+                for s in stack:
+                    if s not in index:
+                        index[s] = len(frames)
+                        name, _, where = s.rpartition(' (')
+                        file, _, line = where.rstrip(')').rpartition(':')
+                        frames.append({'name': name, 'file': file, 'line': int(line)})
+                    ids.append(index[s])
+                samples.append(ids)
+                weights.append(n * self.interval_s)
+            profiles.append({
+                'type': 'sampled',
+                'name': self.thread_names[tid],
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            })
+        speedscope = os.path.join(self.out_dir, self.name + '.speedscope.json')
+        with open(speedscope, 'w', encoding='utf-8') as f:
+            json.dump({
+                '$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'name': self.name,
+                'exporter': 'whatdisay',
+                'shared': {'frames': frames},
+                'profiles': profiles,
+            }, f)
+        return [collapsed, speedscope]
+
+    def hotspots(self, n=10) -> list:
+        """The n functions the most samples were taken in, across threads, as [function, share of samples]."""
+        leaves = collections.Counter()
+        for stacks in self.stacks.values():
+            for stack, k in stacks.items():
+                if stack:
+                    leaves[stack[-1]] += k
+        total = sum(leaves.values()) or 1
+        return [[f, round(k / total, 4)] for f, k in leaves.most_common(n)]
+
+
+def profilerFor(tp: TaskProps) -> SamplingProfiler:
+    """
+    A profiler for a task, writing to tp.profiles_dir, with PROFILE_INTERVAL_MS (default 10) between samples and
+    event loop stalls over PROFILE_STALL_MS (default 100) reported.
+    """
+    c = Config()
+    return SamplingProfiler(
+        tp.task_name,
+        tp.profiles_dir,
+        interval_s=float(c.get_optional_param('PROFILE_INTERVAL_MS', 10)) / 1000,
+        stall_s=float(c.get_optional_param('PROFILE_STALL_MS', 100)) / 1000,
+    )
+
+
+@contextlib.contextmanager
+def profiling(tp: TaskProps, enabled=True):
+    """
+    Profile the enclosed job when enabled, then print and record a summary in the task's metrics.
+    """
+    if not enabled:
+        yield None
+        return
+
+    p = profilerFor(tp).start()
+    try:
+        yield p
+    finally:
+        files = p.stop()
+        hotspots = p.hotspots()
+        print(f'Profiled {p.elapsed:.1f}s in {p.samples} samples, {len(p.stalls)} event loop stalls over {p.stall_s * 1000:.0f}ms.')
+        for f, share in hotspots[:5]:
+            print(f'  {share:6.1%}  {f}')
+        for f in files:
+            print(f'Saved profile at: {f}')
+        TaskMetrics(tp).record('profile', {
+            'seconds': round(p.elapsed, 3),
+            'samples': p.samples,
+            'interval_ms': p.interval_s * 1000,
+            'files': files,
+            'hotspots': hotspots,
+            'loop_stalls': p.stalls,
+        })
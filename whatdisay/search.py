@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+from whatdisay.utils import TaskProps
+from datetime import datetime, timedelta
+import contextlib
+import os
+import re
+import sqlite3
+
+
+# "Speaker: text" transcript lines
+LINE_PATTERN = re.compile(r'^([^:\n]{1,64}):\s(.*)$')
+# the line MdFileUtil transcripts end with
+CREATED_PATTERN = re.compile(r'originally created at: (\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})')
+TRANSCRIPT_EXTENSIONS = ('.txt', '.md')
+
+
+class TranscriptIndex:
+    """
+    Full-text index of the transcript archive, in a SQLite database with an FTS5 table over the transcript lines.
+
+    Each line is stored with its speaker and, for transcripts indexed as they're written, the start and end of its
+    segment.  Each file is stored with its task name, its date and the tags and title of its markdown version, and
+    with its modification time and size, so refresh() only re-reads the files that changed since they were indexed.
+
+    When a task has both a .txt and a .md transcript, the lines come from the .txt and the .md only adds its tags
+    and title.
+
+    Parameters
+    ----------
+    db_path: str
+        Path of the index database.  It's created if it doesn't exist.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        d = os.path.dirname(db_path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with contextlib.closing(self._connect()) as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    task TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    recorded TEXT NOT NULL,
+                    title TEXT,
+                    tags TEXT NOT NULL DEFAULT ','
+                )
+            ''')
+            con.execute('''
+                CREATE TABLE IF NOT EXISTS segments (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    line INTEGER NOT NULL,
+                    speaker TEXT,
+                    start REAL,
+                    end REAL,
+                    text TEXT NOT NULL
+                )
+            ''')
+            con.execute("CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(text, content='segments', content_rowid='id')")
+            con.execute('CREATE INDEX IF NOT EXISTS files_task ON files (task)')
+            con.execute('CREATE INDEX IF NOT EXISTS segments_path ON segments (path, line)')
+            con.execute('CREATE INDEX IF NOT EXISTS segments_speaker ON segments (speaker COLLATE NOCASE)')
+
+    def _connect(self):
+        # autocommit mode, so transactions are only the explicit BEGIN IMMEDIATE blocks
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def update(self, path, rows=None):
+        """
+        (Re)index one transcript file.  rows are the [start, end, speaker, text] rows the file was just written from;
+        without them, the file is parsed and its lines have no timestamps.
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        kind = os.path.splitext(path)[1].lstrip('.')
+        task = os.path.splitext(os.path.basename(path))[0]
+
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        title, tags, created, lines = parseTranscript(text, markdown=(kind == 'md'))
+
+        if rows is not None:
+            lines = [(i + 1, str(r[2]), float(r[0]), float(r[1]), str(r[3])) for i, r in enumerate(r for r in rows if r[3])]
+        elif kind == 'md' and os.path.exists(os.path.splitext(path)[0] + '.txt'):
+            lines = []
+
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            self._delete(con, path)
+            if kind == 'txt':
+                # the .txt is the source of the task's lines from now on
+                self._delete_segments(con, os.path.splitext(path)[0] + '.md')
+            con.execute(
+                'INSERT INTO files (path, task, kind, mtime_ns, size, recorded, title, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, task, kind, st.st_mtime_ns, st.st_size, created or taskDate(task, st.st_mtime), title, ',' + ','.join(tags) + ',')
+            )
+            self._insert(con, path, lines)
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        return len(lines)
+
+    def append(self, path, rows, offset: int):
+        """
+        Index rows that were just appended to a transcript that was offset bytes long before.  If the index doesn't
+        have the file at that size, the whole file is re-indexed instead.
+        """
+        path = os.path.realpath(path)
+        with contextlib.closing(self._connect()) as con:
+            known = con.execute('SELECT size FROM files WHERE path = ?', (path,)).fetchone()
+        if not known or known[0] != offset:
+            # rows appended to an empty file are all of its rows
+            return self.update(path, rows if offset == 0 else None)
+
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            first = con.execute('SELECT COALESCE(MAX(line), 0) FROM segments WHERE path = ?', (path,)).fetchone()[0] + 1
+            lines = [(first + i, str(r[2]), float(r[0]), float(r[1]), str(r[3])) for i, r in enumerate(r for r in rows if r[3])]
+            self._insert(con, path, lines)
+            st = os.stat(path)
+            con.execute('UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?', (st.st_mtime_ns, st.st_size, path))
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        return len(lines)
+
+    def refresh(self, directory) -> dict:
+        """
+        Bring the index in line with the transcripts under a directory: new and modified files are (re)indexed and
+        files that no longer exist are dropped.  Unchanged files are only stat'ed.
+        """
+        found = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(TRANSCRIPT_EXTENSIONS):
+                    p = os.path.realpath(os.path.join(root, name))
+                    st = os.stat(p)
+                    found[p] = (st.st_mtime_ns, st.st_size)
+
+        directory = os.path.join(os.path.realpath(directory), '')
+        with contextlib.closing(self._connect()) as con:
+            known = {
+                r[0]: (r[1], r[2]) for r in
+                con.execute('SELECT path, mtime_ns, size FROM files WHERE substr(path, 1, ?) = ?', (len(directory), directory))
+            }
+
+        # .txt files first, so a .md knows whether its lines come from a sibling .txt
+        changed = sorted((p for p, s in found.items() if known.get(p) != s), key=lambda p: not p.endswith('.txt'))
+        removed = [p for p in known if p not in found]
+        for p in changed:
+            self.update(p)
+        if removed:
+            con = self._connect()
+            try:
+                con.execute('BEGIN IMMEDIATE')
+                for p in removed:
+                    self._delete(con, p)
+                con.execute('COMMIT')
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+            finally:
+                con.close()
+
+        return {'files': len(found), 'indexed': len(changed), 'removed': len(removed)}
+
+    def search(self, phrase=None, speaker=None, since=None, until=None, tags=(), limit=50) -> list:
+        """
+        Transcript lines matching every given filter, best matches first when there's a phrase and most recent
+        first otherwise.
+
+        Parameters
+        ----------
+        phrase: str
+            Words that have to appear in the line, in this order.  Wrapped in parentheses, it's passed to FTS5 as a
+            query instead, e.g. '(budget OR forecast*)'.
+
+        speaker: str
+            Only lines by this speaker (case insensitive).
+
+        since, until: str
+            Only transcripts dated within this range of YYYY-MM-DD dates, both inclusive.
+
+        tags: list
+            Only transcripts with all of these tags.
+        """
+        where, args = [], []
+        if phrase:
+            where.append('segments_fts MATCH ?')
+            args.append(ftsQuery(phrase))
+        if speaker:
+            where.append('s.speaker = ? COLLATE NOCASE')
+            args.append(speaker)
+        if since:
+            where.append('f.recorded >= ?')
+            args.append(_date(since).isoformat())
+        if until:
+            where.append('f.recorded < ?')
+            args.append((_date(until) + timedelta(days=1)).isoformat())
+        for tag in tags:
+            where.append("EXISTS (SELECT 1 FROM files t WHERE t.task = f.task AND t.tags LIKE ? ESCAPE '\\')")
+            args.append('%,' + tag.replace(' ', '-').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + ',%')
+
+        sql = '''
+            SELECT f.task, s.path, s.line, s.speaker, s.start, s.end, s.text, f.recorded,
+                   (SELECT group_concat(trim(t.tags, ','), ',') FROM files t WHERE t.task = f.task AND t.tags != ',')
+            FROM segments s JOIN files f ON f.path = s.path
+        '''
+        if phrase:
+            sql += ' JOIN segments_fts ON segments_fts.rowid = s.id'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + ('segments_fts.rank' if phrase else 'f.recorded DESC, s.path, s.line') + ' LIMIT ?'
+        args.append(int(limit))
+
+        with contextlib.closing(self._connect()) as con:
+            rows = con.execute(sql, args).fetchall()
+        return [
+            {
+                'task': r[0], 'path': r[1], 'line': r[2], 'speaker': r[3], 'start': r[4], 'end': r[5], 'text': r[6],
+                'recorded': r[7], 'tags': sorted(set(t for t in (r[8] or '').split(',') if t)),
+            }
+            for r in rows
+        ]
+
+    def _insert(self, con, path, lines):
+        for line, speaker, start, end, text in lines:
+            cur = con.execute(
+                'INSERT INTO segments (path, line, speaker, start, end, text) VALUES (?, ?, ?, ?, ?, ?)',
+                (path, line, speaker, start, end, text)
+            )
+            con.execute('INSERT INTO segments_fts (rowid, text) VALUES (?, ?)', (cur.lastrowid, text))
+
+    def _delete_segments(self, con, path):
+        # external content FTS5 tables are told which rows to drop, with the text they were indexed with
+        con.execute(
+            "INSERT INTO segments_fts (segments_fts, rowid, text) SELECT 'delete', id, text FROM segments WHERE path = ?",
+            (path,)
+        )
+        con.execute('DELETE FROM segments WHERE path = ?', (path,))
+
+    def _delete(self, con, path):
+        self._delete_segments(con, path)
+        con.execute('DELETE FROM files WHERE path = ?', (path,))
+
+
+def parseTranscript(text: str, markdown=False):
+    """
+    Split a transcript into its title, tags, creation time and (line, speaker, start, end, text) lines.  Markdown
+    transcripts are the ones MdFileUtil writes: a YAML block of tags, a '# title' heading and a closing line with
+    the time the recording was created.
+    """
+    lines = text.splitlines()
+    title, tags, created = None, [], None
+
+    i = 0
+    if markdown and lines and lines[0].strip() == '---':
+        i = 1
+        while i < len(lines) and lines[i].strip() != '---':
+            if lines[i].startswith('- '):
+                # MdFileUtil turns the spaces in 'a, b' into dashes
+                tags.append(lines[i][2:].strip().strip('-'))
+            i += 1
+        i += 1
+    if markdown and i < len(lines) and lines[i].startswith('# '):
+        title = lines[i][2:].strip()
+        i += 1
+
+    parsed = []
+    for n in range(i, len(lines)):
+        line = lines[n].strip()
+        if not line:
+            continue
+        m = CREATED_PATTERN.search(line) if markdown else None
+        if m:
+            created = m.group(1)
+            continue
+        m = LINE_PATTERN.match(line)
+        speaker, body = (m.group(1), m.group(2)) if m else (None, line)
+        parsed.append((n + 1, speaker, None, None, body))
+
+    return title, [t for t in tags if t], created, parsed
+
+
+def taskDate(task_name: str, mtime: float) -> str:
+    """
+    When a transcript was made: the millisecond timestamp getTaskName ends task names with, or the file's mtime.
+    """
+    m = re.search(r'(\d{13})$', task_name)
+    ts = int(m.group(1)) / 1000 if m else mtime
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def ftsQuery(phrase: str) -> str:
+    phrase = phrase.strip()
+    if phrase.startswith('(') and phrase.endswith(')'):
+        return phrase
+    return '"' + phrase.replace('"', '""') + '"'
+
+
+def _date(s: str) -> datetime:
+    try:
+        return datetime.strptime(s, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"Invalid date '{s}'.  Dates must be in the format YYYY-MM-DD.")
+
+
+def indexTranscript(tp: TaskProps, path, rows=None, offset=None):
+    """
+    Add a transcript that was just written (or appended to, from offset bytes on) to the search index.  A failure
+    to index is reported but doesn't fail the transcription; the next search picks the file up.
+    """
+    try:
+        index = TranscriptIndex(tp.search_index)
+        if offset is not None:
+            index.append(path, rows, offset)
+        else:
+            index.update(path, rows)
+    except (sqlite3.Error, OSError) as e:
+        print(f'Could not add {path} to the search index: {e}')
+
+
+def formatTimestamp(seconds) -> str:
+    s = int(seconds)
+    return f'{s // 3600:d}:{s % 3600 // 60:02d}:{s % 60:02d}' if s >= 3600 else f'{s // 60:02d}:{s % 60:02d}'
+
+
+def searchTranscripts(tp: TaskProps, phrase=None, speaker=None, since=None, until=None, tags=(), limit=50) -> list:
+    """
+    Search the transcript archive in tp.diarized_transcriptions_dir and print the matching lines.  The index is
+    refreshed first, which only re-reads transcripts that changed since they were indexed.
+    """
+    index = TranscriptIndex(tp.search_index)
+    r = index.refresh(tp.diarized_transcriptions_dir)
+    if r['indexed'] or r['removed']:
+        print(f"Indexed {r['indexed']} new or changed transcripts and dropped {r['removed']} deleted ones.")
+
+    hits = index.search(phrase, speaker, since, until, tags, limit)
+    for h in hits:
+        when = f"[{formatTimestamp(h['start'])}] " if h['start'] is not None else ''
+        who = f"{h['speaker']}: " if h['speaker'] else ''
+        tagged = f"  #{' #'.join(h['tags'])}" if h['tags'] else ''
+        print(f"{h['recorded'][:10]}  {h['task']}:{h['line']}  {when}{who}{h['text']}{tagged}")
+    print(f"{len(hits)} matching lines{' (limit reached)' if len(hits) >= limit else ''}.")
+    return hits
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import json
+import os
+import pickle
+import time
+
+
+# Key a stage can set in its outputs to mark the result as incomplete so it isn't memoized.
+PARTIAL = '__partial__'
+
+
+class Stage:
+    """
+    One typed step of a stage graph.
+
+    Parameters
+    ----------
+    name: str
+        Unique name of the stage within its graph.
+
+    fn: callable
+        Called with the stage's inputs and params as keyword arguments.  Must return a dict holding every output.
+        A result that is incomplete (e.g. some segments failed) can set PARTIAL in the dict so it isn't memoized.
+
+    inputs: dict
+        Input name -> expected type.  Inputs are either graph sources or outputs of other stages.
+
+    outputs: dict
+        Output name -> type.
+
+    params: dict
+        Settings that change the stage's result.  They are part of the stage's fingerprint, so changing one
+        re-runs this stage and everything downstream of it.
+
+    version: int
+        Bump when the stage's implementation changes in a way that invalidates memoized results.
+
+    memoize: bool
+        Whether results are memoized.  Stages with side effects (exports) shouldn't be.
+    """
+
+    def __init__(self, name, fn, inputs=None, outputs=None, params=None, version=1, memoize=True):
+        self.name = name
+        self.fn = fn
+        self.inputs = inputs or {}
+        self.outputs = outputs or {}
+        self.params = params or {}
+        self.version = version
+        self.memoize = memoize
+
+    def fingerprint(self, input_fingerprints: dict) -> str:
+        return hashValue({
+            'stage': self.name,
+            'version': self.version,
+            'params': self.params,
+            'inputs': {k: input_fingerprints[k] for k in sorted(self.inputs)},
+        })
+
+
+class StageGraph:
+    """
+    A DAG of stages, run in dependency order with independent stages running concurrently.
+
+    Each memoized stage's outputs are cached under cache_dir by a fingerprint of its name, version, params and
+    the fingerprints of its inputs.  Source fingerprints come from the caller (e.g. a content hash of the audio),
+    and each output's fingerprint is derived from the stage that produced it, so a change anywhere only re-runs
+    the stages downstream of it.
+
+    When max_cache_bytes is given, the least recently used cached results are removed after each run until the
+    cache fits, so the cache doesn't keep every result of every recording it has ever seen.
+    """
+
+    def __init__(self, stages: list, cache_dir=None, max_workers=4, max_cache_bytes=None):
+        self.stages = {}
+        self.producers = {}
+        for s in stages:
+            if s.name in self.stages:
+                raise ValueError(f'Duplicate stage name: {s.name}')
+            self.stages[s.name] = s
+            for o in s.outputs:
+                if o in self.producers:
+                    raise ValueError(f"Output '{o}' is produced by both {self.producers[o]} and {s.name}")
+                self.producers[o] = s.name
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.max_workers = max_workers
+        self.timings = {}
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError(f"Stage graph has a cycle: {' -> '.join(path + [name])}")
+            state[name] = 'visiting'
+            for i in self.stages[name].inputs:
+                if i in self.producers:
+                    visit(self.producers[i], path + [name])
+            state[name] = 'done'
+
+        for name in self.stages:
+            visit(name, [])
+
+    def sources(self) -> list:
+        """The inputs that no stage produces and must be passed to run()."""
+        return sorted({i for s in self.stages.values() for i in s.inputs if i not in self.producers})
+
+    def upstream(self, outputs: list) -> dict:
+        """The stages needed to produce the given outputs."""
+        needed = {}
+        todo = list(outputs)
+        while todo:
+            o = todo.pop()
+            if o not in self.producers:
+                continue
+            name = self.producers[o]
+            if name not in needed:
+                needed[name] = self.stages[name]
+                todo.extend(self.stages[name].inputs)
+        return needed
+
+    def run(self, sources: dict, source_fingerprints: dict = None, use_cache=True, outputs: list = None) -> dict:
+        """
+        Run the graph and return every source and output value.  When outputs is given, only the stages needed
+        to produce those outputs are run.
+        """
+        pending = self.upstream(outputs) if outputs else dict(self.stages)
+        missing = sorted({i for s in pending.values() for i in s.inputs if i not in self.producers and i not in sources})
+        if missing:
+            raise ValueError(f'Missing stage graph sources: {missing}')
+
+        values = dict(sources)
+        fingerprints = {k: (source_fingerprints or {}).get(k) or hashValue(v) for k, v in sources.items()}
+        running = {}
+        self.timings = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+            while pending or running:
+                for name, s in list(pending.items()):
+                    if all(i in values for i in s.inputs):
+                        fp = s.fingerprint(fingerprints)
+                        inputs = {i: values[i] for i in s.inputs}
+                        running[ex.submit(self._execute, s, fp, inputs, use_cache)] = (s, fp)
+                        del pending[name]
+
+                if not running:
+                    raise ValueError(f'Stages with unresolvable inputs: {sorted(pending)}')
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    s, fp = running.pop(f)
+                    outputs = f.result()
+                    for o, t in s.outputs.items():
+                        if o not in outputs:
+                            raise ValueError(f"Stage {s.name} did not produce its output '{o}'")
+                        if t is not None and not isinstance(outputs[o], t):
+                            raise TypeError(f"Stage {s.name} output '{o}' should be {t.__name__}, got {type(outputs[o]).__name__}")
+                        values[o] = outputs[o]
+                        fingerprints[o] = fp + ':' + o
+
+        self.evict_cache()
+        return values
+
+    def evict_cache(self) -> list:
+        """
+        Remove the least recently used cached results (by mtime, which a reuse refreshes) until the cache is
+        within max_cache_bytes.  Returns the removed files.
+        """
+        if not (self.cache_dir and self.max_cache_bytes is not None and os.path.isdir(self.cache_dir)):
+            return []
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for n in names:
+                if n.endswith('.pkl'):
+                    path = os.path.join(root, n)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        removed = []
+        for _, size, path in sorted(files):
+            if total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(path)
+        if removed:
+            print(f'Evicted {len(removed)} cached stage results to keep the stage cache under {self.max_cache_bytes // (1024 * 1024)} MB.')
+        return removed
+
+    def _cache_file(self, s: Stage, fp: str):
+        return os.path.join(self.cache_dir, s.name, fp + '.pkl')
+
+    def _execute(self, s: Stage, fp: str, inputs: dict, use_cache: bool) -> dict:
+        started = time.time()
+        cache_file = self._cache_file(s, fp) if (self.cache_dir and s.memoize) else None
+
+        if cache_file and use_cache and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                outputs = pickle.load(f)
+            # mark it recently used, so eviction keeps it
+            os.utime(cache_file)
+            cached = True
+            print(f'Stage {s.name}: reusing memoized result')
+        else:
+            print(f'Stage {s.name}: running')
+            outputs = s.fn(**inputs, **s.params)
+            cached = False
+            if cache_file and not outputs.get(PARTIAL):
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                tmp = cache_file + '.tmp'
+                with open(tmp, 'wb') as f:
+                    pickle.dump({o: outputs[o] for o in s.outputs}, f)
+                os.replace(tmp, cache_file)
+
+        self.timings[s.name] = {'seconds': round(time.time() - started, 3), 'cached': cached, 'fingerprint': fp[:16]}
+        return outputs
+
+
+def hashValue(v) -> str:
+    return hashlib.sha256(json.dumps(v, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def fileFingerprint(path: str, chunk_bytes=1024 * 1024) -> str:
+    """
+    Content hash of a file, so a renamed or re-copied recording still hits the stage cache.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(chunk_bytes)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
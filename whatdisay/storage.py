@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+from abc import ABC, abstractmethod
+import io
+import os
+import shutil
+import tempfile
+
+
+class TaskStorage(ABC):
+    """
+    Where a task's intermediate files live.  Intermediates are addressed by relative names like
+    'tmp_files/audio_segments/0.wav'; a trailing '/' is not required for directories.
+    """
+
+    kind = None
+
+    @abstractmethod
+    def open(self, name: str, mode: str = 'rb'):
+        """Open an intermediate for reading or writing ('rb', 'wb', 'r', 'w', 'a')."""
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def listdir(self, name: str = '') -> list:
+        pass
+
+    @abstractmethod
+    def remove(self, name: str):
+        """Remove an intermediate, or everything under it if it names a directory."""
+
+    @abstractmethod
+    def local_path(self, name: str) -> str:
+        """
+        A real filesystem path for an intermediate, for tools (ffmpeg, pyannote, ...) that only take paths.
+        Backends that don't keep files on disk materialize a temporary copy.
+        """
+
+    @abstractmethod
+    def remove_all(self):
+        pass
+
+    def isdir(self, name: str) -> bool:
+        return bool(self.listdir(name))
+
+    def makedirs(self, name: str):
+        pass
+
+    def write_bytes(self, name: str, data: bytes):
+        with self.open(name, 'wb') as f:
+            f.write(data)
+
+    def read_bytes(self, name: str) -> bytes:
+        with self.open(name, 'rb') as f:
+            return f.read()
+
+    def mmap_path(self, name: str):
+        """The on-disk path of an intermediate if it can be memory-mapped in place, else None."""
+        return None
+
+    def describe(self) -> str:
+        return self.kind
+
+
+class LocalDiskStorage(TaskStorage):
+    """
+    Intermediates stored as regular files under a root directory.
+
+    Parameters
+    ----------
+    root: str
+        The directory the task's intermediates are written to.
+    """
+
+    kind = 'disk'
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def open(self, name, mode='rb'):
+        if any(m in mode for m in 'wa'):
+            self.makedirs(os.path.dirname(name))
+        if 'b' in mode:
+            return open(self.path(name), mode)
+        return open(self.path(name), mode, encoding='utf-8')
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def isdir(self, name):
+        return os.path.isdir(self.path(name))
+
+    def makedirs(self, name):
+        os.makedirs(self.path(name), exist_ok=True)
+
+    def listdir(self, name=''):
+        p = self.path(name)
+        return sorted(os.listdir(p)) if os.path.isdir(p) else []
+
+    def remove(self, name):
+        p = self.path(name)
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        elif os.path.exists(p):
+            os.remove(p)
+
+    def local_path(self, name):
+        self.makedirs(os.path.dirname(name))
+        return self.path(name)
+
+    def mmap_path(self, name):
+        return self.path(name)
+
+    def remove_all(self):
+        if os.path.exists(self.root):
+            print('Deleting task tmp file directory at: {}'.format(self.root))
+            shutil.rmtree(self.root)
+
+    def describe(self):
+        return f'{self.kind}:{self.root}'
+
+
+class TmpfsStorage(LocalDiskStorage):
+    """
+    Intermediates stored on a RAM-backed filesystem (/dev/shm by default), so tools that need real paths
+    still get them without touching the disk.
+    """
+
+    kind = 'tmpfs'
+
+    def __init__(self, root: str):
+        super().__init__(root)
+
+
+class _MemoryFile(io.BytesIO):
+
+    def __init__(self, storage, name, data=b''):
+        super().__init__(data)
+        self.storage = storage
+        self.name = name
+
+    def close(self):
+        if not self.closed:
+            self.storage.files[self.storage._key(self.name)] = self.getvalue()
+        super().close()
+
+
+class MemoryStorage(TaskStorage):
+    """
+    Intermediates kept in process memory.  Meant for short jobs; anything that must be handed to an external
+    tool as a path is spilled to a temporary file that's deleted along with the task.
+    """
+
+    kind = 'memory'
+
+    def __init__(self):
+        self.files = {}
+        self.spilled = {}
+
+    def _key(self, name):
+        return os.path.normpath(name).lstrip('/')
+
+    def open(self, name, mode='rb'):
+        key = self._key(name)
+        if 'r' in mode and '+' not in mode:
+            if key in self.spilled:
+                self._unspill(key)
+            if key not in self.files:
+                raise FileNotFoundError(f'No intermediate named {name} in memory storage.')
+            f = io.BytesIO(self.files[key])
+        else:
+            if key in self.spilled:
+                # the spilled copy would shadow what's written now: fold it back in and drop it
+                if 'a' in mode:
+                    self._unspill(key)
+                p = self.spilled.pop(key)
+                if os.path.exists(p):
+                    os.remove(p)
+            data = self.files.get(key, b'') if 'a' in mode else b''
+            f = _MemoryFile(self, key, data)
+            f.seek(0, io.SEEK_END)
+        if 'b' in mode:
+            return f
+        return io.TextIOWrapper(f, encoding='utf-8')
+
+    def _unspill(self, key):
+        # an external tool may have written to the spilled copy; pick up its contents
+        p = self.spilled[key]
+        if os.path.exists(p):
+            with open(p, 'rb') as f:
+                self.files[key] = f.read()
+
+    def exists(self, name):
+        key = self._key(name)
+        return key in self.files or key in self.spilled or self.isdir(name)
+
+    def listdir(self, name=''):
+        prefix = self._key(name) + '/' if self._key(name) not in ('', '.') else ''
+        children = {k[len(prefix):].split('/')[0] for k in list(self.files) + list(self.spilled) if k.startswith(prefix)}
+        return sorted(children)
+
+    def remove(self, name):
+        key = self._key(name)
+        everything = key in ('', '.')
+        for k in [k for k in list(self.files) + list(self.spilled) if everything or k == key or k.startswith(key + '/')]:
+            self.files.pop(k, None)
+            p = self.spilled.pop(k, None)
+            if p and os.path.exists(p):
+                os.remove(p)
+
+    def local_path(self, name):
+        key = self._key(name)
+        if key not in self.spilled:
+            fd, p = tempfile.mkstemp(prefix='whatdisay_', suffix=os.path.splitext(key)[1])
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.files.get(key, b''))
+            self.spilled[key] = p
+        return self.spilled[key]
+
+    def remove_all(self):
+        print('Releasing in-memory task storage.')
+        self.remove('')
+        self.files.clear()
+
+    def nbytes(self) -> int:
+        return sum(len(v) for v in self.files.values())
+
+
+def makeTaskStorage(kind: str, task_name: str, root: str = None) -> TaskStorage:
+    """
+    Create the storage backend for a task.
+
+    Parameters
+    ----------
+    kind: str
+        'disk', 'tmpfs' or 'memory'.
+
+    task_name: str
+        The task the storage is for; disk and tmpfs backends keep each task in its own directory.
+
+    root: str
+        Directory the disk or tmpfs backend keeps its task directories in (e.g. a fast scratch volume).
+    """
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind == 'tmpfs':
+        return TmpfsStorage(os.path.join(root or '/dev/shm/whatdisay', str(task_name)))
+    if kind == 'disk':
+        if not root:
+            raise ValueError('The disk storage backend needs a root directory.')
+        return LocalDiskStorage(os.path.join(root, str(task_name)))
+    raise ValueError(f"Invalid task storage '{kind}'.  Must be 'disk', 'tmpfs' or 'memory'.")
@@ -1,21 +1,84 @@
 #!/usr/bin/env python3
 
-from whatdisay.utils import TaskProps, millisec
+from whatdisay.utils import TaskProps, TaskMetrics
 from whatdisay.config import Config
 from pydub import AudioSegment
-from whatdisay.diarize import Diarize
-from deepgram import Deepgram
+from whatdisay.diarize import Diarize, deepgramClient
+from whatdisay.intermediates import TaskStore, SEGMENTS
+from whatdisay.decode import DecodeSession, CascadeDecoder, loadWhisperModel, audioSegmentToWhisper
+from whatdisay.upload import WavSource, ByteBudget, ConcurrencyLimit, SegmentFailures, uploadSegments
+from whatdisay.ledger import SegmentLedger
+from whatdisay.stages import fileFingerprint
+from whatdisay.governor import currentGovernor
+from whatdisay.search import indexTranscript
+from whatdisay.callbacks import callbacksEnabled, deepgramJobs
+from whatdisay.fingerprint import dedupeFor
 import aiofiles
 import asyncio
+import concurrent.futures
 import os
-import json
-import re
-import webvtt
-import whisper
-from whisper.utils import write_txt,write_vtt
+import threading
+import aiohttp
 from aiohttp.client_exceptions import ClientResponseError
 
 
+FAILED_SEGMENT_TEXT = '[transcription failed]'
+
+# how far the resource governor can shrink Deepgram uploads
+MIN_INFLIGHT_BYTES = 4 * 1024 * 1024
+MIN_CONCURRENCY = 2
+# how long a governor action waits for the upload loop to apply it
+LOOP_ACTION_TIMEOUT_S = 5.0
+
+
+# torch's thread count is process-wide: the governor's whisper_threads action lowers it for the local
+# transcriptions running now, and the last of them to finish puts the original count back
+_THREADS = {'original': None, 'running': 0}
+_THREADS_LOCK = threading.Lock()
+
+
+def _fewerTorchThreads():
+    import torch
+    with _THREADS_LOCK:
+        n = torch.get_num_threads()
+        if n <= 1:
+            return None
+        if _THREADS['original'] is None:
+            _THREADS['original'] = n
+        torch.set_num_threads(n // 2)
+    return f'whisper threads {n} -> {n // 2}'
+
+
+def _holdTorchThreads():
+    with _THREADS_LOCK:
+        _THREADS['running'] += 1
+
+
+def _releaseTorchThreads():
+    with _THREADS_LOCK:
+        _THREADS['running'] -= 1
+        original = _THREADS['original']
+        if _THREADS['running'] == 0 and original is not None:
+            import torch
+            torch.set_num_threads(original)
+            _THREADS['original'] = None
+            print(f'Restored whisper threads to {original}')
+
+
+def _applyOnLoop(coro, loop) -> bool:
+    # Run coro on the upload loop from the governor's thread.  The loop may have finished (or be stuck) by the time
+    # an action fires, and the governor's thread must never block on it.
+    try:
+        asyncio.run_coroutine_threadsafe(coro, loop).result(timeout=LOOP_ACTION_TIMEOUT_S)
+        return True
+    except RuntimeError:
+        # the loop is closed
+        coro.close()
+        return False
+    except concurrent.futures.TimeoutError:
+        return False
+
+
 def generateWhisperTranscript(wav_file, tp: TaskProps, model="large", custom_name=""):
     """
     Uses OpenAI Whisper to generate a transcription from an audio file.
@@ -38,28 +101,22 @@ def generateWhisperTranscript(wav_file, tp: TaskProps, model="large", custom_nam
         raise ValueError('Parameter tp must be of type TaskProps.')
 
     print(f'Beginning Whisper transcription from {wav_file}')
-    model = whisper.load_model(model)
+    model = loadWhisperModel(model)
     result = model.transcribe(wav_file)
 
-    if custom_name:
-        whisper_filename = str(custom_name)
+    if str(custom_name):
+        table = 'whisper_' + str(custom_name)
     else: 
-        whisper_filename = tp.task_name
-
-    # TODO: do i actually need to use whisper's file writer for text? 
-
-    # save TXT
-    with open(os.path.join(tp.whisper_transcriptions_dir, str(whisper_filename) + '_whisper.txt'), "w", encoding="utf-8") as txt:
-        write_txt(result["segments"], file=txt)
-    print('Saved TXT file of whisper transcription at: {}'.format(os.path.join(
-        tp.whisper_transcriptions_dir, str(whisper_filename) + '_whisper.txt')))
-
-    # save VTT
-    with open(os.path.join(tp.whisper_transcriptions_dir, str(whisper_filename) + '_whisper.vtt'), "w", encoding="utf-8") as vtt:
-        write_vtt(result["segments"], file=vtt)
-    print('Saved VTT file of whisper transcription at: {}'.format(os.path.join(
-        tp.whisper_transcriptions_dir, str(whisper_filename) + '_whisper.vtt')))
+        table = 'whisper'
 
+    segments = result["segments"]
+    TaskStore(tp).write_table(table, {
+        'start': [seg['start'] for seg in segments],
+        'end': [seg['end'] for seg in segments],
+        'text': [seg['text'].strip() for seg in segments],
+    })
+    print(f'Saved whisper transcription to the task intermediates as table: {table}')
+    return table
 
 
 def diarizedTranscriptPyannote(wav_file, tp: TaskProps):
@@ -77,45 +134,378 @@ def diarizedTranscriptPyannote(wav_file, tp: TaskProps):
     
     """
     whisper_model = Config().get_param('WHISPER_MODEL')
-    dz = Diarize(tp,3).diarize_pyannote(wav_file)
-    groups = dz[0]
-    gidx = dz[1]
-    
-    # Make sure there's a directory to save the audio segment files in
-    tp.createTaskDir(tp.whisper_transcriptions_dir)
+    segments = Diarize(tp).pyannote_segments(wav_file)
+    rows = transcribeSegmentsLocal(wav_file, segments, whisper_model, tp)
+    writeDiarizedTranscript(tp, rows)
 
-    for i in range(gidx+1):
-        segment_audio_filename = tp.dia_segments_dir, str(gidx) + '.wav'
-        generateWhisperTranscript(segment_audio_filename, tp, whisper_model, i)
-    
-    gidx = -1
 
-    final_output_file = os.path.join(tp.diarized_transcriptions_dir, tp.task_name + ".txt")
+async def diarizeDeepgram(wav_file, tp: TaskProps) -> list:
+    """
+    Deepgram diarization as [start, end, speaker, caption] segments, with speakers labelled 'Speaker_<n>'.
+    """
+    dz = await Diarize(tp).diarize_deepgram(wav_file)
+    return [[s[0], s[1], 'Speaker_' + str(s[2]), s[3]] for s in dz]
 
-    with open(final_output_file, "w", encoding="utf-8") as text_file:
-        for g in groups:
-            shift = re.findall('[0-9]+:[0-9]+:[0-9]+\.[0-9]+', string=g[0])[0] # the start time in the original video
-            shift = millisec(shift) - 2000
-            shift = max(shift, 0)
 
-            gidx += 1
+def transcribeSegmentsLocal(wav_file, segments, whisper_model: str, tp: TaskProps, metrics_key=None, model_copy=0) -> list:
+    """
+    Run OpenAI Whisper locally over each diarized segment of an audio file.
+
+    Parameters
+    ----------
+    wav_file: str
+        The path to the audio file the segments were diarized from.
+
+    segments: list
+        [start, end, speaker, ...] segments, with times in seconds.
+
+    whisper_model: str
+        The whisper model instance (tiny, base, small, medium, large).
+
+    tp: TaskProps
+        An instantiated utils.TaskProps class that provides all the necessary directory names.
+
+    metrics_key: str
+        Record this run's metrics under this key of each metrics section, for parts of a recording (e.g. its
+        channels) that are transcribed side by side.
+
+    model_copy: int
+        Decode with this copy of the whisper model, so parts transcribed on different copies decode in parallel.
+
+    Returns [start, end, speaker, text] rows for the segments that produced any text.
+    """
+    audio = {'full': AudioSegment.from_wav(wav_file)}
+    session = newDecodeSession(whisper_model, model_copy)
+
+    def segment_audio(i):
+        # Hand whisper the segment samples directly instead of exporting a wav per segment.
+        start, end = float(segments[i][0]), float(segments[i][1])
+        # read once: the governor's thread can drop it at any moment
+        full = audio['full']
+        if full is not None:
+            return audioSegmentToWhisper(full[start * 1000:end * 1000])
+        with WavSource(wav_file) as source:
+            first = source.frame_at(start)
+            data = source.read_frames(first, source.frame_at(end) - first)
+            return audioSegmentToWhisper(AudioSegment(
+                data=data, sample_width=source.sample_width, frame_rate=source.frame_rate, channels=source.channels
+            ))
+
+    def stream_audio():
+        # under memory pressure, read each segment from the file instead of keeping the whole recording decoded
+        if audio['full'] is None:
+            return None
+        audio['full'] = None
+        return 'dropped the decoded recording, reading segments from the file'
+
+    governor = currentGovernor()
+    _holdTorchThreads()
+    actions = [
+        governor.add_action('stream_audio', stream_audio, 'memory', repeat=False),
+        governor.add_action('whisper_threads', _fewerTorchThreads, 'cpu'),
+    ]
+
+    rows = []
+    dedupe = None
+    try:
+        # Detect the language once, on the longest segment, rather than on every segment.
+        longest = max(range(len(segments)), key=lambda i: float(segments[i][1]) - float(segments[i][0]), default=None)
+        if longest is not None and session.language is None:
+            session.detect_language(segment_audio(longest))
+
+        # segments whose audio was transcribed before with the same model reuse that transcript
+        language = Config().get_optional_param('WHISPER_LANGUAGE')
+        dedupe = dedupeFor(tp, f'whisper:{whisper_model}' + (f':{language}' if language else ''))
+
+        print(f'Beginning Whisper transcription of {len(segments)} diarized segments')
+        with WavSource(wav_file) as source:
+            for i, segment in enumerate(segments):
+                governor.checkpoint()
+                speaker = segment[2]
+                w = dedupe.match(source, i, segment) if dedupe is not None else None
+                if w is None:
+                    w = session.transcribe(segment_audio(i), speaker)["text"].strip()
+                    if dedupe is not None:
+                        dedupe.remember(i, w)
+
+                if w:
+                    rows.append([segment[0], segment[1], speaker, w])
+                    print(f'{speaker}: {w}')
+    finally:
+        for a in actions:
+            governor.remove_action(a)
+        # a worker process runs job after job, don't leave it with the threads this one was cut down to
+        _releaseTorchThreads()
+        if dedupe is not None:
+            dedupe.close(tp, metrics_key)
+
+    stats = session.stats()
+    TaskMetrics(tp).record('decode', {metrics_key: stats} if metrics_key else stats)
+    if 'cascade' in stats:
+        cs = stats['cascade']
+        saved = f"{cs['estimated_seconds_saved']}s" if cs['estimated_seconds_saved'] is not None else 'unknown'
+        print(f"Cascade escalated {cs['escalations']} of {cs['segments']} segments ({cs['escalation_rate']:.0%}), estimated time saved: {saved}")
+    return rows
+
+
+async def transcribeSegmentsDeepgram(wav_file, segments, tp: TaskProps, policy=None, metrics_key=None, reuse=True) -> list:
+    """
+    Leverage Deepgram's API to run OpenAI Whisper over each diarized segment of an audio file.
+
+    Parameters
+    ----------
+    wav_file: str
+        The path to the audio file the segments were diarized from.
+
+    segments: list
+        [start, end, speaker, ...] segments, with times in seconds.
+
+    tp: TaskProps
+        An instantiated utils.TaskProps class that provides all the necessary directory names.
+
+    policy: str
+        What to do when a segment fails: 'fail_fast' cancels the outstanding requests and raises, 'continue' carries
+        on and marks the failed segments in the transcript.  Defaults to DEEPGRAM_FAILURE_POLICY from config.
+
+    metrics_key: str
+        Record this run's metrics under this key of each metrics section, as for transcribeSegmentsLocal.
+
+    reuse: bool
+        Whether segment results saved by an earlier failed or interrupted run may be reused.
+
+    Every result is persisted to a SegmentLedger as it arrives, and segments the ledger already has a result for
+    (from an earlier failed or interrupted run of the same recording) aren't uploaded again.  Once every segment
+    has a result, they're dropped from the ledger.
+
+    Returns [start, end, speaker, text] rows for the segments that produced any text.  Under 'continue', failed
+    segments get FAILED_SEGMENT_TEXT as their text.
+    """
+    # Initialize the Deepgram SDK, or the submit-then-collect client in callback mode
+    jobs = deepgramJobs() if callbacksEnabled() else None
+    deepgram = deepgramClient() if jobs is None else None
+
+    # Segment payloads are generated lazily from the source file and streamed in chunks, with the audio in flight
+    # capped by a byte budget, so peak memory doesn't grow with the number of segments or the length of the file.
+    c = Config()
+    budget = ByteBudget(float(c.get_optional_param('DEEPGRAM_INFLIGHT_MB', 64)) * 1024 * 1024)
+    concurrency = ConcurrencyLimit(int(c.get_optional_param('DEEPGRAM_MAX_CONCURRENCY', 50)))
+    chunk_bytes = int(c.get_optional_param('UPLOAD_CHUNK_KB', 256)) * 1024
+    policy = policy or c.get_optional_param('DEEPGRAM_FAILURE_POLICY', 'fail_fast')
+
+    ledger = SegmentLedger(tp.partial_dir, fileFingerprint(wav_file), 'deepgram-whisper')
+    if not reuse:
+        ledger.discard(segments)
+    reused = {i: ledger.completed(seg) for i, seg in enumerate(segments) if ledger.completed(seg)}
+    if reused:
+        print(f'Reusing {len(reused)} segment transcripts from a previous run, uploading the other {len(segments) - len(reused)}.')
+
+    # segments whose audio was transcribed before reuse that transcript; repeats within the recording wait for
+    # the first occurrence instead of being uploaded too
+    dedupe = dedupeFor(tp, 'deepgram-whisper')
+    duplicates = {}
+    if dedupe is not None:
+        with WavSource(wav_file) as source:
+            for i, seg in enumerate(segments):
+                if i not in reused:
+                    text = dedupe.match(source, i, seg)
+                    if text is not None:
+                        duplicates[i] = {'text': text}
+        duplicates.update({i: {'text': None} for i in dedupe.followers})
+
+    def persist(i, segment, result, error):
+        ledger.record(i, segment, result[3] if result else '', error)
+        if dedupe is not None:
+            if error is None:
+                dedupe.remember(i, result[3] if result else '')
+            else:
+                dedupe.forget(i)
+
+    async def get_transcript(i, segment, payload):
+        print(f'Starting task: {i}')
+        try:
+            # As of now there seems to be a server error thrown if file size is too small when uploaded to deepgram.
+            # The payload carries a 2 second silent spacer to be safe.
+            options = {
+                'punctuate': True, 
+                'tier': 'enhanced', 
+                'model': 'whisper'}
+            if jobs is not None:
+                # the budget and concurrency slots only cover the upload, not the wait for the callback
+                response = await jobs.transcribe(payload.chunks(), options, session=session, on_submitted=payload.uploaded)
+            else:
+                source = {'buffer': payload.chunks(), 'mimetype': 'audio/wav'}
+                response = await deepgram.transcription.prerecorded(source, options)
+            transcript = response["results"]["channels"][0]["alternatives"][0]["transcript"]
+            speaker = segment[2]
+
+            if transcript:
+                result = [segment[0], segment[1], speaker, transcript]
+                print(f'{speaker}: {transcript}')
+            else:
+                result = None
+        except ClientResponseError as e:
+            print(f'Error while getting transcript for task {i}: {str(e)}')
+            raise
+        except Exception as e:
+            print(f'task of error: {i}')
+            print(f'Error while getting transcript for task {i}: {str(e)}')
+            raise
+
+        return result
+
+    # The resource governor samples from its own thread, so it shrinks the limits through the event loop.
+    loop = asyncio.get_running_loop()
+
+    def shrink_budget():
+        if budget.limit <= MIN_INFLIGHT_BYTES:
+            return None
+        old, new = budget.limit, max(budget.limit // 2, MIN_INFLIGHT_BYTES)
+        if not _applyOnLoop(budget.set_limit(new), loop):
+            return None
+        return f'upload budget {old / 1024 / 1024:.1f}MB -> {new / 1024 / 1024:.1f}MB'
+
+    def shrink_concurrency():
+        if concurrency.limit <= MIN_CONCURRENCY:
+            return None
+        old, new = concurrency.limit, max(concurrency.limit // 2, MIN_CONCURRENCY)
+        if not _applyOnLoop(concurrency.set_limit(new), loop):
+            return None
+        return f'upload concurrency {old} -> {new}'
+
+    governor = currentGovernor()
+    actions = [
+        governor.add_action('upload_budget', shrink_budget, 'memory'),
+        governor.add_action('upload_concurrency', shrink_concurrency, 'memory'),
+        governor.add_action('upload_concurrency', shrink_concurrency, 'cpu'),
+    ]
+
+    print('Getting whisper transcripts from Deepgram...')
+    failures = {}
+    # callback requests share one connection pool; they only hold a connection while their audio uploads
+    session = aiohttp.ClientSession() if jobs is not None else None
+    try:
+        with WavSource(wav_file) as source:
+            result_list, failures = await uploadSegments(
+                source, segments, get_transcript, budget, concurrency, spacer_ms=2000, chunk_bytes=chunk_bytes,
+                policy=policy, on_result=persist, skip=reused | duplicates
+            )
+    except SegmentFailures:
+        print(f'Stopped after a failed segment.  Completed segment transcripts are saved at {ledger.file}; '
+              'running the same recording again only uploads the missing segments.')
+        raise
+    finally:
+        for a in actions:
+            governor.remove_action(a)
+        if session is not None:
+            await session.close()
+        if dedupe is not None:
+            dedupe.close(tp, metrics_key)
+        upload = {
+            'segments': len(segments),
+            'reused': len(reused),
+            'failed': len(failures),
+            'policy': policy,
+            'peak_in_flight_bytes': budget.peak,
+            'budget_bytes': budget.limit,
+            'max_concurrency': concurrency.limit,
+            **({'callbacks': jobs.stats} if jobs is not None else {}),
+        }
+        TaskMetrics(tp).record('upload', {metrics_key: upload} if metrics_key else upload)
+
+    if dedupe is not None:
+        # repeats get the transcript of their first occurrence, or fail with it
+        texts = {i: r[3] if r else '' for i, r in enumerate(result_list) if i not in failures and i not in duplicates}
+        for i, text in dedupe.follower_texts(texts).items():
+            duplicates[i]['text'] = text
+        failures.update({i: failures[j] for i, j in dedupe.followers.items() if j in failures})
+    for i, e in (reused | duplicates).items():
+        if e['text']:
+            result_list[i] = [segments[i][0], segments[i][1], segments[i][2], e['text']]
+    for i in failures:
+        result_list[i] = [segments[i][0], segments[i][1], segments[i][2], FAILED_SEGMENT_TEXT]
+    if failures:
+        print(f'{len(failures)} segments failed and are marked in the transcript.  Run the same recording again to retry them.')
+    else:
+        # the transcript is complete, there's nothing left to resume
+        ledger.discard(segments)
+
+    return [r for r in result_list if r]
+
+
+def newDecodeSession(whisper_model, model_copy=0):
+    """
+    Start a per-recording whisper decode session using the decode settings from config.  When WHISPER_CASCADE_MODEL
+    is set, segments are decoded with that model first and only escalated to whisper_model when they fail the
+    cascade thresholds.  model_copy picks the copy of the models to decode with (see decode.modelKey).
+    """
+    c = Config()
+
+    def session(model):
+        return DecodeSession(
+            model,
+            max_fallbacks=int(c.get_optional_param('WHISPER_MAX_FALLBACKS', 2)),
+            prompt_chars=int(c.get_optional_param('WHISPER_PROMPT_CHARS', 200)),
+            language=c.get_optional_param('WHISPER_LANGUAGE'),
+            copy=model_copy
+        )
+
+    cascade_model = c.get_optional_param('WHISPER_CASCADE_MODEL')
+    if not cascade_model or cascade_model == whisper_model:
+        return session(whisper_model)
+
+    print(f'Cascade decoding: {cascade_model} first, {whisper_model} for segments that need it.')
+    return CascadeDecoder(
+        session(cascade_model),
+        session(whisper_model),
+        **cascadeThresholds()
+    )
+
+
+def cascadeThresholds() -> dict:
+    c = Config()
+    return {
+        'min_avg_logprob': float(c.get_optional_param('CASCADE_MIN_AVG_LOGPROB', -0.8)),
+        'max_compression_ratio': float(c.get_optional_param('CASCADE_MAX_COMPRESSION_RATIO', 2.2)),
+        'max_no_speech_prob': float(c.get_optional_param('CASCADE_MAX_NO_SPEECH_PROB', 0.5)),
+    }
+
+
+def writeDiarizedTranscript(tp: TaskProps, rows) -> str:
+    """
+    Persist the transcribed segments as the task's 'segments' intermediate table and write the final
+    diarized transcript text file from it.
+
+    Parameters
+    ----------
+    tp: TaskProps
+        An instantiated utils.TaskProps class that provides all the necessary directory names.
 
-            vtt_file = os.path.join(tp.tmp_file_dir, 'whisper_transcriptions/' + str(gidx) + '_whisper.vtt')
-            captions = [[(int)(millisec(caption.start)), (int)(millisec(caption.end)),  caption.text] for caption in webvtt.read(vtt_file)]
+    rows: list
+        [start, end, speaker, text] rows, in the order they should appear in the transcript.
+    """
+    TaskStore(tp).write_table(SEGMENTS, {
+        'start': [float(r[0]) for r in rows],
+        'end': [float(r[1]) for r in rows],
+        'speaker': [str(r[2]) for r in rows],
+        'text': [str(r[3]) for r in rows],
+    })
 
-            if captions:
-                speaker = g[0].split()[-1]
+    final_output_file = os.path.join(tp.diarized_transcriptions_dir, tp.task_name + ".txt")
 
-                for c in captions:
-                    text_file.write(f'{speaker}: {c[2]}')
+    with open(final_output_file, "w", encoding="utf-8") as text_file:
+        for r in rows:
+            if r[3]:
+                text_file.write(f'{r[2]}: {r[3]}\n')
     
     print(f'Saved diarized transcript at location: {final_output_file}')
+    indexTranscript(tp, final_output_file, rows)
+    return final_output_file
 
 
 def getWhisperTxt(wav_file, model="large") -> str:
 
     print(f'Beginning Whisper transcription from {wav_file}')
-    model = whisper.load_model(model)
+    model = loadWhisperModel(model)
     w = model.transcribe(wav_file)    
     transcript_txt: str = w["text"]
     
@@ -141,43 +531,14 @@ async def diarizedTranscriptDeepgramWhisperLocal(
 
     """
     
-    dz = await Diarize(tp).diarize_deepgram(wav_file)
-
-    audio = AudioSegment.from_wav(wav_file)
-
-    # Make sure there's a directory to save the audio segment files in
-    tp.createTaskDir(tp.dia_segments_dir)
-
-    idx = 0
-    for segment in dz:
-        start = float(segment[0]) * 1000
-        end = float(segment[1]) * 1000
-
-        output_af_name = os.path.join(tp.dia_segments_dir + str(idx) + '.wav')
-        audio[start:end].export(output_af_name, format='wav')
-        idx += 1
-        
-    final_output_file = os.path.join(tp.diarized_transcriptions_dir, tp.task_name + ".txt")
-
-    with open(final_output_file, "w", encoding="utf-8") as text_file:
-
-        for i in range(len(dz)):
-            segment_audio = os.path.join(tp.dia_segments_dir, str(i) + '.wav')
-            speaker = 'Speaker_' + str(dz[i][2])
-            w = getWhisperTxt(segment_audio, whisper_model)
-
-            if w:
-                text_file.write(f'{speaker}: {w}\n')
-                print(f'{speaker}: {w}')
-
-    print(f'Saved diarized transcript at location: {final_output_file}')
+    segments = await diarizeDeepgram(wav_file, tp)
+    rows = transcribeSegmentsLocal(wav_file, segments, whisper_model, tp)
+    writeDiarizedTranscript(tp, rows)
 
 async def getWhisperTxtDeepgram(wav_file) -> str:
 
-    deepgram_api_key = Config().get_param('DEEPGRAM_API_KEY')
-
     # Initialize the Deepgram SDK
-    deepgram = Deepgram(deepgram_api_key)
+    deepgram = deepgramClient()
 
     # with open(wav_file,'rb') as audio:
         # source = {'buffer': audio, 'mimetype': 'audio/wav'}
@@ -196,9 +557,7 @@ async def getWhisperTxtDeepgram(wav_file) -> str:
             )
         )
 
-    # output_json = json.dumps(response)
-    j = json.loads(response)
-    transcript = j["results"]["channels"][0]["alternatives"][0]["transcript"]
+    transcript = response["results"]["channels"][0]["alternatives"][0]["transcript"]
 
     return transcript
 
@@ -222,90 +581,6 @@ async def diarizedTranscriptAllDeepgram(
 
     """
 
-    dz = await Diarize(tp).diarize_deepgram(wav_file)
-
-    audio = AudioSegment.from_wav(wav_file)
-
-    # Make sure there's a directory to save the audio segment files in
-    tp.createTaskDir(tp.dia_segments_dir)
-
-    print('Creating audio segments based on the diarization...')
-    idx = 0
-    for segment in dz:
-        start = float(segment[0]) * 1000
-        end = float(segment[1]) * 1000
-
-        output_af_name = os.path.join(tp.dia_segments_dir + str(idx) + '.wav')
-        extract = audio[start:end]
-        
-        # As of now there seems to be a server error thrown if file size is too small when uploaded to deepgram.  add spacer to be safe.
-        spacer = AudioSegment.silent(duration=2000)
-        add_spacer = spacer.append(extract,crossfade=0)
-        add_spacer.export(output_af_name, format='wav')
-        idx += 1
-
-    deepgram_api_key = Config().get_param('DEEPGRAM_API_KEY')
-    
-    # Initialize the Deepgram SDK
-    deepgram = Deepgram(deepgram_api_key)
-
-    async def gather_with_concurrency_limit(n, *coros):
-        semaphore = asyncio.Semaphore(n)
-
-        async def sem_coro(coro):
-            async with semaphore:
-                return await coro
-        return await asyncio.gather(*(sem_coro(c) for c in coros))
-
-    async def get_transcript(i, s, af):
-        print(f'Starting task: {i}')
-        try:
-            async with aiofiles.open(af, mode='rb') as f:
-                audio = await f.read()
-                source = {'buffer': audio, 'mimetype': 'audio/wav'}
-                response = await asyncio.create_task(
-                    deepgram.transcription.prerecorded(
-                        source,
-                        {
-                            'punctuate': True, 
-                            'tier': 'enhanced', 
-                            'model': 'whisper'}
-                    )
-                )
-                output_json = json.dumps(response)
-                j = json.loads(output_json)
-                transcript = j["results"]["channels"][0]["alternatives"][0]["transcript"]
-                speaker = 'Speaker_' + s
-
-                if transcript:
-                    result = f'{speaker}: {transcript}'
-                    print(result)
-                else:
-                    result = ""
-        except ClientResponseError as e:
-            print(f'Error while getting transcript for task {i}: {str(e)}')
-            raise
-        except Exception as e:
-            print(f'task of error: {i}')
-            print(f'Error while getting transcript for task {i}: {str(e)}')
-            raise
-
-        return result
-
-    coroutines = []
-    for i in range(len(dz)):
-        speaker = str(dz[i][2])
-        af = f'{tp.dia_segments_dir}/{str(i)}.wav'
-        coroutines.append(get_transcript(i,speaker,af))
-
-    print('Getting whisper transcripts from Deepgram...')
-    result_list = await gather_with_concurrency_limit(50, *coroutines)
-    
-    final_output_file = f'{tp.diarized_transcriptions_dir}/{tp.task_name}.txt'
-
-    async with aiofiles.open(final_output_file, "w", encoding="utf-8") as text_file:
-        for r in result_list:
-            if r:
-                await text_file.write(f'{r}\n')
-        
-    print(f'Saved diarized transcript at location: {final_output_file}')
+    segments = await diarizeDeepgram(wav_file, tp)
+    rows = await transcribeSegmentsDeepgram(wav_file, segments, tp)
+    writeDiarizedTranscript(tp, rows)
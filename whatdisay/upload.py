@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+import asyncio
+import io
+import numpy as np
+import os
+import struct
+
+
+class WavSource:
+    """
+    Read-only, shared view of a PCM wav file.  Frames are read with positional reads straight from the file, so
+    any number of concurrent segment uploads can stream from one open file without loading the audio in memory.
+
+    Parameters
+    ----------
+    wav_file: str
+        The path to the audio file.
+    """
+
+    def __init__(self, wav_file):
+        self.wav_file = wav_file
+        self.fd = os.open(wav_file, os.O_RDONLY)
+        try:
+            self._read_header()
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def _read_header(self):
+        riff = os.pread(self.fd, 12, 0)
+        if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f'Not a RIFF/WAVE file: {self.wav_file}')
+
+        pos = 12
+        fmt = None
+        while True:
+            hdr = os.pread(self.fd, 8, pos)
+            if len(hdr) < 8:
+                raise ValueError(f'No data chunk found in wav file: {self.wav_file}')
+            cid, size = hdr[0:4], struct.unpack('<I', hdr[4:8])[0]
+            if cid == b'fmt ':
+                fmt = os.pread(self.fd, size, pos + 8)
+            elif cid == b'data':
+                self.data_offset = pos + 8
+                available = os.fstat(self.fd).st_size - self.data_offset
+                # a recorder still writing the file hasn't filled in the data size yet
+                self.data_size = available if size in (0, 0xFFFFFFFF) else min(size, available)
+                break
+            pos += 8 + size + (size & 1)
+
+        if fmt is None:
+            raise ValueError(f'No fmt chunk found in wav file: {self.wav_file}')
+        audio_format, self.channels, self.frame_rate, _, self.block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+        if audio_format not in (1, 0xFFFE):
+            raise ValueError('Only PCM wav files are supported.')
+        self.sample_width = bits // 8
+        self.nframes = self.data_size // self.block_align
+
+    @property
+    def duration(self) -> float:
+        return self.nframes / self.frame_rate
+
+    def frame_at(self, seconds: float) -> int:
+        return min(max(int(round(float(seconds) * self.frame_rate)), 0), self.nframes)
+
+    def read_frames(self, start_frame: int, nframes: int) -> bytes:
+        return os.pread(self.fd, nframes * self.block_align, self.data_offset + start_frame * self.block_align)
+
+    def read_samples(self, start_frame: int, nframes: int) -> np.ndarray:
+        """Frames as a (frames, channels) float32 array scaled to [-1, 1], for 8, 16, 24 and 32 bit PCM."""
+        return pcmToFloat(self.read_frames(start_frame, nframes), self.sample_width, self.channels)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def pcmToFloat(data: bytes, sample_width: int, channels: int) -> np.ndarray:
+    """Little-endian PCM samples as a (frames, channels) float32 array scaled to [-1, 1]."""
+    if sample_width == 3:
+        # no 24 bit dtype: place each sample in the top bytes of an int32, which keeps its sign
+        b = np.frombuffer(data, dtype=np.uint8)[:len(data) // 3 * 3].reshape(-1, 3)
+        x = np.zeros((len(b), 4), dtype=np.uint8)
+        x[:, 1:] = b
+        x = x.view('<i4').ravel()
+        full_scale = float(2 ** 31)
+    elif sample_width in (1, 2, 4):
+        x = np.frombuffer(data, dtype={1: np.uint8, 2: '<i2', 4: '<i4'}[sample_width])
+        full_scale = float(2 ** (8 * sample_width - 1))
+    else:
+        raise ValueError(f'Unsupported sample width: {sample_width} bytes')
+    x = x[:len(x) // channels * channels].reshape(-1, channels).astype(np.float32)
+    if sample_width == 1:
+        x -= 128
+    return x / full_scale
+
+
+def wavHeader(nframes: int, channels: int, sample_width: int, frame_rate: int) -> bytes:
+    block_align = channels * sample_width
+    data_size = nframes * block_align
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, frame_rate, frame_rate * block_align, block_align, sample_width * 8,
+        b'data', data_size
+    )
+
+
+class PaddedWavReader(io.RawIOBase):
+    """
+    Seekable, read-only wav file that is a range of a WavSource with leading silence, without copying the audio.
+    The header and the silence are generated on the fly and the source frames are read from the file as they're
+    asked for, so it can be handed to anything that reads wav files from a file object (pyannote, soundfile,
+    pydub, shutil.copyfileobj, ...).
+
+    Times on the padded timeline map back to the source with to_source_time.
+
+    Parameters
+    ----------
+    source: WavSource
+        The audio to read from.  It is not closed with the reader.
+
+    pad_ms: int
+        Milliseconds of silence before the audio.
+
+    start, end: float
+        The range of the source to expose, in seconds.  Defaults to all of it.
+    """
+
+    HEADER_BYTES = 44
+
+    def __init__(self, source: WavSource, pad_ms=0, start=0.0, end=None):
+        super().__init__()
+        self.source = source
+        self.start_frame = source.frame_at(start)
+        self.end_frame = max(source.frame_at(end) if end is not None else source.nframes, self.start_frame)
+        self.pad_frames = int(source.frame_rate * pad_ms / 1000)
+        self.nframes = self.pad_frames + self.end_frame - self.start_frame
+        self.header = wavHeader(self.nframes, source.channels, source.sample_width, source.frame_rate)
+        self.pad_bytes = self.pad_frames * source.block_align
+        self.size = self.HEADER_BYTES + self.nframes * source.block_align
+        self.pos = 0
+
+    @property
+    def offset(self) -> float:
+        """Seconds to subtract from a time on the padded timeline to get the time in the source."""
+        return (self.pad_frames - self.start_frame) / self.source.frame_rate
+
+    def to_source_time(self, t: float) -> float:
+        return min(max(float(t) - self.offset, 0.0), self.source.duration)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        if pos < 0:
+            raise ValueError('Negative seek position')
+        self.pos = pos
+        return self.pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        n = 0
+        while n < len(view) and self.pos < self.size:
+            chunk = self._read_at(self.pos, len(view) - n)
+            if not chunk:
+                # the source file is shorter than its header says
+                break
+            view[n:n + len(chunk)] = chunk
+            n += len(chunk)
+            self.pos += len(chunk)
+        return n
+
+    def _read_at(self, pos, n) -> bytes:
+        if pos < self.HEADER_BYTES:
+            return self.header[pos:pos + n]
+        pos -= self.HEADER_BYTES
+        if pos < self.pad_bytes:
+            return bytes(min(n, self.pad_bytes - pos))
+        pos -= self.pad_bytes
+
+        # only whole frames are read from the source, then trimmed to the requested bytes
+        ba = self.source.block_align
+        first = pos // ba
+        last = min(-(-(pos + n) // ba), self.end_frame - self.start_frame)
+        data = self.source.read_frames(self.start_frame + first, last - first)
+        skip = pos - first * ba
+        return data[skip:skip + n]
+
+
+class SegmentPayload:
+    """
+    A wav request body for one segment of a WavSource, with optional leading silence, generated lazily in chunks.
+    Nothing is read from the source until the body is iterated.
+
+    uploadSegments sets on_uploaded to free what the payload holds of the byte budget and concurrency limit; a
+    sender that goes on waiting after the body is sent (e.g. for a callback) awaits uploaded() once it is.
+    """
+
+    def __init__(self, source: WavSource, start: float, end: float, spacer_ms=0, chunk_bytes=256 * 1024):
+        self.source = source
+        self.start_frame = source.frame_at(start)
+        self.end_frame = max(source.frame_at(end), self.start_frame)
+        self.spacer_frames = int(source.frame_rate * spacer_ms / 1000)
+        self.chunk_frames = max(chunk_bytes // source.block_align, 1)
+        self.on_uploaded = None
+
+    async def uploaded(self):
+        on_uploaded, self.on_uploaded = self.on_uploaded, None
+        if on_uploaded is not None:
+            await on_uploaded()
+
+    @property
+    def nframes(self) -> int:
+        return self.spacer_frames + self.end_frame - self.start_frame
+
+    @property
+    def size(self) -> int:
+        return 44 + self.nframes * self.source.block_align
+
+    async def chunks(self):
+        s = self.source
+        yield wavHeader(self.nframes, s.channels, s.sample_width, s.frame_rate)
+
+        remaining = self.spacer_frames
+        while remaining > 0:
+            n = min(remaining, self.chunk_frames)
+            yield bytes(n * s.block_align)
+            remaining -= n
+
+        f = self.start_frame
+        while f < self.end_frame:
+            n = min(self.end_frame - f, self.chunk_frames)
+            yield s.read_frames(f, n)
+            f += n
+            # let other uploads make progress between chunks
+            await asyncio.sleep(0)
+
+
+class ByteBudget:
+    """
+    Async semaphore over bytes: callers acquire the size of the payload they're about to put in flight and
+    release it once the request completes.  A payload bigger than the whole budget is admitted on its own.
+    The limit can be changed while uploads are running.
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit = int(limit_bytes)
+        self.in_flight = 0
+        self.peak = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, n: int):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight == 0 or self.in_flight + n <= self.limit)
+            self.in_flight += n
+            self.peak = max(self.peak, self.in_flight)
+
+    async def release(self, n: int):
+        async with self.cond:
+            self.in_flight -= n
+            self.cond.notify_all()
+
+    async def set_limit(self, limit_bytes: int):
+        async with self.cond:
+            self.limit = int(limit_bytes)
+            self.cond.notify_all()
+
+
+class ConcurrencyLimit:
+    """
+    Async semaphore whose limit can be changed while it's in use, e.g. lowered by the resource governor.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = int(limit)
+        self.in_flight = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < max(self.limit, 1))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    async def set_limit(self, limit: int):
+        async with self.cond:
+            self.limit = int(limit)
+            self.cond.notify_all()
+
+
+class SegmentFailures(Exception):
+    """
+    Raised by uploadSegments under the 'fail_fast' policy.  Carries the failures and every result that had
+    completed before the outstanding uploads were cancelled.
+    """
+
+    def __init__(self, failures: dict, results: list):
+        self.failures = failures
+        self.results = results
+        i, e = next(iter(failures.items()))
+        super().__init__(f'{len(failures)} segment upload(s) failed, first was segment {i}: {str(e)}')
+
+
+FAILURE_POLICIES = ['fail_fast', 'continue']
+
+
+async def uploadSegments(
+    source: WavSource,
+    segments,
+    send,
+    budget: ByteBudget,
+    max_concurrency=50,
+    spacer_ms=0,
+    chunk_bytes=256 * 1024,
+    policy='fail_fast',
+    on_result=None,
+    skip=()
+    ):
+    """
+    Upload every [start, end, ...] segment of a WavSource through send(i, segment, payload).  Payloads are created
+    only once there's room for them in the byte budget, so the amount of audio in flight doesn't depend on how
+    many segments there are or how long the recording is.
+
+    Uploads run as one task group.  Under the 'fail_fast' policy the first failure stops new uploads, cancels the
+    outstanding ones and raises SegmentFailures; under 'continue' failed segments are collected and the rest carry on.
+    on_result(i, segment, result, error) is called as each upload finishes so results can be persisted as they arrive.
+    Segments whose index is in skip aren't uploaded.  max_concurrency can be a ConcurrencyLimit to change it
+    while the uploads run.
+
+    Returns (results, failures): the results in segment order (None where skipped or failed) and a dict of
+    segment index -> exception.
+    """
+    if policy not in FAILURE_POLICIES:
+        raise ValueError(f"Invalid failure policy '{policy}'.  Must be one of {FAILURE_POLICIES}.")
+
+    results = [None] * len(segments)
+    failures = {}
+    abort = asyncio.Event()
+    semaphore = max_concurrency if isinstance(max_concurrency, ConcurrencyLimit) else ConcurrencyLimit(max_concurrency)
+    tasks = set()
+
+    async def release(payload):
+        await budget.release(payload.size)
+        await semaphore.release()
+
+    async def run(i, segment, payload):
+        # the sender can free the payload's slots early by awaiting payload.uploaded()
+        payload.on_uploaded = lambda: release(payload)
+        try:
+            results[i] = await send(i, segment, payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failures[i] = e
+            if policy == 'fail_fast':
+                abort.set()
+        finally:
+            await payload.uploaded()
+
+        if on_result:
+            on_result(i, segment, results[i], failures.get(i))
+
+    try:
+        for i, segment in enumerate(segments):
+            if i in skip:
+                continue
+            payload = SegmentPayload(source, segment[0], segment[1], spacer_ms, chunk_bytes)
+            await semaphore.acquire()
+            await budget.acquire(payload.size)
+            if abort.is_set():
+                await budget.release(payload.size)
+                await semaphore.release()
+                break
+            t = asyncio.create_task(run(i, segment, payload))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+
+        if tasks:
+            if policy == 'fail_fast':
+                # wait until everything finishes or the first failure, whichever comes first
+                waiter = asyncio.create_task(abort.wait())
+                while tasks and not abort.is_set():
+                    await asyncio.wait(set(tasks) | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+            else:
+                await asyncio.gather(*tasks)
+    finally:
+        # never leave uploads running behind the caller's back
+        outstanding = list(tasks)
+        for t in outstanding:
+            t.cancel()
+        if outstanding:
+            await asyncio.gather(*outstanding, return_exceptions=True)
+            print(f'Cancelled {len(outstanding)} outstanding segment uploads.')
+
+    if failures and policy == 'fail_fast':
+        raise SegmentFailures(failures, results)
+
+    return results, failures
@@ -2,10 +2,13 @@
 
 import os
 import sys
-import shutil
+from whatdisay.storage import TaskStorage, LocalDiskStorage
 from pathlib import Path
-from pydub import AudioSegment
+from whatdisay.upload import WavSource, PaddedWavReader
 import time
+import json
+import shutil
+import threading
 
 def getTaskName(args:dict) -> str:
 
@@ -43,33 +46,48 @@ def check_file_is_valid(f: str) -> bool:
 
     return True
 
-# Add 0.5 second buffer to beginning of audio file to avoid loss on transcription.  accepts audio file name.
+# Add 2 second buffer to beginning of audio file to avoid loss on transcription.  accepts audio file name.
+# The silence and the audio are streamed into the new file, without loading the audio in memory.
 def addIntroSpacer(input_audio,output_dir):
-    audio = AudioSegment.from_wav(input_audio)
     spacermilli = 2000
-    spacer = AudioSegment.silent(duration=spacermilli)
-    audio = spacer.append(audio, crossfade=0)
 
     filename_spacer = output_dir + 'audio_intro_spacer.wav'
-    audio.export(filename_spacer, format='wav')
+    with WavSource(input_audio) as source, open(filename_spacer, 'wb') as f:
+        shutil.copyfileobj(PaddedWavReader(source, pad_ms=spacermilli), f)
     print('Saved new copy of {} at {}'.format(input_audio,filename_spacer))
 
 class TaskProps:
 
-    def __init__(self, task_name):
+    def __init__(self, task_name, output_dir=None, storage: TaskStorage = None):
         self.task_name = task_name
-        self.output_dir = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__name__))) + '/output/'
+
+        # Final outputs go to OUTPUT_DIR from the config when it's set.
+        if output_dir:
+            self.output_dir = os.path.join(os.path.realpath(os.path.expanduser(output_dir)), '')
+        else:
+            self.output_dir = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__name__))) + '/output/'
         self.diarized_transcriptions_dir = self.output_dir + 'diarized_transcriptions/'
         self.tasks_dir = self.output_dir + 'tasks/'
         self.task_dir = self.tasks_dir + str(self.task_name) + '/'
-        self.tmp_file_dir = self.task_dir + 'tmp_files/' 
-        self.dia_segments_dir = self.tmp_file_dir + 'audio_segments/' 
-        self.whisper_transcriptions_dir = self.tmp_file_dir + 'whisper_transcriptions/'
         self.pipelines_dir = self.output_dir + 'pipelines/'
         self.sd_pipeline = self.pipelines_dir + 'models--pyannote--speaker-diarization'
+        self.sd_snapshot = self.pipelines_dir + 'snapshots/speaker-diarization/'
         self.new_recordings_dir = self.output_dir + 'new_recordings/'
-        self.pyannote_diarization_txt = os.path.join(self.tmp_file_dir,'diarization.txt')
-        self.diarized_audio_file = os.path.join(self.tmp_file_dir, 'dz.wav')
+        self.metrics_dir = self.output_dir + 'metrics/'
+        self.stage_cache_dir = self.output_dir + 'cache/stages/'
+        self.embeddings_cache_dir = self.output_dir + 'cache/embeddings/'
+        self.partial_dir = self.output_dir + 'partial/'
+        self.queue_db = self.output_dir + 'queue/jobs.db'
+        self.incremental_dir = self.output_dir + 'incremental/'
+        self.search_index = self.output_dir + 'index/transcripts.db'
+        self.fingerprint_index = self.output_dir + 'index/fingerprints.db'
+        self.profiles_dir = self.output_dir + 'profiles/'
+
+        # Intermediates are named relative to the task storage, which may be on disk, on tmpfs or in memory.
+        self.storage = storage or LocalDiskStorage(self.task_dir)
+        self.tmp_files = 'tmp_files/'
+        self.dia_segments = self.tmp_files + 'audio_segments/'
+        self.intermediates = self.tmp_files + 'intermediates/'
 
     def createTaskDir(self,dir):
         if not os.path.exists(dir):
@@ -77,50 +95,55 @@ class TaskProps:
             os.makedirs(dir)
 
     def createAllTaskDirectories(self):
-        if not os.path.exists(self.output_dir):
-            print('Output directory not detected.  creating one..')
-            os.makedirs(self.output_dir)
-        if not os.path.exists(self.tasks_dir):
-            print('Output directory not detected.  creating one..')
-            os.makedirs(self.tasks_dir)
-        if not os.path.exists(self.task_dir):
-            print('Output directory not detected.  creating one..')
-            os.makedirs(self.task_dir)
-        if not os.path.exists(self.tmp_file_dir):
-            print('Tmp file directory not detected.  creating one..')
-            os.makedirs(self.tmp_file_dir)
-        if not os.path.exists(self.task_dir):
-            print('Task directory not detected.  creating one..')
-            os.makedirs(self.task_dir)
-        if not os.path.exists(self.diarized_transcriptions_dir):
-            print('Directory for final transcription files not detected.  creating one..')
-            os.makedirs(self.diarized_transcriptions_dir)
-        if not os.path.exists(self.whisper_transcriptions_dir):
-            print('Directory for whisper transcription files not detected.  creating one..')
-            os.makedirs(self.whisper_transcriptions_dir)
-        if not os.path.exists(self.dia_segments_dir):
-            print('Directory for diarization segments files not detected.  creating one..')
-            os.makedirs(self.dia_segments_dir)
+        for d in [self.output_dir, self.diarized_transcriptions_dir]:
+            self.createTaskDir(d)
+        for d in [self.tmp_files, self.dia_segments, self.intermediates]:
+            self.storage.makedirs(d)
 
     def cleanupTask(self):
-        # remove the task directory and delete all intermediate files used in creating the diarized transcript
-        p = self.task_dir
-        if os.path.exists(p):
-            print('Deleting task tmp file directory at: {}'.format(p))
-            shutil.rmtree(self.task_dir)
+        # remove the task's storage and delete all intermediate files used in creating the diarized transcript
+        if self.storage.exists('') or self.storage.listdir(''):
+            self.storage.remove_all()
         else:
             print('No task tmp directory found for task: {}'.format(self.task_name))
 
     def cleanupAllTasks(self):
-        # remove all tasks by deleting entire tmp directory
-        p = self.tmp_file_dir
-        if os.path.exists(p):
-            print('Deleting tmp file directory at: {}'.format(p))
-            shutil.rmtree(self.tmp_file_dir)
+        # remove all of the task's tmp files
+        if self.storage.exists(self.tmp_files):
+            print('Deleting tmp files for task: {}'.format(self.task_name))
+            self.storage.remove(self.tmp_files)
         else:
             print('No tmp directory found for task: {}'.format(self.task_name))
 
 
+class TaskMetrics:
+    """
+    Per-task metrics (decode counters, timings, ...) saved as json under the output 'metrics' dir, so they
+    outlive the cleanup of the task's tmp files.
+    """
+
+    def __init__(self, tp: TaskProps):
+        self.tp = tp
+        self.metrics_file = os.path.join(tp.metrics_dir, tp.task_name + '.json')
+
+    def load(self) -> dict:
+        if not os.path.exists(self.metrics_file):
+            return {}
+        with open(self.metrics_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    # stages running in parallel threads record into the same file
+    _lock = threading.Lock()
+
+    def record(self, section: str, values: dict):
+        with self._lock:
+            metrics = self.load()
+            metrics.setdefault(section, {}).update(values)
+            self.tp.createTaskDir(self.tp.metrics_dir)
+            with open(self.metrics_file, 'w', encoding='utf-8') as f:
+                json.dump(metrics, f, indent=4)
+
+
 class MdFileUtil:
 
     def __init__(self, in_file: str, tags: str, title: str, tp: TaskProps):
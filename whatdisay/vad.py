@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+from whatdisay.upload import WavSource
+import numpy as np
+
+
+def _blocks(source: WavSource, frame_len: int, block_seconds):
+    # (frames, channels) float samples of consecutive blocks of the file, each a whole number of frames long
+    block_frames = max(int(source.frame_rate * block_seconds) // frame_len, 1) * frame_len
+
+    for start in range(0, source.nframes, block_frames):
+        x = source.read_samples(start, min(block_frames, source.nframes - start))
+        usable = (len(x) // frame_len) * frame_len
+        if usable:
+            yield x[:usable]
+
+
+def _db(frames: np.ndarray) -> np.ndarray:
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def frameEnergies(source: WavSource, frame_ms=30, channel=None, block_seconds=30) -> np.ndarray:
+    """
+    RMS energy (dBFS) of consecutive frames of a wav file.  The file is read in blocks, so this never holds more
+    than block_seconds of audio in memory.
+
+    Parameters
+    ----------
+    source: WavSource
+        The audio to measure.
+
+    frame_ms: int
+        Frame length in milliseconds.
+
+    channel: int
+        Measure a single channel instead of the downmix of all channels.
+    """
+    frame_len = max(int(source.frame_rate * frame_ms / 1000), 1)
+    energies = []
+    for x in _blocks(source, frame_len, block_seconds):
+        x = x[:, channel] if channel is not None else x.mean(axis=1)
+        energies.append(_db(x.reshape(-1, frame_len)))
+
+    return np.concatenate(energies) if energies else np.zeros(0, dtype=np.float32)
+
+
+def channelEnergies(source: WavSource, frame_ms=30, block_seconds=30) -> np.ndarray:
+    """
+    Like frameEnergies, for every channel at once in a single pass over the file.  Returns a (channels, frames)
+    array.
+    """
+    frame_len = max(int(source.frame_rate * frame_ms / 1000), 1)
+    energies = []
+    for x in _blocks(source, frame_len, block_seconds):
+        energies.append(np.stack([_db(x[:, c].reshape(-1, frame_len)) for c in range(source.channels)]))
+
+    return np.concatenate(energies, axis=1) if energies else np.zeros((source.channels, 0), dtype=np.float32)
+
+
+def speechThreshold(energies_db: np.ndarray, margin_db=15.0) -> float:
+    """The noise floor (the 10th percentile of the frame energies) plus margin_db, and at least -60 dBFS."""
+    return max(float(np.percentile(energies_db, 10)) + margin_db, -60.0)
+
+
+def speechRegions(energies_db: np.ndarray, frame_ms=30, threshold_db=None, margin_db=15.0, min_speech_s=0.25, min_silence_s=0.5) -> list:
+    """
+    Turn frame energies into [start, end] speech regions, in seconds.
+
+    A frame counts as speech when it is louder than threshold_db, which defaults to the noise floor (the 10th
+    percentile of the frame energies) plus margin_db.  Gaps shorter than min_silence_s are bridged and regions
+    shorter than min_speech_s are dropped.
+    """
+    if len(energies_db) == 0:
+        return []
+    if threshold_db is None:
+        threshold_db = speechThreshold(energies_db, margin_db)
+    return activeRegions(energies_db > threshold_db, frame_ms, min_speech_s, min_silence_s)
+
+
+def activeRegions(active: np.ndarray, frame_ms=30, min_speech_s=0.25, min_silence_s=0.5) -> list:
+    """
+    Turn per-frame speech flags into [start, end] regions, in seconds, bridging gaps shorter than min_silence_s
+    and dropping regions shorter than min_speech_s.
+    """
+    frame_s = frame_ms / 1000
+    regions = []
+    start = None
+    for i, a in enumerate(active):
+        if a and start is None:
+            start = i
+        elif not a and start is not None:
+            regions.append([start * frame_s, i * frame_s])
+            start = None
+    if start is not None:
+        regions.append([start * frame_s, len(active) * frame_s])
+
+    merged = []
+    for r in regions:
+        if merged and r[0] - merged[-1][1] < min_silence_s:
+            merged[-1][1] = r[1]
+        else:
+            merged.append(r)
+
+    return [r for r in merged if r[1] - r[0] >= min_speech_s]
+
+
+def detectSpeech(wav_file, frame_ms=30, channel=None, **kwargs) -> list:
+    """
+    Energy-based voice activity detection over a wav file.  Returns [start, end] speech regions in seconds.
+    """
+    with WavSource(wav_file) as source:
+        energies = frameEnergies(source, frame_ms, channel)
+    return speechRegions(energies, frame_ms, **kwargs)
+
+
+def overlap(start: float, end: float, regions: list) -> float:
+    """
+    How many seconds of [start, end] fall inside the given (sorted, non-overlapping) regions.
+    """
+    total = 0.0
+    for r in regions:
+        if r[0] >= end:
+            break
+        total += max(0.0, min(end, r[1]) - max(start, r[0]))
+    return total